@@ -8,7 +8,7 @@ set -eo pipefail
 : "${GUNICORN_WORKERS:=4}"
 
 usage() {
-  echo "usage: ./bin/run.sh web|web-dev|worker|test|bash|manage.py"
+  echo "usage: ./bin/run.sh web|web-dev|worker|beat|test|bash|manage.py"
   exit 1
 }
 
@@ -43,6 +43,11 @@ case $1 in
   worker)
     exec celery -A relops_hardware_controller.celery:app worker -l debug
     ;;
+  beat)
+    # Sends the periodic tasks in CELERY_BEAT_SCHEDULE, e.g. the power sweep.
+    # Run exactly one next to the workers.
+    exec celery -A relops_hardware_controller.celery:app beat -l info --schedule /tmp/celerybeat-schedule
+    ;;
   worker-purge)
     # Start worker but first purge ALL old stale tasks.
     # Only useful in local development where you might have accidentally
@@ -58,6 +58,7 @@ import gettext
 import six.moves.xmlrpc_client as xmlrpclib
 import six.moves.http_client as httplib
 import socket
+import ssl
 import sys
 
 translation = gettext.translation('xen-xm', fallback = True)
@@ -113,6 +114,83 @@ class UDSTransport(xmlrpclib.Transport):
         for key, value in self._extra_headers:
             connection.putheader(key, value)
 
+class _KeepAliveHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, transport, host, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self._transport = transport
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self._transport.connections += 1
+
+class _KeepAliveHTTPSConnection(httplib.HTTPSConnection):
+    """HTTPSConnection resuming the TLS session of the transport's
+    previous connection."""
+    def __init__(self, transport, host, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self._transport = transport
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self._transport.connections += 1
+        server_hostname = self._tunnel_host or self.host
+        kwargs = {}
+        if self._transport.tls_session is not None:
+            kwargs['session'] = self._transport.tls_session
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=server_hostname,
+                                              **kwargs)
+        if getattr(self.sock, 'session_reused', False):
+            self._transport.resumed += 1
+        if not self._context.check_hostname and getattr(self, "_check_hostname", False):
+            try:
+                ssl.match_hostname(self.sock.getpeercert(), server_hostname)
+            except Exception:
+                self.sock.shutdown(socket.SHUT_RDWR)
+                self.sock.close()
+                raise
+
+class KeepAliveTransport(xmlrpclib.SafeTransport):
+    """Transport keeping its HTTP/1.1 connection to the server open
+    between requests, as xapi allows. Sockets time out after timeout
+    seconds, and https reconnections resume the TLS session of the
+    previous connection instead of a full handshake.
+
+    xmlrpclib retries a request once when the kept connection was
+    closed by the server in the meantime."""
+    def __init__(self, use_https=True, timeout=None, context=None, use_datetime=0):
+        xmlrpclib.SafeTransport.__init__(self, use_datetime=use_datetime, context=context)
+        self.use_https = use_https
+        self.timeout = timeout
+        self.tls_session = None
+        self._session_from = None
+        self.connections = 0
+        self.resumed = 0
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        if self.use_https:
+            connection = _KeepAliveHTTPSConnection(self, chost, timeout=self.timeout,
+                                                   context=self.context, **(x509 or {}))
+        else:
+            connection = _KeepAliveHTTPConnection(self, chost, timeout=self.timeout)
+        self._connection = host, connection
+        return connection
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        result = xmlrpclib.SafeTransport.single_request(self, host, handler, request_body, verbose)
+        # once per connection since reading the session is not free, and
+        # after a response since with TLS 1.3 the ticket follows the handshake
+        connection = self._connection[1]
+        if connection is not self._session_from:
+            self._session_from = connection
+            session = getattr(connection.sock, 'session', None)
+            if session is not None:
+                self.tls_session = session
+        return result
+
 class Session(xmlrpclib.ServerProxy):
     """A server proxy and session manager for communicating with xapi using
     the Xen-API.
@@ -126,19 +204,19 @@ class Session(xmlrpclib.ServerProxy):
     """
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
-                 allow_none=1, ignore_ssl=False):
+                 allow_none=1, ignore_ssl=False, timeout=None):
 
         # Fix for CA-172901 (+ Python 2.4 compatibility)
         # Fix for context=ctx ( < Python 2.7.9 compatibility)
+        ctx = None
         if not (sys.version_info[0] <= 2 and sys.version_info[1] <= 7 and sys.version_info[2] <= 9 ) \
                 and ignore_ssl:
-            import ssl
             ctx = ssl._create_unverified_context()
-            xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
-                                           verbose, allow_none, context=ctx)
-        else:
-            xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
-                                           verbose, allow_none)
+        if transport is None:
+            transport = KeepAliveTransport(use_https=uri.startswith('https'),
+                                           timeout=timeout, context=ctx)
+        xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
+                                       verbose, allow_none)
         self.transport = transport
         self._session = None
         self.last_login_method = None
@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Runs requests for the same device from concurrent jobs as one batch.
+
+Each job queues its request in Redis with the seconds it may take.
+Whichever job takes the device's leader key collects the queue for a
+window of seconds, runs it with one call and leaves each result for the
+job that asked for it. The leader key lasts as long as the whole batch
+may take, and the other jobs wait for as long as it is held.
+"""
+
+import json
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = '{}:queue:{}'
+LEADER_KEY = '{}:leader:{}'
+RESULT_KEY = '{}:result:{}'
+
+# seconds on top of the request timeouts for the Redis round trips
+GRACE = 5
+RESULT_TIMEOUT = 60
+
+
+def _hold(key, seconds):
+    """Sets the leader key to the time it is held until, for seconds."""
+    cache.set(key, time.time() + seconds, int(seconds) + 1)
+
+
+def _lead(prefix, device, window, run_batch):
+    time.sleep(window)
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    pipe.lrange(QUEUE_KEY.format(prefix, device), 0, -1)
+    pipe.delete(QUEUE_KEY.format(prefix, device))
+    items, _ = pipe.execute()
+
+    requests = [json.loads(item.decode('utf-8')) for item in items]
+    if not requests:
+        return
+    _hold(LEADER_KEY.format(prefix, device), sum(timeout for _, timeout, _ in requests) + GRACE)
+    logger.info('Running %d coalesced %s requests on %s', len(requests), prefix, device)
+    results = run_batch([request for _, _, request in requests])
+
+    for (request_id, _, _), result in zip(requests, results):
+        cache.set(RESULT_KEY.format(prefix, request_id), result, RESULT_TIMEOUT)
+
+
+def run(prefix, device, request, timeout, window, run_batch):
+    """Runs request on device together with the requests other jobs queue
+    for it within window seconds and returns its result.
+
+    request is JSON and takes up to timeout seconds. run_batch(requests)
+    returns a result for each request in order, which is cached so must
+    be JSON-serializable. Raises CommandError when no result arrived in time.
+    """
+    redis = get_redis_connection('default')
+    queue = QUEUE_KEY.format(prefix, device)
+    leader = LEADER_KEY.format(prefix, device)
+    request_id = uuid.uuid4().hex
+    # long enough to run after the batch of a leader that just started
+    span = window + timeout + GRACE
+
+    redis.rpush(queue, json.dumps([request_id, timeout, request]))
+    redis.expire(queue, span)
+    deadline = time.time() + span
+    while time.time() < deadline:
+        result = cache.get(RESULT_KEY.format(prefix, request_id))
+        if result is None:
+            if cache.add(leader, time.time() + span, span):
+                try:
+                    _lead(prefix, device, window, run_batch)
+                finally:
+                    cache.delete(leader)
+                result = cache.get(RESULT_KEY.format(prefix, request_id))
+            else:
+                held_until = cache.get(leader)
+                if held_until is not None and held_until + span > deadline:
+                    deadline = held_until + span
+                    redis.expire(queue, int(deadline - time.time()) + 1)
+
+        if result is not None:
+            cache.delete(RESULT_KEY.format(prefix, request_id))
+            return result
+        time.sleep(0.1)
+
+    raise CommandError('Timed out waiting for the coalesced {} requests on {}'.format(prefix, device))
@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""hpilo clients that reuse what they can between requests to an iLO.
+
+Each RIBCL request is a TLS connection of its own which the iLO closes
+after answering, and a new hpilo.Ilo first sends a bogus request to
+detect whether the iLO speaks RIBCL over HTTP or raw. get_ilo remembers
+the detected protocol and the TLS session of each iLO for the life of
+the worker process, so later requests skip the detection round trip and
+resume the TLS session with an abbreviated handshake.
+"""
+
+import logging
+import ssl
+import threading
+
+import hpilo
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_protocols = {}
+_contexts = {}
+
+
+class ResumingContext(object):
+    """Stands in for the ssl_context of hpilo.Ilo and resumes the TLS
+    session of the previous connection. Like hpilo without ssl_verify it
+    does not verify the iLO's self-signed certificate.
+    """
+
+    def __init__(self):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+        self.session = None
+        self.connections = 0
+        self.resumed = 0
+
+    def wrap_socket(self, sock, server_hostname=None):
+        tls = self.context.wrap_socket(sock, server_hostname=server_hostname, session=self.session)
+        self.connections += 1
+        if tls.session_reused:
+            self.resumed += 1
+        return _ResumableSocket(tls, self)
+
+
+class _ResumableSocket(object):
+    """Keeps the TLS session when hpilo shuts the connection down. With
+    TLS 1.3 the session ticket only arrives after the handshake.
+    """
+
+    def __init__(self, tls, context):
+        self.tls = tls
+        self.context = context
+
+    def __getattr__(self, name):
+        return getattr(self.tls, name)
+
+    def _keep_session(self):
+        if self.tls.session is not None:
+            self.context.session = self.tls.session
+
+    def shutdown(self, how):
+        self._keep_session()
+        self.tls.shutdown(how)
+
+    def close(self):
+        self._keep_session()
+        self.tls.close()
+
+
+def get_ilo(hostname, login, password, timeout=60, delayed=False):
+    """Returns an hpilo.Ilo for hostname sharing the protocol and TLS
+    session of the earlier ones.
+    """
+    with _lock:
+        context = _contexts.setdefault(hostname, ResumingContext())
+    return hpilo.Ilo(hostname,
+                     login=login,
+                     password=password,
+                     timeout=timeout,
+                     delayed=delayed,
+                     protocol=_protocols.get(hostname),
+                     ssl_context=context)
+
+
+def get_post_state(ilo):
+    """Reads the POST state of the server, e.g. InPost or FinishedPost.
+    python-hpilo 4.3 has no method for GET_POST_STATE, which iLO 4 and
+    newer answer with a POST_STATE tag.
+    """
+    if hasattr(ilo, 'get_post_state'):
+        return ilo.get_post_state()
+    return ilo._info_tag('SERVER_INFO', 'GET_POST_STATE', 'POST_STATE', process=lambda data: data['value'])
+
+
+def knows_protocol(hostname):
+    """Returns True when the next get_ilo for hostname skips protocol detection."""
+    return hostname in _protocols
+
+
+def remember(ilo):
+    """Keeps the protocol ilo detected for the next get_ilo."""
+    if isinstance(ilo.protocol, int):
+        _protocols[ilo.hostname] = ilo.protocol
+
+
+def forget(hostname):
+    """Drops what is remembered about hostname, e.g. after a communication
+    error in case the iLO was replaced or its firmware updated.
+    """
+    with _lock:
+        _protocols.pop(hostname, None)
+        _contexts.pop(hostname, None)
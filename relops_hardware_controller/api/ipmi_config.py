@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""The IPMI part of WORKER_CONFIG compiled into a per-host table.
+
+Each host with IPMI credentials or a parent BMC maps to an IpmiTarget
+holding its BMC, credentials, bridge args and the ipmitool argv of each
+ipmi_* action, so a lookup is a dict access. The table is validated
+when compiled and recompiled when WORKER_CONFIG changes.
+"""
+
+import collections
+import threading
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+IpmiTarget = collections.namedtuple('IpmiTarget', ['bmc', 'user', 'password', 'args', 'commands'])
+
+# ipmitool commands for hosts without a type remapping them
+DEFAULT_COMMANDS = {
+    'ipmi_list': ('sel', 'list', 'last', '15'),
+    'ipmi_status': ('chassis', 'power', 'status'),
+    'ipmi_reset': ('chassis', 'power', 'reset'),
+    'ipmi_cycle': ('chassis', 'power', 'cycle'),
+    'ipmi_off': ('chassis', 'power', 'off'),
+    'ipmi_on': ('chassis', 'power', 'on'),
+}
+
+_lock = threading.Lock()
+_table = None
+
+
+def _argv(value, where, errors):
+    if not isinstance(value, list) or not all(isinstance(arg, str) for arg in value):
+        errors.append('{} must be a list of strings'.format(where))
+        return ()
+    return tuple(value)
+
+
+def compile_ipmi_config(config):
+    """Returns a read only dict of short hostname to IpmiTarget.
+
+    Raises ImproperlyConfigured listing every bad entry.
+    """
+    config = config or {}
+    servers = config.get('servers', {})
+    types = config.get('types', {})
+    errors = []
+
+    compiled_types = {}
+    for hwtype, remap in types.items():
+        commands = dict(DEFAULT_COMMANDS)
+        for action, argv in remap.get('commands', {}).items():
+            commands[action] = _argv(argv, 'types.{}.commands.{}'.format(hwtype, action), errors)
+        compiled_types[hwtype] = (
+            _argv(remap.get('args', []), 'types.{}.args'.format(hwtype), errors),
+            {addr: _argv(argv, 'types.{}.map.{}'.format(hwtype, addr), errors)
+             for addr, argv in remap.get('map', {}).items()},
+            MappingProxyType(commands),
+        )
+
+    table = {}
+    for hostname, server in servers.items():
+        if 'parent' not in server and 'user' not in server:
+            continue  # not managed over IPMI
+
+        bmc = server.get('parent', hostname)
+        bmc_server = servers.get(bmc)
+        if bmc_server is None:
+            errors.append('servers.{}: parent {} is not in servers'.format(hostname, bmc))
+            continue
+        if 'user' not in bmc_server or 'password' not in bmc_server:
+            errors.append('servers.{}: no IPMI user and password'.format(bmc))
+            continue
+
+        hwtype = bmc_server.get('type')
+        if hwtype is None:
+            args, commands = (), MappingProxyType(DEFAULT_COMMANDS)
+            if 'parent' in server and server.get('addr') is not None:
+                errors.append('servers.{}: addr without a type on {}'.format(hostname, bmc))
+                continue
+        elif hwtype not in compiled_types:
+            errors.append('servers.{}: unknown type {}'.format(bmc, hwtype))
+            continue
+        else:
+            args, addresses, commands = compiled_types[hwtype]
+            addr = server.get('addr') if 'parent' in server else None
+            if addr is not None:
+                if addr not in addresses:
+                    errors.append('servers.{}: addr {} is not in types.{}.map'.format(hostname, addr, hwtype))
+                    continue
+                args += addresses[addr]
+
+        table[hostname] = IpmiTarget(bmc, bmc_server['user'], bmc_server['password'], args, commands)
+
+    if errors:
+        raise ImproperlyConfigured('Invalid IPMI WORKER_CONFIG: {}'.format('; '.join(errors)))
+    return MappingProxyType(table)
+
+
+def get_ipmi_table():
+    global _table
+    with _lock:
+        if _table is None:
+            _table = compile_ipmi_config(settings.WORKER_CONFIG)
+        return _table
+
+
+@receiver(setting_changed)
+def reset_ipmi_table(setting, **kwargs):
+    global _table
+    if setting == 'WORKER_CONFIG':
+        with _lock:
+            _table = None
+
+
+def get_ipmi_target(hostname):
+    """Returns the IpmiTarget for a short or fully qualified hostname.
+
+    Raises KeyError for hosts not managed over IPMI.
+    """
+    table = get_ipmi_table()
+    target = table.get(hostname.split('.')[0])
+    if target is None:
+        target = table[hostname]
+    return target
@@ -0,0 +1,647 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""IPMI v2.0 RMCP+ (lanplus) client.
+
+Covers the ipmitool commands the controller uses: chassis power
+status/on/off/reset/cycle and sel list, with ipmitool's -B/-b/-T/-t
+bridging for moonshot cartridges behind a chassis manager.
+
+Sessions use cipher suite 3 (RAKP-HMAC-SHA1, HMAC-SHA1-96, AES-CBC-128).
+https://www.intel.com/content/dam/www/public/us/en/documents/product-briefs/ipmi-second-gen-interface-spec-v2-rev1-1.pdf
+"""
+
+import atexit
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import (
+    Cipher,
+    algorithms,
+    modes,
+)
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+RMCP_PORT = 623
+# RMCP v1.0, no ack, IPMI class
+RMCP_HEADER = b'\x06\x00\xff\x07'
+AUTH_TYPE_RMCP_PLUS = 0x06
+
+PAYLOAD_IPMI = 0x00
+PAYLOAD_OPEN_SESSION_REQUEST = 0x10
+PAYLOAD_OPEN_SESSION_RESPONSE = 0x11
+PAYLOAD_RAKP1 = 0x12
+PAYLOAD_RAKP2 = 0x13
+PAYLOAD_RAKP3 = 0x14
+PAYLOAD_RAKP4 = 0x15
+PAYLOAD_ENCRYPTED = 0x80
+PAYLOAD_AUTHENTICATED = 0x40
+
+# auth, integrity and confidentiality payloads of cipher suite 3
+CIPHER_SUITE_3 = (b'\x00\x00\x00\x08\x01\x00\x00\x00'
+                  b'\x01\x00\x00\x08\x01\x00\x00\x00'
+                  b'\x02\x00\x00\x08\x01\x00\x00\x00')
+
+PRIVILEGE_LEVELS = {
+    'CALLBACK': 1,
+    'USER': 2,
+    'OPERATOR': 3,
+    'ADMINISTRATOR': 4,
+}
+
+BMC_ADDRESS = 0x20
+REMOTE_CONSOLE_ADDRESS = 0x81
+
+NETFN_CHASSIS = 0x00
+NETFN_APP = 0x06
+NETFN_STORAGE = 0x0a
+
+CMD_GET_CHASSIS_STATUS = 0x01
+CMD_CHASSIS_CONTROL = 0x02
+CMD_SEND_MESSAGE = 0x34
+CMD_SET_SESSION_PRIVILEGE = 0x3b
+CMD_CLOSE_SESSION = 0x3c
+CMD_GET_SEL_ENTRY = 0x43
+
+COMPLETION_INVALID_COMMAND = 0xc1
+COMPLETION_TIMEOUT = 0xc3
+COMPLETION_NOT_PRESENT = 0xcb
+
+# chassis control data byte and the ipmitool message for it
+CHASSIS_CONTROLS = {
+    'off': (0x00, 'Down/Off'),
+    'on': (0x01, 'Up/On'),
+    'cycle': (0x02, 'Cycle'),
+    'reset': (0x03, 'Reset'),
+}
+
+SENSOR_TYPES = {
+    0x01: 'Temperature',
+    0x02: 'Voltage',
+    0x04: 'Fan',
+    0x07: 'Processor',
+    0x08: 'Power Supply',
+    0x0c: 'Memory',
+    0x10: 'Event Logging Disabled',
+    0x12: 'System Event',
+    0x13: 'Critical Interrupt',
+    0x1d: 'System Boot Initiated',
+    0x1f: 'OS Boot',
+    0x20: 'OS Critical Stop',
+    0x23: 'Watchdog2',
+}
+
+# sensor specific event offsets for the sensor types the verifiers read
+SENSOR_EVENTS = {
+    0x12: ['System Reconfigured', 'OEM System boot event', 'Undetermined system hardware failure',
+           'Entry added to auxiliary log', 'PEF Action', 'Timestamp Clock Sync'],
+    0x1d: ['Initiated by power up', 'Initiated by hard reset', 'Initiated by warm reset',
+           'User requested PXE boot', 'Automatic boot to diagnostic', 'OS initiated hard reset',
+           'OS initiated warm reset', 'System Restart'],
+    0x1f: ['A: boot completed', 'C: boot completed', 'PXE boot completed', 'Diagnostic boot completed',
+           'CD-ROM boot completed', 'ROM boot completed', 'boot completed - device not specified'],
+}
+
+SelEntry = collections.namedtuple('SelEntry', ['record_id', 'timestamp', 'sensor_type', 'sensor_number',
+                                               'event_type', 'asserted', 'offset'])
+
+Response = collections.namedtuple('Response', ['netfn', 'seq', 'cmd', 'code', 'data'])
+
+
+class IpmiError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class IpmiAuthError(IpmiError):
+    """The BMC refused the session credentials."""
+
+
+class IpmiUnreachableError(IpmiError):
+    """The BMC did not answer the session setup."""
+
+
+def checksum(data):
+    return -sum(data) & 0xff
+
+
+def ipmb_message(rs_addr, netfn, rq_addr, seq, cmd, data=b''):
+    """Returns an IPMB request message (also the body of an IPMI LAN message)."""
+    header = bytes([rs_addr, netfn << 2])
+    body = bytes([rq_addr, (seq & 0x3f) << 2, cmd]) + bytes(data)
+    return header + bytes([checksum(header)]) + body + bytes([checksum(body)])
+
+
+def parse_response(message):
+    """Parses an IPMB or IPMI LAN response message."""
+    if len(message) < 8 or checksum(message[:3]) or checksum(message[3:]):
+        raise IpmiError('Malformed IPMI response')
+    return Response(message[1] >> 2, message[4] >> 2, message[5], message[6], bytes(message[7:-1]))
+
+
+def parse_bridge_args(args):
+    """Returns the bridge hops for ipmitool style -B/-b/-T/-t args.
+
+    e.g. ['-B 0', '-b 7', '-T 0x82', '-t 0x72'] (transit channel and
+    address then target channel and address) gives [(0, 0x82), (7, 0x72)].
+    """
+    options = {}
+    words = ' '.join(args).split()
+    for flag, value in zip(words[::2], words[1::2]):
+        if flag not in ('-B', '-b', '-T', '-t'):
+            raise IpmiError('Unsupported ipmitool option {}'.format(flag))
+        options[flag] = int(value, 0)
+
+    hops = []
+    if '-T' in options:
+        hops.append((options.get('-B', 0), options['-T']))
+    if '-t' in options:
+        hops.append((options.get('-b', 0), options['-t']))
+    return hops
+
+
+def bridge_request(hops, netfn, cmd, data=b'', seq=0):
+    """Wraps a request in one Send Message per bridge hop, innermost last."""
+    for index in reversed(range(len(hops))):
+        channel, address = hops[index]
+        requester = hops[index - 1][1] if index else BMC_ADDRESS
+        data = bytes([0x40 | channel]) + ipmb_message(address, netfn, requester, seq, cmd, data)
+        netfn, cmd = NETFN_APP, CMD_SEND_MESSAGE
+    return netfn, cmd, data
+
+
+def _aes(key, iv):
+    return Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+
+
+class Session:
+    """An authenticated and encrypted RMCP+ session with a BMC.
+
+    Use as a context manager to open and close the session, then call
+    power_status(), power(action) or sel_entries(). Commands go to the
+    bridged target when hops is set (see parse_bridge_args).
+    """
+
+    def __init__(self, host, username, password, privilege='OPERATOR', hops=None,
+                 port=None, timeout=2, retries=3):
+        self.host = host
+        self.username = username.encode('utf-8')
+        self.password = password.encode('utf-8')
+        self.privilege = PRIVILEGE_LEVELS[privilege]
+        self.hops = hops or []
+        self.address = (host, port or RMCP_PORT)
+        self.timeout = timeout
+        self.retries = retries
+
+        self.sock = None
+        self.console_session_id = 0
+        self.bmc_session_id = 0
+        self.session_seq = 0
+        self.rq_seq = 0
+        self.k1 = None
+        self.k2 = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _wrap(self, payload_type, payload):
+        if self.k1 is None:
+            header = struct.pack('<BBIIH', AUTH_TYPE_RMCP_PLUS, payload_type, 0, 0, len(payload))
+            return RMCP_HEADER + header + payload
+
+        iv = os.urandom(16)
+        pad_length = -(len(payload) + 1) % 16
+        plain = payload + bytes(range(1, pad_length + 1)) + bytes([pad_length])
+        encryptor = _aes(self.k2[:16], iv).encryptor()
+        payload = iv + encryptor.update(plain) + encryptor.finalize()
+
+        self.session_seq += 1
+        packet = struct.pack('<BBIIH', AUTH_TYPE_RMCP_PLUS, payload_type | PAYLOAD_ENCRYPTED | PAYLOAD_AUTHENTICATED,
+                             self.bmc_session_id, self.session_seq, len(payload)) + payload
+        pad_length = -(len(packet) + 2) % 4
+        packet += b'\xff' * pad_length + bytes([pad_length, 0x07])
+        return RMCP_HEADER + packet + hmac.new(self.k1, packet, hashlib.sha1).digest()[:12]
+
+    def _unwrap(self, packet):
+        """Returns (payload type, payload) or None for packets not for this session."""
+        if len(packet) < 16 or packet[:4] != RMCP_HEADER or packet[4] != AUTH_TYPE_RMCP_PLUS:
+            return None
+        payload_type = packet[5]
+        session_id, _, length = struct.unpack('<IIH', packet[6:16])
+        payload = packet[16:16 + length]
+        if len(payload) != length:
+            return None
+
+        if self.k1 is not None:
+            if session_id != self.console_session_id or not payload_type & PAYLOAD_AUTHENTICATED:
+                return None
+            expected = hmac.new(self.k1, packet[4:-12], hashlib.sha1).digest()[:12]
+            if not hmac.compare_digest(expected, packet[-12:]):
+                logger.warn('Dropping IPMI packet from %s with a bad integrity check', self.host)
+                return None
+        if payload_type & PAYLOAD_ENCRYPTED:
+            if len(payload) < 32 or len(payload) % 16:
+                return None
+            decryptor = _aes(self.k2[:16], payload[:16]).decryptor()
+            plain = decryptor.update(payload[16:]) + decryptor.finalize()
+            payload = plain[:-1 - plain[-1]]
+        return payload_type & 0x3f, payload
+
+    def _exchange(self, payload_type, payload, accept):
+        """Sends a payload and returns the first reply accept() returns a
+        value for, resending on timeout.
+        """
+        for attempt in range(self.retries):
+            self.sock.sendto(self._wrap(payload_type, payload), self.address)
+            deadline = time.time() + self.timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.sock.settimeout(remaining)
+                try:
+                    packet, _ = self.sock.recvfrom(1024)
+                except socket.timeout:
+                    break
+                reply = self._unwrap(packet)
+                if reply is None:
+                    continue
+                result = accept(*reply)
+                if result is not None:
+                    return result
+            logger.debug('IPMI timeout from %s, attempt %d', self.host, attempt + 1)
+        raise IpmiError('No response from BMC {}'.format(self.host))
+
+    def _session_setup(self, payload_type, payload, reply_type, tag):
+        def accept(reply_payload_type, reply):
+            if reply_payload_type == reply_type and len(reply) >= 8 and reply[0] == tag:
+                if reply[1]:
+                    raise IpmiAuthError('BMC {} refused session setup with RMCP+ status 0x{:02x}'.format(
+                        self.host, reply[1]))
+                return reply
+        return self._exchange(payload_type, payload, accept)
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._open()
+        except Exception as e:
+            self.sock.close()
+            self.sock = None
+            if type(e) is IpmiError and e.code is None:
+                raise IpmiUnreachableError(str(e)) from e
+            raise
+
+    def _open(self):
+        tag = os.urandom(1)[0]
+        self.console_session_id = struct.unpack('<I', os.urandom(4))[0] | 1
+        console_id = struct.pack('<I', self.console_session_id)
+
+        reply = self._session_setup(
+            PAYLOAD_OPEN_SESSION_REQUEST,
+            bytes([tag, self.privilege, 0, 0]) + console_id + CIPHER_SUITE_3,
+            PAYLOAD_OPEN_SESSION_RESPONSE, tag)
+        bmc_id = reply[8:12]
+        self.bmc_session_id = struct.unpack('<I', bmc_id)[0]
+
+        kuid = self.password.ljust(20, b'\x00')[:20]
+        random_console = os.urandom(16)
+        role = bytes([self.privilege, len(self.username)]) + self.username
+        reply = self._session_setup(
+            PAYLOAD_RAKP1,
+            bytes([tag, 0, 0, 0]) + bmc_id + random_console + bytes([self.privilege, 0, 0]) + role[1:],
+            PAYLOAD_RAKP2, tag)
+        random_bmc, guid, auth_code = reply[8:24], reply[24:40], reply[40:60]
+        expected = hmac.new(kuid, console_id + bmc_id + random_console + random_bmc + guid + role,
+                            hashlib.sha1).digest()
+        if not hmac.compare_digest(expected, auth_code):
+            raise IpmiAuthError('BMC {} failed RAKP2 authentication, wrong password?'.format(self.host))
+
+        sik = hmac.new(kuid, random_console + random_bmc + role, hashlib.sha1).digest()
+        reply = self._session_setup(
+            PAYLOAD_RAKP3,
+            bytes([tag, 0, 0, 0]) + bmc_id + hmac.new(kuid, random_bmc + console_id + role, hashlib.sha1).digest(),
+            PAYLOAD_RAKP4, tag)
+        expected = hmac.new(sik, random_console + bmc_id + guid, hashlib.sha1).digest()[:12]
+        if not hmac.compare_digest(expected, reply[8:20]):
+            raise IpmiAuthError('BMC {} failed RAKP4 integrity check'.format(self.host))
+
+        self.k1 = hmac.new(sik, b'\x01' * 20, hashlib.sha1).digest()
+        self.k2 = hmac.new(sik, b'\x02' * 20, hashlib.sha1).digest()
+        self.session_seq = 0
+
+        self._raw(NETFN_APP, CMD_SET_SESSION_PRIVILEGE, bytes([self.privilege]), hops=[])
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            if self.k1 is not None:
+                self._raw(NETFN_APP, CMD_CLOSE_SESSION, struct.pack('<I', self.bmc_session_id), hops=[])
+        except IpmiError as e:
+            logger.info('Could not close IPMI session with %s: %s', self.host, e)
+        finally:
+            self.sock.close()
+            self.sock = None
+            self.k1 = self.k2 = None
+
+    def _raw(self, netfn, cmd, data=b'', hops=None):
+        hops = self.hops if hops is None else hops
+        self.rq_seq = (self.rq_seq + 1) % 64
+        seq = self.rq_seq
+        outer_netfn, outer_cmd, outer_data = bridge_request(hops, netfn, cmd, data, seq)
+        message = ipmb_message(BMC_ADDRESS, outer_netfn, REMOTE_CONSOLE_ADDRESS, seq, outer_cmd, outer_data)
+        acknowledged = []
+
+        def accept(payload_type, payload):
+            if payload_type != PAYLOAD_IPMI:
+                return None
+            response = parse_response(payload)
+            if response.seq != seq:
+                return None
+            # a bridged response comes back inside a Send Message response per hop,
+            # a Send Message response without data only acknowledges the request
+            while response.cmd == CMD_SEND_MESSAGE and response.cmd != cmd:
+                if response.code:
+                    return response
+                if not response.data:
+                    acknowledged.append(response)
+                    return None
+                response = parse_response(response.data)
+            if response.netfn == netfn + 1 and response.cmd == cmd:
+                return response
+            return None
+
+        try:
+            response = self._exchange(PAYLOAD_IPMI, message, accept)
+        except IpmiError:
+            if not acknowledged:
+                raise
+            # the BMC is fine, the bridged target did not answer
+            raise IpmiError('No response from 0x{:02x} bridged by BMC {}'.format(hops[-1][1], self.host),
+                            COMPLETION_TIMEOUT)
+        if response.code:
+            raise IpmiError('BMC {} returned completion code 0x{:02x} for netfn 0x{:02x} cmd 0x{:02x}'.format(
+                self.host, response.code, netfn, cmd), response.code)
+        return response.data
+
+    def raw(self, netfn, cmd, data=b''):
+        """Sends a request to the (bridged) target and returns the response data."""
+        return self._raw(netfn, cmd, data)
+
+    def power_status(self):
+        """Returns 'on' or 'off'."""
+        data = self.raw(NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS)
+        return 'on' if data[0] & 0x01 else 'off'
+
+    def power(self, action):
+        """Runs chassis power off, on, cycle or reset."""
+        self.raw(NETFN_CHASSIS, CMD_CHASSIS_CONTROL, bytes([CHASSIS_CONTROLS[action][0]]))
+
+    def sel_entries(self, last=None, after=None):
+        """Returns the system event log entries, only the newest last if set
+        and only those following record id after if set. Reads the whole
+        SEL when record after is gone, e.g. after the SEL was cleared.
+        """
+        entries = collections.deque(maxlen=last)
+        record_id = 0x0000
+        if after is not None:
+            try:
+                data = self.raw(NETFN_STORAGE, CMD_GET_SEL_ENTRY, struct.pack('<HHBB', 0, after, 0, 0xff))
+                record_id = struct.unpack('<H', data[:2])[0]
+            except IpmiError as e:
+                if e.code != COMPLETION_NOT_PRESENT:
+                    raise
+        while record_id != 0xffff:
+            try:
+                data = self.raw(NETFN_STORAGE, CMD_GET_SEL_ENTRY, struct.pack('<HHBB', 0, record_id, 0, 0xff))
+            except IpmiError as e:
+                if e.code == COMPLETION_NOT_PRESENT and record_id == 0x0000:
+                    break  # empty SEL
+                raise
+            next_id, record = struct.unpack('<H', data[:2])[0], data[2:]
+            if len(record) < 16 or next_id == record_id:
+                break
+            entries.append(parse_sel_record(record))
+            record_id = next_id
+        return list(entries)
+
+
+def parse_sel_record(record):
+    record_id, record_type, timestamp = struct.unpack('<HBI', record[:7])
+    if record_type != 0x02:
+        return SelEntry(record_id, timestamp if record_type < 0xe0 else None, None, None, record_type, True, None)
+    return SelEntry(record_id, timestamp, record[10], record[11], record[12] & 0x7f,
+                    not record[12] & 0x80, record[13] & 0x0f)
+
+
+def format_sel_entry(entry):
+    """Formats a SelEntry like a line of `ipmitool sel list`."""
+    if entry.timestamp is None:
+        date, clock = '', ''
+    elif entry.timestamp <= 0x20000000:
+        date, clock = 'Pre-Init', '{:010d}'.format(entry.timestamp)
+    else:
+        moment = datetime.utcfromtimestamp(entry.timestamp)
+        date, clock = moment.strftime('%m/%d/%Y'), moment.strftime('%H:%M:%S')
+
+    if entry.sensor_type is None:
+        return '{:4x} | {} | {} | OEM record {:02x}'.format(entry.record_id, date, clock, entry.event_type)
+
+    sensor = '{} #0x{:02x}'.format(
+        SENSOR_TYPES.get(entry.sensor_type, 'Sensor type 0x{:02x}'.format(entry.sensor_type)), entry.sensor_number)
+    events = SENSOR_EVENTS.get(entry.sensor_type, [])
+    if entry.event_type == 0x6f and entry.offset < len(events):
+        event = events[entry.offset]
+    else:
+        event = 'Event type 0x{:02x} offset 0x{:x}'.format(entry.event_type, entry.offset)
+    return '{:4x} | {} | {} | {} | {} | {}'.format(
+        entry.record_id, date, clock, sensor, event, 'Asserted' if entry.asserted else 'Deasserted')
+
+
+class SessionPool:
+    """Keeps an authenticated session open per BMC for reuse.
+
+    Moonshot cartridges all bridge through their chassis BMC so a rack
+    reboot sets up one session instead of one per cartridge. Requests
+    to a BMC are serialised on its session, different BMCs run in
+    parallel. Sessions idle for more than max_idle seconds are reopened
+    since BMCs expire inactive sessions (usually after 60s).
+    """
+
+    def __init__(self, timeout=2, retries=3):
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.sessions = {}
+
+    def _lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def _open(self, host, username, password, privilege):
+        session = Session(host, username, password, privilege=privilege,
+                          timeout=self.timeout, retries=self.retries)
+        session.open()
+        return session
+
+    def run(self, host, username, password, privilege, hops, action, max_idle):
+        """Calls action(session) on the pooled session for host and returns its result.
+
+        When a reused session gets no answer the action runs again on a new
+        session, unless action.repeatable is False. Then it raises an
+        IpmiError with COMPLETION_TIMEOUT since the request may have run.
+        """
+        key = (host, RMCP_PORT, username, privilege)
+        with self._lock(key):
+            session, last_used = self.sessions.pop(key, (None, 0))
+            if session is not None and (session.password != password.encode('utf-8') or
+                                        time.time() - last_used > max_idle):
+                session.close()
+                session = None
+
+            reused = session is not None
+            if session is None:
+                session = self._open(host, username, password, privilege)
+            else:
+                logger.debug('Reusing IPMI session with %s', host)
+
+            session.hops = hops
+            try:
+                result = action(session)
+            except IpmiError as e:
+                if e.code is not None:
+                    # the BMC answered so the session is still good
+                    self.sessions[key] = (session, time.time())
+                    raise
+                session.close()
+                if not reused:
+                    raise
+                if not getattr(action, 'repeatable', True):
+                    # e.g. a power action, which may have reached the BMC
+                    raise IpmiError(str(e), COMPLETION_TIMEOUT) from e
+                # the BMC dropped the session, e.g. after a BMC reset
+                logger.info('IPMI session with %s went stale, opening a new one', host)
+                session = self._open(host, username, password, privilege)
+                session.hops = hops
+                result = action(session)
+
+            self.sessions[key] = (session, time.time())
+            return result
+
+    def close_all(self):
+        with self.lock:
+            keys = list(self.sessions)
+        for key in keys:
+            with self._lock(key):
+                session, _ = self.sessions.pop(key, (None, 0))
+                if session is not None:
+                    session.close()
+
+
+pool = SessionPool()
+atexit.register(pool.close_all)
+
+
+def command_action(command):
+    """Returns a function running the ipmitool command (e.g. ['chassis',
+    'power', 'status']) on a Session and returning ipmitool's output.
+    """
+    if isinstance(command, str):
+        command = command.split()
+
+    if command == ['chassis', 'power', 'status']:
+        def action(session):
+            return 'Chassis Power is {}\n'.format(session.power_status())
+    elif command[:2] == ['chassis', 'power'] and len(command) == 3 and command[2] in CHASSIS_CONTROLS:
+        def action(session):
+            session.power(command[2])
+            return 'Chassis Power Control: {}\n'.format(CHASSIS_CONTROLS[command[2]][1])
+        action.repeatable = False
+    elif command == ['sel', 'list'] or (command[:3] == ['sel', 'list', 'last'] and len(command) == 4):
+        last = int(command[3]) if len(command) == 4 else None
+
+        def action(session):
+            return ''.join(format_sel_entry(entry) + '\n' for entry in session.sel_entries(last))
+    else:
+        raise IpmiError('Unsupported IPMI command {}'.format(' '.join(command)), COMPLETION_INVALID_COMMAND)
+    return action
+
+
+def _with_session(host, username, password, privilege, hops, action):
+    if settings.IPMI_SESSION_IDLE > 0:
+        return pool.run(host, username, password, privilege, hops, action, settings.IPMI_SESSION_IDLE)
+
+    with Session(host, username, password, privilege=privilege, hops=hops) as session:
+        return action(session)
+
+
+def run(host, username, password, bridge_args, command, privilege='OPERATOR'):
+    """Runs an ipmitool command over RMCP+ and returns output formatted
+    like ipmitool's.
+    """
+    return run_action(host, username, password, bridge_args, command_action(command), privilege)
+
+
+def run_action(host, username, password, bridge_args, action, privilege='OPERATOR'):
+    """Calls action(session) on a session with host bridged by
+    bridge_args and returns its result, e.g. to read the power state and
+    act on it without opening a second session.
+    """
+    return _with_session(host, username, password, privilege, parse_bridge_args(bridge_args), action)
+
+
+def run_batch(host, username, password, requests, privilege='OPERATOR'):
+    """Runs a list of (bridge_args, command) over one session with host,
+    e.g. one command per moonshot cartridge behind a chassis BMC.
+
+    Returns the output or the IpmiError for each request in order.
+    """
+    prepared = []
+    for bridge_args, command in requests:
+        try:
+            prepared.append((parse_bridge_args(bridge_args), command_action(command)))
+        except (IpmiError, ValueError) as e:
+            prepared.append(e)
+
+    results = []
+
+    def action(session):
+        # run again on a new session, carry on after the answered requests
+        answered = len(results)
+        for request in prepared[answered:]:
+            if isinstance(request, Exception):
+                results.append(request)
+                continue
+            session.hops, node_action = request
+            try:
+                results.append(node_action(session))
+            except IpmiError as e:
+                if e.code is None and len(results) == answered:
+                    if not getattr(node_action, 'repeatable', True):
+                        # the pool must not send a power action again
+                        results.append(IpmiError(str(e), COMPLETION_TIMEOUT))
+                    raise  # let the pool retry a stale session
+                results.append(e)
+        return results
+
+    return _with_session(host, username, password, privilege, [], action)
@@ -1,16 +1,32 @@
 
 import logging
+import re
 import time
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 import hpilo
 
+from relops_hardware_controller.api import (
+    ilo as ilo_client,
+    power_timer,
+)
 from relops_hardware_controller.api.validators import validate_host
 
 
 logger = logging.getLogger(__name__)
 
+# MESSAGEs of a failed RESET_SERVER, e.g. without the reset privilege
+RESET_ERROR_RE = re.compile(r'RESET_SERVER|powered off|power is off', re.IGNORECASE)
+
+
+def reset_failed(error):
+    """Returns True when param error, raised for a batch reading the power
+    status then resetting the server, is the reset's. The status read needs
+    no privilege beyond the login.
+    """
+    return isinstance(error, hpilo.IloPermissionError) or RESET_ERROR_RE.search(str(error)) is not None
+
 
 class Command(BaseCommand):
     help = 'Reboots a server using HP\'s iLO interface.'
@@ -54,6 +70,15 @@ class Command(BaseCommand):
             help='Wait N seconds before turning the power back on for hard powercycles.',
         )
 
+    def power_on(self, hostname, login=None, password=None, timeout=60):
+        """Turns the server back on for a power_timer entry, with the
+        ILO_USERNAME and ILO_PASSWORD unless it has credentials of its own.
+        """
+        validate_host(hostname)
+        ilo = ilo_client.get_ilo(hostname, login or settings.ILO_USERNAME, password or settings.ILO_PASSWORD, timeout)
+        ilo.set_host_power(host_power=True)
+        ilo_client.remember(ilo)
+
     def handle(self, hostname, *args, **options):
         validate_host(hostname)
 
@@ -62,25 +87,62 @@ class Command(BaseCommand):
         username = options.get('login', None) or settings.ILO_USERNAME
         password = options.get('password', None) or settings.ILO_PASSWORD
 
-        ilo = hpilo.Ilo(hostname,
-                        login=username,
-                        password=password,
-                        timeout=options['timeout'])
-
-        power_status = ilo.get_host_power_status()
-        logger.debug("Got power status %s for ilo server %s.", power_status, hostname)
+        # one request for the power status and the reset, and no protocol
+        # detection once it is known, instead of a request for each
+        round_trips = 1 if ilo_client.knows_protocol(hostname) else 2
+        unbatched = 3
+        ilo = ilo_client.get_ilo(hostname, username, password, options['timeout'], delayed=True)
+        ilo.get_host_power_status()
+        ilo.reset_server()
 
         try:
-            ilo.reset_server()
+            power_status = ilo.call_delayed()[0]
+            logger.debug("Got power status %s for ilo server %s.", power_status, hostname)
             logger.debug("Soft reset of ilo server %s complete.", hostname)
+        except (hpilo.IloCommunicationError, hpilo.IloLoginFailed) as error:
+            # nothing got through
+            ilo_client.forget(hostname)
+            raise error
         except Exception as error:
-            logger.debug("clean powercycle of ilo server %s failed with error: %s", hostname, error)
-            ilo.set_host_power(host_power=False)
-            logger.debug("hard shutdown of ilo sever %s complete.", hostname)
-
-            logger.debug("Power is off, waiting %d seconds before turning it back on.", options['delay'])
-            time.sleep(options['delay'])
-
-            ilo.set_host_power(host_power=True)
-
-        logger.info("Powercycle of %s completed.", hostname)
+            # the iLO runs every command of the batch and hpilo raises on the
+            # first failed one, so only resend a reset that failed itself
+            logger.debug("Power status and reset of ilo server %s failed with error: %s", hostname, error)
+            ilo.delayed = False
+            round_trips += 1
+            if not reset_failed(error):
+                power_status = ilo.get_host_power_status()
+                logger.debug("Got power status %s for ilo server %s.", power_status, hostname)
+            else:
+                try:
+                    ilo.reset_server()
+                except Exception as error:
+                    round_trips += 2
+                    unbatched += 2
+                    if not self.hard_cycle(ilo, hostname, error, **options):
+                        return
+        ilo_client.remember(ilo)
+
+        logger.info("Powercycle of %s completed in %d iLO round trips, %d with a request each.",
+                    hostname, round_trips, unbatched)
+
+    def hard_cycle(self, ilo, hostname, error, **options):
+        """Turns the power off and on again. Returns False when the
+        power-on got scheduled for a delay over POWER_ON_INLINE_DELAY.
+        """
+        logger.debug("clean powercycle of ilo server %s failed with error: %s", hostname, error)
+        ilo.set_host_power(host_power=False)
+        logger.debug("hard shutdown of ilo sever %s complete.", hostname)
+
+        if options['delay'] > settings.POWER_ON_INLINE_DELAY:
+            # only explicit credentials, the settings stay out of Redis
+            credentials = {name: options[name] for name in ('login', 'password') if options.get(name)}
+            power_timer.schedule_on('ilo_reboot', hostname, options['delay'],
+                                    timeout=options['timeout'], **credentials)
+            logger.info("Power of %s is off, power on scheduled in %d seconds.", hostname, options['delay'])
+            return False
+
+        logger.debug("Power is off, waiting %d seconds before turning it back on.", options['delay'])
+        time.sleep(options['delay'])
+
+        ilo.set_host_power(host_power=True)
+        return True
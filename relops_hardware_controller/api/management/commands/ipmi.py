@@ -1,12 +1,379 @@
+import collections
 import functools
-import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.management import (
     call_command,
     load_command_class,
 )
-from django.core.management.base import BaseCommand
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+
+from relops_hardware_controller.api import (
+    coalescer,
+    ipmilan,
+    sel_cache,
+)
+from relops_hardware_controller.api.ipmi_config import (
+    get_ipmi_table,
+    get_ipmi_target,
+)
+from relops_hardware_controller.api.management.commands.ipmitool import (
+    POWER_RE,
+    IpmiCommandError,
+    IpmiResult,
+)
+from relops_hardware_controller.api.validators import validate_host
+
+
+logger = logging.getLogger(__name__)
+
+# power actions for nodes behind a chassis BMC that the native client
+# batches with other requests for the same chassis
+COALESCED_COMMANDS = ['ipmi_on', 'ipmi_off', 'ipmi_reset', 'ipmi_cycle']
+# messages a coalesced action may take, a session setup and the command
+COALESCE_NODE_MESSAGES = 5
+
+# completion codes for commands the BMC or bridged node does not support
+UNSUPPORTED_CODES = [0xc1, 0xc2, 0xc9, 0xcc, 0xd5]
+
+# power actions that read chassis power status first and pick the
+# ipmi_* action for it, over one session with the native client
+SMART_COMMANDS = ['ipmi_ensure_on', 'ipmi_smart_reboot']
+
+
+def lookup(hostname, command):
+    """Resolves hostname's BMC and the ipmitool arguments for command.
+
+    Returns (bmc_hostname, user, password, bridge_args, command_args).
+    """
+    target = get_ipmi_target(hostname)
+    command_args = target.commands.get(command)
+    if command_args is None:
+        command_args = tuple(command.split())
+    return target.bmc, target.user, target.password, list(target.args), list(command_args)
+
+
+def native_error(error, bmc, command):
+    """Returns the IpmiCommandError for an ipmilan.IpmiError or None for
+    a timeout, after which the command may still have run.
+    """
+    if isinstance(error, ipmilan.IpmiAuthError) or error.code == 0xd4:  # insufficient privilege
+        status = 'auth_error'
+    elif isinstance(error, ipmilan.IpmiUnreachableError):
+        status = 'unreachable'
+    elif error.code in UNSUPPORTED_CODES:
+        status = 'unsupported'
+    elif error.code in (None, ipmilan.COMPLETION_TIMEOUT):
+        logger.warn('ipmi %s on %s timed out, checking the host anyway: %s', ' '.join(command), bmc, error)
+        return None
+    else:
+        status = 'unknown'
+    return IpmiCommandError(IpmiResult(status, None, error.code, str(error)))
+
+
+def run(bmc, user, password, args, command):
+    """Runs a looked up command with the IPMI_CLIENT.
+
+    Raises IpmiCommandError when the BMC refused the command.
+    """
+    if settings.IPMI_CLIENT == 'native':
+        validate_host(bmc)
+        try:
+            return ipmilan.run(bmc, user, password, args, command)
+        except ipmilan.IpmiError as e:
+            error = native_error(e, bmc, command)
+            if error is not None:
+                raise error
+            return None
+
+    run_cmd = functools.partial(
+        call_command,
+        load_command_class('relops_hardware_controller.api', 'ipmitool'),
+        '-H', bmc,
+        '-U', user,
+        '-P', password,
+        *args)
+
+    return run_cmd(*command)
+
+
+def choose_action(command, power):
+    """Returns the ipmi_* action smart command should run when the power
+    state read first is power ('on', 'off' or None), None for nothing to do.
+    """
+    if command == 'ipmi_ensure_on':
+        return None if power == 'on' else 'ipmi_on'
+    # reset and cycle do nothing for a node that is off
+    return 'ipmi_on' if power == 'off' else 'ipmi_cycle'
+
+
+def _unsupported(error):
+    if isinstance(error, IpmiCommandError):
+        return error.status == 'unsupported'
+    return isinstance(error, ipmilan.IpmiError) and error.code in UNSUPPORTED_CODES
+
+
+def smart_power(command, run_command):
+    """Runs smart command with run_command(ipmi_name), which returns the
+    ipmitool output of one ipmi_* command.
+
+    Returns output with the power state before, the action's output and
+    the power state after.
+    """
+    def power_state():
+        match = POWER_RE.search(run_command('ipmi_status') or '')
+        return match.group(1) if match else None
+
+    before = power_state()
+    action = choose_action(command, before)
+    lines = ['Chassis Power was {}'.format(before or 'unknown')]
+    if action is None:
+        after = before
+    else:
+        try:
+            output = run_command(action)
+        except Exception as e:
+            # some cartridges only do a warm reset
+            if action != 'ipmi_cycle' or not _unsupported(e):
+                raise
+            logger.info('%s refused %s, trying ipmi_reset', command, action)
+            action = 'ipmi_reset'
+            output = run_command(action)
+        lines.append(' '.join((output or '{} sent'.format(action)).split()))
+        after = power_state()
+    lines.append('Chassis Power is {}'.format(after or 'unknown'))
+    return '\n'.join(lines) + '\n'
+
+
+def smart(hostname, command):
+    """Runs ipmi_ensure_on or ipmi_smart_reboot on hostname.
+
+    The native client reads the power state, acts on it and reads it
+    again over one session. ipmitool needs a process per command.
+    """
+    target = get_ipmi_target(hostname)
+    if settings.IPMI_CLIENT != 'native':
+        return smart_power(command, lambda name: run(target.bmc, target.user, target.password,
+                                                     list(target.args), list(target.commands[name])))
+
+    validate_host(target.bmc)
+
+    def action(session):
+        sent = []
+
+        def run_command(name):
+            try:
+                output = ipmilan.command_action(list(target.commands[name]))(session)
+            except ipmilan.IpmiError as e:
+                if e.code is None and sent:
+                    # keep the pool from repeating a power action that may have run
+                    raise ipmilan.IpmiError(str(e), ipmilan.COMPLETION_TIMEOUT) from e
+                raise
+            sent.append(name)
+            return output
+
+        return smart_power(command, run_command)
+
+    try:
+        return ipmilan.run_action(target.bmc, target.user, target.password, list(target.args), action)
+    except ipmilan.IpmiError as e:
+        error = native_error(e, target.bmc, [command])
+        if error is not None:
+            raise error
+        return None
+
+
+def _run_concurrently(calls, results, max_workers=None):
+    """Runs (nodes, function, args) calls in up to max_workers threads.
+    The exception of a failed call becomes the result of each of its
+    nodes, which are tuples starting with the index into results.
+    """
+    if not calls:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(calls), max_workers or len(calls))) as executor:
+        futures = [(nodes, executor.submit(function, *args)) for nodes, function, args in calls]
+        for nodes, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception(e)
+                for node in nodes:
+                    results[node[0]] = e
+
+
+def batch(requests, max_workers=None):
+    """Runs a list of (hostname, command) grouped by BMC.
+
+    The native client sends the bridged commands for every node behind a
+    BMC (e.g. the cartridges of a moonshot chassis) over one session.
+    Each BMC gets its commands one at a time. Up to max_workers BMCs and
+    SMART_COMMANDS run concurrently. Returns the output or exception for
+    each request in order.
+    """
+    results = [None] * len(requests)
+    groups = collections.OrderedDict()
+    smart_requests = []
+    for index, (hostname, command) in enumerate(requests):
+        if command in SMART_COMMANDS:
+            smart_requests.append((index, hostname, command))
+            continue
+        try:
+            bmc, user, password, args, command = lookup(hostname, command)
+        except KeyError as e:
+            results[index] = CommandError('No IPMI config for {}: {}'.format(hostname, e))
+            continue
+        groups.setdefault((bmc, user, password), []).append((index, args, command))
+
+    def run_group(bmc, user, password, nodes):
+        if settings.IPMI_CLIENT == 'native':
+            validate_host(bmc)
+            outputs = ipmilan.run_batch(bmc, user, password, [(args, command) for _, args, command in nodes])
+            outputs = [native_error(output, bmc, command) if isinstance(output, ipmilan.IpmiError) else output
+                       for output, (_, _, command) in zip(outputs, nodes)]
+        else:
+            outputs = []
+            for _, args, command in nodes:
+                try:
+                    outputs.append(run(bmc, user, password, args, command))
+                except Exception as e:
+                    outputs.append(e)
+        for (index, _, _), output in zip(nodes, outputs):
+            results[index] = output
+
+    def run_smart(index, hostname, command):
+        try:
+            results[index] = smart(hostname, command)
+        except KeyError as e:
+            results[index] = CommandError('No IPMI config for {}: {}'.format(hostname, e))
+
+    calls = [(nodes, run_group, key + (nodes,)) for key, nodes in groups.items()]
+    calls += [([request], run_smart, request) for request in smart_requests]
+    _run_concurrently(calls, results, max_workers)
+    return results
+
+
+def refresh_sel(hostnames):
+    """Fetches the SEL entries following each host's cursor into the
+    sel_cache.
+
+    Hosts are grouped by BMC so the native client refreshes a whole
+    chassis over one session. The ipmitool client reads ipmi_list and
+    keeps the lines after the cursor. Returns the new `sel list` lines or
+    the exception for each hostname in order.
+    """
+    results = [None] * len(hostnames)
+    groups = collections.OrderedDict()
+    for index, (hostname, cursor) in enumerate(zip(hostnames, sel_cache.get_cursors(hostnames))):
+        try:
+            target = get_ipmi_target(hostname)
+        except KeyError as e:
+            results[index] = CommandError('No IPMI config for {}: {}'.format(hostname, e))
+            continue
+        groups.setdefault((target.bmc, target.user, target.password), []).append((index, target, cursor))
+
+    def fetch_group(bmc, user, password, nodes):
+        if settings.IPMI_CLIENT == 'native':
+            validate_host(bmc)
+
+            def action(session):
+                outputs = []
+                for _, target, cursor in nodes:
+                    try:
+                        session.hops = ipmilan.parse_bridge_args(list(target.args))
+                        entries = session.sel_entries(last=settings.IPMI_SEL_RING, after=cursor)
+                        outputs.append([ipmilan.format_sel_entry(entry) for entry in entries])
+                    except ipmilan.IpmiError as e:
+                        if e.code is None and not outputs:
+                            raise  # let the pool retry a stale session
+                        outputs.append(e)
+                return outputs
+
+            try:
+                outputs = ipmilan.run_action(bmc, user, password, [], action)
+            except ipmilan.IpmiError as e:
+                outputs = [e] * len(nodes)
+            outputs = [native_error(output, bmc, ['sel', 'list']) if isinstance(output, ipmilan.IpmiError)
+                       else output for output in outputs]
+        else:
+            outputs = []
+            for _, target, cursor in nodes:
+                try:
+                    output = run(bmc, user, password, list(target.args), list(target.commands['ipmi_list']))
+                    outputs.append(sel_cache.new_lines((output or '').splitlines(), cursor))
+                except Exception as e:
+                    outputs.append(e)
+
+        for (index, _, _), output in zip(nodes, outputs):
+            if isinstance(output, list):
+                sel_cache.store(hostnames[index], output)
+            # None is a timeout, the cache stays as it is
+            results[index] = [] if output is None else output
+
+    _run_concurrently([(nodes, fetch_group, key + (nodes,)) for key, nodes in groups.items()], results)
+    return results
+
+
+def sel_list(hostnames, cached=False):
+    """Returns the `sel list` output of each hostname, or the exception,
+    from the sel_cache after fetching the new entries unless cached.
+    """
+    fetched = refresh_sel(hostnames) if not cached else [[]] * len(hostnames)
+    results = []
+    for hostname, result in zip(hostnames, fetched):
+        if isinstance(result, Exception):
+            results.append(result)
+            continue
+        try:
+            argv = get_ipmi_target(hostname).commands['ipmi_list']
+        except KeyError as e:
+            results.append(CommandError('No IPMI config for {}: {}'.format(hostname, e)))
+            continue
+        # as many entries as ipmi_list would show
+        last = int(argv[3]) if tuple(argv[:3]) == ('sel', 'list', 'last') and len(argv) == 4 else None
+        results.append(''.join(line + '\n' for line in sel_cache.cached(hostname, last)))
+    return results
+
+
+def chassis_hostnames(hostname):
+    """Returns the hostnames managed through the BMC of hostname."""
+    bmc = get_ipmi_target(hostname).bmc
+    return sorted(name for name, target in get_ipmi_table().items() if target.bmc == bmc)
+
+
+def _run_coalesced(requests):
+    results = []
+    for result in batch([(hostname, command) for hostname, command in requests]):
+        if isinstance(result, IpmiCommandError):
+            results.append(dict(output=result.result.output, error=str(result), status=result.status))
+        elif isinstance(result, Exception):
+            results.append(dict(output=None, error='{}: {}'.format(result.__class__.__name__, result), status=None))
+        else:
+            results.append(dict(output=result, error=None, status='ok'))
+    return results
+
+
+def coalesce(hostname, command):
+    """Runs command together with the requests for other nodes behind the
+    same BMC that arrive within IPMI_COALESCE_WINDOW seconds.
+
+    Whichever worker leads the batch sends the commands of every node over
+    one native session, so concurrent tasks in other worker processes
+    share the session setup too.
+    """
+    bmc = lookup(hostname, command)[0]
+    # the native client resends each message up to retries times
+    timeout = COALESCE_NODE_MESSAGES * ipmilan.pool.timeout * ipmilan.pool.retries
+    result = coalescer.run('ipmi', bmc, [hostname, command], timeout, settings.IPMI_COALESCE_WINDOW, _run_coalesced)
+    if result['error'] is not None:
+        if result['status'] is not None:
+            raise IpmiCommandError(IpmiResult(result['status'], None, None, result['output']))
+        raise CommandError(result['error'])
+    return result['output']
 
 
 class Command(BaseCommand):
@@ -16,48 +383,53 @@ class Command(BaseCommand):
         parser.add_argument(
             'hostname',
             type=str,
-            help='machine hostname')
+            nargs='+',
+            help='machine hostname, several hostnames run as one batch per BMC')
 
         parser.add_argument(
             'command',
             type=str,
             help='IPMI command')
 
+        parser.add_argument(
+            '--chassis',
+            action='store_true',
+            help='run command on every host managed through the BMC of hostname')
+
+        parser.add_argument(
+            '--cached',
+            action='store_true',
+            help='for ipmi_list print the cached SEL entries without asking the BMC')
+
     def handle(self, hostname, command, *args, **options):
-        config = settings.WORKER_CONFIG
-        servers = config['servers']
-        try:
-            server = servers[hostname.split('.')[0]]
-            hostname = hostname.split('.')[0]
-        except:
-            server = servers[hostname]
+        if options.get('chassis'):
+            hostname = [name for host in hostname for name in chassis_hostnames(host)]
 
-        args = []
+        if command == 'ipmi_list':
+            results = sel_list(hostname, cached=options.get('cached', False))
+            if len(hostname) == 1:
+                if isinstance(results[0], Exception):
+                    raise results[0]
+                return results[0]
+            return ''.join('{}: error {}\n'.format(host, result) if isinstance(result, Exception)
+                           else ''.join('{}: {}\n'.format(host, line) for line in result.splitlines())
+                           for host, result in zip(hostname, results))
 
-        parent = server.get('parent', None)
-        if parent is not None:
-            addr = server.get('addr', None)
-            hostname = parent
-        else:
-            addr = None
-
-        hwtype = servers[hostname].get('type', None)
-        remap = config['types'].get(hwtype, None)
-        if remap is not None:
-            args += remap.get('args', None)
-            if addr is not None:
-                args += remap['map'][addr]
-            command = remap['commands'].get(command, [command])
-
-        user = servers[hostname]['user']
-        password = servers[hostname]['password']
-
-        run_cmd = functools.partial(
-            call_command,
-            load_command_class('relops_hardware_controller.api', 'ipmitool'),
-            '-H', hostname,
-            '-U', user,
-            '-P', password,
-            *args)
-
-        return run_cmd(*command)
+        if len(hostname) > 1:
+            results = batch([(host, command) for host in hostname])
+            return ''.join('{}: {}\n'.format(host, 'error {}'.format(result) if isinstance(result, Exception)
+                                             else ' '.join((result or '').split()))
+                           for host, result in zip(hostname, results))
+
+        hostname = hostname[0]
+        if command in SMART_COMMANDS:
+            return smart(hostname, command)
+
+        bmc, user, password, args, ipmi_command = lookup(hostname, command)
+        # bridge args mean a node behind a chassis BMC, ipmitool has no
+        # session to share so its commands would only queue behind each other
+        if (args and command in COALESCED_COMMANDS and settings.IPMI_CLIENT == 'native' and
+                settings.IPMI_COALESCE_WINDOW > 0):
+            return coalesce(hostname, command)
+
+        return run(bmc, user, password, args, ipmi_command)
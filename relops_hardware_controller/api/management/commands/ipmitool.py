@@ -1,8 +1,13 @@
+import collections
 import logging
+import re
 import subprocess
 
 from django.core.exceptions import ValidationError
-from django.core.management.base import BaseCommand
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
 
 from celery.exceptions import SoftTimeLimitExceeded
 
@@ -12,6 +17,65 @@ from relops_hardware_controller.api.validators import validate_host
 logger = logging.getLogger(__name__)
 
 
+IpmiResult = collections.namedtuple('IpmiResult', ['status', 'power', 'returncode', 'output'])
+
+# results where the BMC clearly refused so the command did not run
+FAILED_STATUSES = ['auth_error', 'unreachable', 'unsupported']
+
+AUTH_ERROR_RE = re.compile(
+    r'RAKP \d|unauthorized name|HMAC is invalid|invalid user ?name|password|insufficient privilege|'
+    r'Activate Session error',
+    re.IGNORECASE)
+UNREACHABLE_RE = re.compile(
+    r'Unable to establish|Address lookup for .* failed|Get Auth Capabilities error|'
+    r'No response|Connection refused|Network is unreachable',
+    re.IGNORECASE)
+UNSUPPORTED_RE = re.compile(
+    r'Invalid command|not supported|Unrecognized option|Invalid chassis power command|Invalid data field',
+    re.IGNORECASE)
+POWER_RE = re.compile(r'Chassis Power is (on|off)')
+
+
+class IpmiCommandError(CommandError):
+    """Raised when the BMC refused an ipmi command. result is the IpmiResult."""
+
+    def __init__(self, result):
+        super().__init__('{}: {}'.format(result.status, ' '.join((result.output or '').split())))
+        self.result = result
+
+    @property
+    def status(self):
+        return self.result.status
+
+
+def parse_result(returncode, output):
+    """Classifies ipmitool's exit status and output into an IpmiResult
+    with status ok, auth_error, unreachable, unsupported, timeout or unknown
+    and the power state for chassis power status.
+
+    Output of a zero exit is never classified as an error since e.g. a
+    sel list names "Invalid Username or Password" session audit events.
+    """
+    output = output or ''
+    power = POWER_RE.search(output)
+    if power is not None:
+        return IpmiResult('ok', power.group(1), returncode, output)
+
+    if returncode == 0:
+        status = 'ok'
+    elif returncode is None:
+        status = 'timeout'
+    elif AUTH_ERROR_RE.search(output):
+        status = 'auth_error'
+    elif UNREACHABLE_RE.search(output):
+        status = 'unreachable'
+    elif UNSUPPORTED_RE.search(output):
+        status = 'unsupported'
+    else:
+        status = 'unknown'
+    return IpmiResult(status, None, returncode, output)
+
+
 class Command(BaseCommand):
     help = 'Runs a command with ipmitool. Raises exception on timeout.'
     doc_url = 'https://linux.die.net/man/1/ipmitool'
@@ -108,12 +172,26 @@ class Command(BaseCommand):
         ] + command
 
         try:
-            return subprocess.check_output(call_args,
-                                           stderr=subprocess.STDOUT,
-                                           encoding='utf-8',
-                                           timeout=options['timeout'])
+            output = subprocess.check_output(call_args,
+                                             stderr=subprocess.STDOUT,
+                                             encoding='utf-8',
+                                             timeout=options['timeout'])
+            returncode = 0
         except SoftTimeLimitExceeded as e:
             raise e
-        except Exception as e:
-            logging.warn('ipmitool may report failure on success. '
-                         'So we ignore the exception and check for ping:')
+        except subprocess.CalledProcessError as e:
+            output, returncode = e.output, e.returncode
+        except subprocess.TimeoutExpired as e:
+            output, returncode = e.output, None
+            if isinstance(output, bytes):
+                output = output.decode('utf-8', 'replace')
+
+        result = parse_result(returncode, output)
+        if result.status in FAILED_STATUSES:
+            logger.error('ipmitool %s on %s failed: %s', ' '.join(command), options['address'], result.status)
+            raise IpmiCommandError(result)
+        if result.status != 'ok':
+            # a power action can time out or exit non-zero and still have run
+            logger.warn('ipmitool %s on %s returned %s, checking the host anyway: %s',
+                        ' '.join(command), options['address'], result.status, result.output)
+        return result.output
@@ -1,4 +1,4 @@
-import functools
+import collections
 import json
 import logging
 from datetime import datetime
@@ -14,6 +14,17 @@ from django.core.management import (
 )
 from django.core.management.base import BaseCommand
 
+from relops_hardware_controller.api.preflight import (
+    format_preflight,
+    preflight,
+)
+from relops_hardware_controller.api.probes import (
+    PingCheck,
+    any_up,
+    get_up_checks,
+)
+from relops_hardware_controller.api.verifiers import get_verifier
+
 logger = logging.getLogger(__name__)
 
 
@@ -54,17 +65,238 @@ def wait_for_state(fn, timeout, interval):
             break
 
 
-def reboot_succeeded(fqdn):
-    def is_down():
-        return not can_ping(fqdn, count=1, timeout=4)
+class Deadline:
+    '''
+    Tracks the time left of a budget of param seconds from param start.
+    '''
+    def __init__(self, seconds, start=None):
+        self.end = (start or time.time()) + seconds
+
+    def remaining(self):
+        return max(0, self.end - time.time())
+
+    def share(self, parts):
+        '''
+        returns when one of param parts equal shares of the remaining time ends
+        '''
+        return time.time() + self.remaining() / max(1, parts)
+
+
+def is_down(fqdn):
+    return not can_ping(fqdn, count=1, timeout=4)
+
+
+def went_down(fqdn, verifier=None):
+    '''
+    Returns True once fqdn stops answering ICMP or param verifier reads a
+    power cycle from the BMC, PDU or hypervisor. With REBOOT_VERIFY_WITH_PING
+    off the verifier is used instead of ICMP.
+    '''
+    if verifier is None:
+        return is_down(fqdn)
+    if verifier.power_cycled():
+        return True
+    return settings.REBOOT_VERIFY_WITH_PING and is_down(fqdn)
+
+
+def reboot_succeeded(fqdn, verifier=None, up_checks=None, deadline=None):
+    '''
+    Waits for fqdn to go down then come back up.
+
+    Param deadline (a time.time() value) caps DOWN_TIMEOUT and UP_TIMEOUT.
+
+    With param verifier the power cycle is read from the BMC, PDU or
+    hypervisor as well so a reboot faster than the ping interval still counts.
+
+    Param up_checks are readiness probes run concurrently on each poll,
+    the first one to report the host usable ends the wait. Defaults to ICMP.
+    A verifier reading the host finished booting, e.g. iLO FinishedPost,
+    ends it too.
+    '''
+    up_checks = up_checks or [PingCheck(fqdn, None)]
+
+    def power_cycled():
+        return went_down(fqdn, verifier)
 
     def is_up():
-        return can_ping(fqdn, count=1, timeout=60)
+        return any_up(up_checks) or (verifier is not None and verifier.finished_boot())
+
+    def timeout(limit):
+        if deadline is None:
+            return limit
+        return max(0, min(limit, deadline - time.time()))
 
-    powered_down = wait_for_state(is_down, timeout=settings.DOWN_TIMEOUT, interval=1)
+    powered_down = wait_for_state(power_cycled, timeout=timeout(settings.DOWN_TIMEOUT), interval=1)
     if not powered_down:
         return False
-    return wait_for_state(is_up, timeout=settings.UP_TIMEOUT, interval=5)
+    return wait_for_state(is_up, timeout=timeout(settings.UP_TIMEOUT), interval=5)
+
+
+def get_server(hostname):
+    config = settings.WORKER_CONFIG
+    try:
+        return config['servers'][hostname.split('.')[0]]
+    except:
+        return config['servers'][hostname]
+
+
+def get_reboot_call(reboot_method, hostname, server, job_data, reboot_attempt_log=''):
+    '''
+    Returns the (command name, target, args) to call_command for
+    param reboot_method or None when the server has no config for it.
+    '''
+    target = hostname
+    if reboot_method == 'ssh_reboot':
+        try:
+            reboot_args = [
+                '-l', server['ssh']['user'],
+                '-i', server['ssh']['key_file'],
+            ]
+        except KeyError:
+            reboot_args = [
+                '-l', 'roller',
+                '-i', 'ssh.key',
+            ]
+        # per host override of the reboot command tried first
+        ssh_config = server.get('ssh', {})
+        if 'os' in ssh_config:
+            reboot_args.extend(['--os', ssh_config['os']])
+        if 'reboot_command' in ssh_config:
+            reboot_args.extend(['--reboot-command', ssh_config['reboot_command']])
+    elif reboot_method in ['ipmi_on', 'ipmi_reset', 'ipmi_cycle', 'ipmi_ensure_on', 'ipmi_smart_reboot']:
+        reboot_args = [ reboot_method ]
+        reboot_method = 'ipmi'
+    elif reboot_method == 'snmp_reboot':
+        try:
+            reboot_args = server['pdu'].rsplit(':', 1)
+        except KeyError:
+            # no pdu information
+            return None
+    elif reboot_method == 'snmp_rebootdelay':
+        try:
+            reboot_args = server['pdu'].rsplit(':', 1)
+        except KeyError:
+            # no pdu information
+            return None
+        reboot_args.extend(['--delay', 60])
+        reboot_method = 'snmp_reboot'
+    elif reboot_method == 'xenapi_reboot':
+        # the VM uuid then any options, like the verifier and pre-flight probe read it
+        target, *reboot_args = server['xen']['reboot']
+    elif reboot_method == 'ilo_reboot':
+        target, reboot_args = server['ilo']
+    elif reboot_method == 'file_bugzilla_bug':
+        try:
+            bug_cc_email = server['bug_cc']
+        except Exception as e:
+            logging.warn(e)
+            bug_cc_email = ''
+        reboot_args = [
+            json.dumps(job_data),
+            '--cc', bug_cc_email,
+            '--log', reboot_attempt_log,
+        ]
+    else:
+        raise NotImplementedError()
+
+    return reboot_method, target, reboot_args
+
+
+def format_attempt(reboot_method, reboot_args, error):
+    '''
+    Returns the bug log and short log entries for a failed reboot method.
+    '''
+    name = error.__class__.__name__
+    if getattr(error, 'status', None) is not None:
+        name += ' ' + error.status  # e.g. auth_error from ipmi
+    return (
+        '{} {} {} {}\\n'.format(
+            datetime.utcnow().isoformat(),
+            reboot_method,
+            ' '.join(str(a) for a in reboot_args),
+            name),
+        '{} {} {}. '.format(
+            datetime.utcnow().strftime("%H:%M:%S"),
+            reboot_method,
+            name),
+    )
+
+
+class NoTimeLeft(Exception):
+    '''
+    Raised by plan_method when the deadline of the reboot is used up. The
+    message is the short log entry.
+    '''
+
+
+MethodCall = collections.namedtuple('MethodCall', ['command', 'target', 'reboot_args', 'deadline'])
+
+
+def preflight_methods(hostname, server, reboot_methods):
+    '''
+    Returns (methods, preflight note, log entry) with the methods of param
+    reboot_methods the pre-flight probes found usable, or all of them and
+    empty strings when REBOOT_PREFLIGHT is off.
+    '''
+    if not settings.REBOOT_PREFLIGHT:
+        return reboot_methods, '', ''
+    capabilities = preflight(hostname, server, reboot_methods)
+    methods = [method for method, capability in capabilities.items() if capability.usable]
+    return (methods,
+            ' Preflight: {}.'.format(format_preflight(capabilities)),
+            'preflight: {}\\n'.format(format_preflight(capabilities)))
+
+
+def plan_method(reboot_methods, index, hostname, server, job_data, deadline, reboot_attempt_log=''):
+    '''
+    Returns the MethodCall for the reboot method at param index of param
+    reboot_methods, with the time param deadline leaves it when shared
+    equally with the methods after it. Returns None when the server has
+    no config for the method.
+
+    Raises NoTimeLeft when the deadline is used up, except for
+    file_bugzilla_bug which always runs.
+    '''
+    reboot_method = reboot_methods[index]
+    method_deadline = None
+    if reboot_method != 'file_bugzilla_bug':
+        if not deadline.remaining():
+            raise NoTimeLeft('{} {} skipped, no time left. '.format(
+                datetime.utcnow().strftime("%H:%M:%S"),
+                reboot_method))
+        methods_left = len([method for method in reboot_methods[index:] if method != 'file_bugzilla_bug'])
+        method_deadline = deadline.share(methods_left)
+
+    reboot_call = get_reboot_call(reboot_method, hostname, server, job_data, reboot_attempt_log)
+    if reboot_call is None:
+        return None
+    return MethodCall(*reboot_call, deadline=method_deadline)
+
+
+def run_method(reboot_method, method_call, hostname, server, job_data, stdout, started=None):
+    '''
+    Runs param method_call after snapshotting the up checks and verifier
+    that tell whether param reboot_method cycled the host. Calls param
+    started with them right before the power action.
+
+    Returns (verifier, up_checks), None and [] for file_bugzilla_bug.
+    '''
+    verifier, up_checks = None, []
+    if reboot_method != 'file_bugzilla_bug':
+        up_checks = get_up_checks(hostname, job_data)
+        for up_check in up_checks:
+            up_check.snapshot()
+        verifier = get_verifier(reboot_method, hostname, server)
+        if verifier is not None:
+            verifier.snapshot()
+
+    if started is not None:
+        started(verifier, up_checks)
+    call_command(load_command_class('relops_hardware_controller.api', method_call.command),
+                 method_call.target,
+                 *method_call.reboot_args,
+                 stdout=stdout)
+    return verifier, up_checks
 
 
 class Command(BaseCommand):
@@ -86,87 +318,45 @@ class Command(BaseCommand):
         result_template = '{command}: {stdout} Completed in {time:.3g} seconds'
         reboot_attempt_log = '\\n'
         reboot_attempt_log_short = ' '
-        config = settings.WORKER_CONFIG
-        try:
-            server = config['servers'][hostname.split('.')[0]]
-        except:
-            server = config['servers'][hostname]
+        server = get_server(hostname)
+
+        reboot_methods, preflight_note, preflight_log = preflight_methods(hostname, server,
+                                                                          settings.REBOOT_METHODS)
+        reboot_attempt_log += preflight_log
 
-        logger.debug('reboot_methods:{}'.format(settings.REBOOT_METHODS))
+        # Keep back time to file a bug before the celery soft time limit
+        # and split the rest between the remaining reboot methods.
+        deadline = Deadline(int(settings.CELERY_TASK_SOFT_TIME_LIMIT) - settings.BUG_FILING_RESERVE, start)
+
+        logger.debug('reboot_methods:{}'.format(reboot_methods))
         stdout = StringIO()
-        try:
-            bug_cc_email = server['bug_cc']
-        except Exception as e:
-            logging.warn(e)
-            bug_cc_email = ''
-        for reboot_method in settings.REBOOT_METHODS:
+        for index, reboot_method in enumerate(reboot_methods):
             reboot_args = []
             logger.debug('reboot_method:{}'.format(reboot_method))
-            check = reboot_succeeded
             try:
                 reboot_command = reboot_method
-                if reboot_method == 'ssh_reboot':
-                    try:
-                        reboot_args = [
-                            '-l', server['ssh']['user'],
-                            '-i', server['ssh']['key_file'],
-                        ]
-                    except KeyError:
-                        reboot_args = [
-                            '-l', 'roller',
-                            '-i', 'ssh.key',
-                        ]
-                elif reboot_method == 'ipmi_on':
-                    reboot_args = [ reboot_method ]
-                    reboot_method = 'ipmi'
-                elif reboot_method == 'ipmi_reset':
-                    reboot_args = [ reboot_method ]
-                    reboot_method = 'ipmi'
-                elif reboot_method == 'ipmi_cycle':
-                    reboot_args = [ reboot_method ]
-                    reboot_method = 'ipmi'
-                elif reboot_method == 'snmp_reboot':
-                    try:
-                        reboot_args = server['pdu'].rsplit(':', 1)
-                    except KeyError:
-                        # no pdu information
-                        continue
-                elif reboot_method == 'snmp_rebootdelay':
-                    try:
-                        reboot_args = server['pdu'].rsplit(':', 1)
-                    except KeyError:
-                        # no pdu information
-                        continue
-                    reboot_args.extend(['--delay', 60])
-                    reboot_method = 'snmp_reboot'
-                elif reboot_method == 'xenapi_reboot':
-                    reboot_args = server['xen']['reboot']
-                elif reboot_method == 'ilo_reboot':
-                    hostname, reboot_args = server['ilo']
-                elif reboot_method == 'file_bugzilla_bug':
+                method_call = plan_method(reboot_methods, index, hostname, server, job_data, deadline,
+                                          reboot_attempt_log)
+                if method_call is None:
+                    continue
+                reboot_method, reboot_args = method_call.command, method_call.reboot_args
+
+                if reboot_command == 'file_bugzilla_bug':
                     result_template = 'failed. {stdout}'
-                    reboot_args = [
-                        json.dumps(job_data),
-                        '--cc', bug_cc_email,
-                        '--log', reboot_attempt_log,
-                    ]
-                    def check(hostname):
-                        logger.info(hostname)
-                        return True
-                else:
-                    raise NotImplementedError()
 
-                call_command(load_command_class('relops_hardware_controller.api', reboot_method),
-                             hostname,
-                             *reboot_args,
-                             stdout=stdout)
+                verifier, up_checks = run_method(reboot_command, method_call, hostname, server, job_data, stdout)
 
-                if check(hostname):
+                if reboot_command == 'file_bugzilla_bug' or reboot_succeeded(
+                        hostname, verifier=verifier, up_checks=up_checks, deadline=method_call.deadline):
                     rebooted = True
                     break
                 else:
                     raise Exception('Reboot did not cycle power.')
 
+            except NoTimeLeft as e:
+                logger.warn('No time left to try %s', reboot_method)
+                reboot_attempt_log_short += str(e)
+
             except SoftTimeLimitExceeded as e:
                 logger.exception(e)
                 reboot_attempt_log_short += '{} {} {}. '.format(
@@ -178,21 +368,15 @@ class Command(BaseCommand):
 
             except Exception as e:
                 logger.exception(e)
-                reboot_attempt_log += '{} {} {} {}\\n'.format(
-                    datetime.utcnow().isoformat(),
-                    reboot_method,
-                    ' '.join(str(a) for a in reboot_args),
-                    e.__class__.__name__)
-                reboot_attempt_log_short += '{} {} {}. '.format(
-                    datetime.utcnow().strftime("%H:%M:%S"),
-                    reboot_method,
-                    e.__class__.__name__)
+                log_entry, log_entry_short = format_attempt(reboot_method, reboot_args, e)
+                reboot_attempt_log += log_entry
+                reboot_attempt_log_short += log_entry_short
 
         if not rebooted:
-            raise Exception('failed:{}'.format(reboot_attempt_log_short))
+            raise Exception('failed:{}{}'.format(reboot_attempt_log_short, preflight_note))
 
         elapsed = time.time() - start
         return result_template.format(
             command=reboot_command,
             stdout=stdout.getvalue().replace('\n', '\r'),
-            time=elapsed)
+            time=elapsed) + preflight_note
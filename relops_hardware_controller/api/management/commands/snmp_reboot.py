@@ -1,10 +1,21 @@
+import collections
 import logging
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
 
+from relops_hardware_controller.api import (
+    coalescer,
+    pdu_cache,
+    power_timer,
+    snmp,
+)
 from relops_hardware_controller.api.validators import validate_host
 
 
@@ -28,8 +39,28 @@ class Command(BaseCommand):
     # <o>: outlet
     base_oid = "1.3.6.1.4.1.1718.3.2.3.1.11"
 
+    #    |  |     +--outletStatus(5)                        |   |       +- .5 .<t> .<i> .<o>
+    status_oid = "1.3.6.1.4.1.1718.3.2.3.1.5"
+
+    #    |  |     +--outletLoadValue(7)                     |   |       +- .7 .<t> .<i> .<o>
+    # in hundredths of amps, -1 when the outlet does not measure it
+    load_oid = "1.3.6.1.4.1.1718.3.2.3.1.7"
+
     cmds = dict(on='1', off='2', reboot='3')
 
+    outlet_statuses = {
+        '0': 'on',
+        '1': 'off',
+        '2': 'onWait',
+        '3': 'offWait',
+        '4': 'onError',
+        '5': 'offError',
+        '6': 'noComm',
+        '7': 'reading',
+        '8': 'offFuse',
+        '9': 'onFuse',
+    }
+
     port_mappings = {
         "a": "1",
         "b": "2",
@@ -84,32 +115,297 @@ class Command(BaseCommand):
             raise
 
     def run_cmd(self, fqdn, cmd, **options):
-        config = settings.WORKER_CONFIG
-
         # Append tower, infeed, and outlet
         oid = "%s.%s.%s.%s" % (self.base_oid, self.tower, self.infeed, self.outlet)
 
-        snmp_community_string = config['snmp_community_string']
+        if settings.SNMP_CLIENT == 'native':
+            validate_host(fqdn)
+            logger.info('SNMP SET %s %s = %s', fqdn, oid, cmd)
+            varbinds = snmp.run(fqdn, 'set', (oid, int(cmd)), timeout=options['timeout'])
+            return snmp.format_varbinds(varbinds)
 
         # Example reboot command:
         # snmpset -v 2c -c comm_string 10.26.9.45 1.3.6.1.4.1.1718.3.2.3.1.11.1.1.8 i 3
-        command = ' '.join([
+        command = [
             'snmpset',
             '-v', '2c',  # SNMP version to use
-            '-c', 'snmp_community_string',
+            '-c', settings.WORKER_CONFIG['snmp_community_string'],
             fqdn,
             oid,
-            'i', # cmd value type (i: integer)
+            'i',  # cmd value type (i: integer)
             cmd,
-        ])
-        logger.info(command)
+        ]
+        logger.info(' '.join(command[:3] + command[5:]))
 
-        return subprocess.check_output(command.replace('snmp_community_string', snmp_community_string),
+        return subprocess.check_output(command,
                                        stderr=subprocess.STDOUT,
                                        encoding='utf-8',
-                                       shell=True,
                                        timeout=options['timeout'])
 
+    def set_outlets(self, pdu, outlets, timeout=60):
+        """SETs the outletControlAction of several (port, cmd) on pdu in
+        one request. Returns the output or exception for each outlet.
+
+        A SET is all or nothing, so when the agent blames one outlet the
+        others are sent again without it.
+        """
+        oids = ["%s.%s.%s.%s" % ((self.base_oid,) + self._parse_port(port)) for port, _ in outlets]
+        varbinds = [(oid, int(cmd)) for oid, (_, cmd) in zip(oids, outlets)]
+        logger.info('SNMP SET %s %s', pdu, ' '.join('{}={}'.format(oid, value) for oid, value in varbinds))
+
+        if settings.SNMP_CLIENT == 'native':
+            validate_host(pdu)
+            try:
+                answered = dict(snmp.run(pdu, 'set', *varbinds, timeout=timeout))
+            except snmp.SnmpError as e:
+                if e.oid not in oids or len(oids) == 1:
+                    return [e] * len(outlets)
+                index = oids.index(e.oid)
+                rest = self.set_outlets(pdu, outlets[:index] + outlets[index + 1:], timeout)
+                return rest[:index] + [e] + rest[index:]
+            return [snmp.format_varbinds([(oid, answered.get(oid))]) for oid in oids]
+
+        command = [
+            'snmpset',
+            '-v', '2c',
+            '-c', settings.WORKER_CONFIG['snmp_community_string'],
+            pdu,
+        ]
+        for oid, value in varbinds:
+            command.extend([oid, 'i', str(value)])
+        try:
+            output = subprocess.check_output(command,
+                                             stderr=subprocess.STDOUT,
+                                             encoding='utf-8',
+                                             timeout=timeout)
+        except Exception as e:
+            return [e] * len(outlets)
+        lines = output.splitlines()
+        # snmpset prints one line per varbind
+        if len(lines) != len(outlets):
+            return [output] * len(outlets)
+        return [line + '\n' for line in lines]
+
+    def batch(self, requests, timeout=60, max_workers=None):
+        """Runs a list of (pdu, port, cmd) as one SET per PDU, up to
+        max_workers PDUs at once. Returns the output or exception for each
+        request in order.
+        """
+        results = [None] * len(requests)
+        groups = collections.OrderedDict()
+        for index, (pdu, port, cmd) in enumerate(requests):
+            groups.setdefault(pdu, []).append((index, port, cmd))
+        if not groups:
+            return results
+
+        def run_group(pdu, nodes):
+            try:
+                outputs = self.set_outlets(pdu, [(port, cmd) for _, port, cmd in nodes], timeout)
+            except Exception as e:
+                logger.exception(e)
+                outputs = [e] * len(nodes)
+            for (index, _, _), output in zip(nodes, outputs):
+                results[index] = output
+
+        with ThreadPoolExecutor(max_workers=min(len(groups), max_workers or len(groups))) as executor:
+            for future in [executor.submit(run_group, pdu, nodes) for pdu, nodes in groups.items()]:
+                future.result()
+        return results
+
+    def batch_hosts(self, hostnames, action='reboot', timeout=60, max_workers=None):
+        """Runs action (on, off or reboot) on the outlet in the pdu entry
+        of each server in WORKER_CONFIG. Returns the output or exception
+        for each hostname in order.
+        """
+        results = [None] * len(hostnames)
+        requests = []
+        for index, hostname in enumerate(hostnames):
+            try:
+                pdu, port = settings.WORKER_CONFIG['servers'][hostname]['pdu'].rsplit(':', 1)
+            except (KeyError, ValueError) as e:
+                results[index] = CommandError('No PDU config for {}: {}'.format(hostname, e))
+                continue
+            requests.append((index, (pdu, port, self.cmds[action])))
+
+        outputs = self.batch([request for _, request in requests], timeout, max_workers)
+        for (index, _), output in zip(requests, outputs):
+            results[index] = output
+        return results
+
+    def _run_coalesced(self, pdu, requests):
+        timeout = max(timeout for _, _, timeout in requests)
+        results = []
+        for result in self.batch([(pdu, port, cmd) for port, cmd, _ in requests], timeout):
+            if isinstance(result, snmp.SnmpError):
+                results.append(dict(output=None, error=str(result), status=result.status))
+            elif isinstance(result, Exception):
+                results.append(dict(output=None, error='{}: {}'.format(result.__class__.__name__, result),
+                                    status=None))
+            else:
+                results.append(dict(output=result, error=None, status=None))
+        return results
+
+    def coalesce(self, pdu, port, cmd, timeout=60):
+        """SETs the outlet together with the outlets of the same PDU that
+        other jobs ask for within SNMP_COALESCE_WINDOW seconds.
+
+        Whichever job leads the batch sends the whole queue as one SET and
+        leaves each outlet's result for the job that asked for it. A SET
+        the agent refuses for one outlet is sent again without it, so
+        each outlet may add a SET of up to timeout seconds to the batch.
+        """
+        result = coalescer.run('snmp', pdu, [port, cmd, timeout], timeout, settings.SNMP_COALESCE_WINDOW,
+                               lambda requests: self._run_coalesced(pdu, requests))
+        if result['error'] is not None:
+            if result['status'] is not None:
+                raise snmp.SnmpError(result['error'], result['status'])
+            raise CommandError(result['error'])
+        return result['output']
+
+    def set_outlet(self, pdu, port, cmd, **options):
+        if settings.SNMP_COALESCE_WINDOW > 0:
+            return self.coalesce(pdu, port, cmd, options['timeout'])
+        return self.run_cmd(pdu, cmd, **options)
+
+    def power_on(self, pdu, port, timeout=60):
+        """Turns the outlet back on for a power_timer entry."""
+        [output] = self.set_outlets(pdu, [(port, self.cmds['on'])], timeout)
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    def outlet_index(self, port):
+        """Returns the tower.infeed.outlet index of port e.g. AA8 -> 1.1.8."""
+        return '.'.join(self._parse_port(port))
+
+    def _outlets(self, indexes, statuses, loads):
+        outlets = {}
+        for index, status, load in zip(indexes, statuses, loads):
+            try:
+                load = int(load)
+            except (TypeError, ValueError):
+                load = None
+            outlets[index] = (self.outlet_statuses.get(str(status).strip(), None), load)
+        return outlets
+
+    def read_outlets(self, pdu, ports, timeout=60):
+        """GETs the outletStatus and outletLoadValue of ports on pdu in one
+        request and caches them. Returns the pdu_cache entry of each port.
+        """
+        indexes = [self.outlet_index(port) for port in ports]
+        oids = [column + '.' + index for index in indexes for column in (self.status_oid, self.load_oid)]
+
+        if settings.SNMP_CLIENT == 'native':
+            validate_host(pdu)
+            values = [value for _, value in snmp.run(pdu, 'get', *oids, timeout=timeout)]
+        else:
+            command = [
+                'snmpget',
+                '-v', '2c',
+                '-c', settings.WORKER_CONFIG['snmp_community_string'],
+                '-Oqve',  # print only the values, enums as integers
+                pdu,
+            ] + oids
+            logger.info(' '.join(command[:3] + command[5:]))
+            values = subprocess.check_output(command,
+                                             stderr=subprocess.STDOUT,
+                                             encoding='utf-8',
+                                             timeout=timeout).splitlines()
+
+        entries = pdu_cache.store(pdu, self._outlets(indexes, values[0::2], values[1::2]))
+        return [entries[index] for index in indexes]
+
+    def walk_outlets(self, pdu, timeout=60):
+        """Walks the outletStatus and outletLoadValue columns of pdu with
+        GETBULK and caches every outlet. Returns the dict of outlet index
+        to pdu_cache entry.
+        """
+        columns = {}
+        if settings.SNMP_CLIENT == 'native':
+            validate_host(pdu)
+            for column, varbinds in snmp.run(pdu, 'walk', self.status_oid, self.load_oid, timeout=timeout).items():
+                columns[column] = collections.OrderedDict((oid[len(column) + 1:], value) for oid, value in varbinds)
+        else:
+            for column in (self.status_oid, self.load_oid):
+                command = [
+                    'snmpbulkwalk',
+                    '-v', '2c',
+                    '-c', settings.WORKER_CONFIG['snmp_community_string'],
+                    '-Oqne',  # numeric oids and enums, no type names
+                    pdu,
+                    column,
+                ]
+                logger.info(' '.join(command[:3] + command[5:]))
+                output = subprocess.check_output(command,
+                                                 stderr=subprocess.STDOUT,
+                                                 encoding='utf-8',
+                                                 timeout=timeout)
+                columns[column] = collections.OrderedDict()
+                for line in output.splitlines():
+                    oid, _, value = line.strip().lstrip('.').partition(' ')
+                    if oid.startswith(column + '.'):
+                        columns[column][oid[len(column) + 1:]] = value
+
+        indexes = list(columns[self.status_oid])
+        loads = [columns[self.load_oid].get(index) for index in indexes]
+        return pdu_cache.store(pdu, self._outlets(indexes, columns[self.status_oid].values(), loads))
+
+    def walk_pdus(self, pdus, timeout=60, max_workers=None):
+        """Walks the outlet table of each pdu, up to max_workers at once.
+        Returns a dict of pdu to its entries or exception.
+        """
+        results = collections.OrderedDict()
+        if not pdus:
+            return results
+        with ThreadPoolExecutor(max_workers=min(len(pdus), max_workers or len(pdus))) as executor:
+            futures = [(pdu, executor.submit(self.walk_outlets, pdu, timeout)) for pdu in pdus]
+            for pdu, future in futures:
+                try:
+                    results[pdu] = future.result()
+                except Exception as e:
+                    logger.info('Could not walk the outlets of %s: %s', pdu, e)
+                    results[pdu] = e
+        return results
+
+    def confirm(self, pdu, port, timeout=60):
+        """Reads the outlet back after a SET. The PduVerifier picks the
+        cached state up instead of waiting for the host to drop off the
+        network.
+        """
+        try:
+            [entry] = self.read_outlets(pdu, [port], timeout)
+        except Exception as e:
+            logger.info('Could not read back outlet %s of %s: %s', port, pdu, e)
+            return ''
+        load = '' if entry['load'] is None else ' {:.2f}A'.format(entry['load'])
+        return 'outlet {} {}{}\n'.format(port, entry['status'], load)
+
+    def get_outlet_status(self, pdu, port, **options):
+        """Returns the outletStatus name of port on pdu e.g. 'on' or 'offWait'."""
+        tower, infeed, outlet = self._parse_port(port)
+        oid = "%s.%s.%s.%s" % (self.status_oid, tower, infeed, outlet)
+
+        if settings.SNMP_CLIENT == 'native':
+            validate_host(pdu)
+            [(_, value)] = snmp.run(pdu, 'get', oid, timeout=options.get('timeout', 60))
+            return self.outlet_statuses.get(str(value), None)
+
+        command = [
+            'snmpget',
+            '-v', '2c',
+            '-c', settings.WORKER_CONFIG['snmp_community_string'],
+            '-Oqve',  # print only the value, enums as integers
+            pdu,
+            oid,
+        ]
+        logger.info(' '.join(command[:3] + command[5:]))
+
+        output = subprocess.check_output(command,
+                                         stderr=subprocess.STDOUT,
+                                         encoding='utf-8',
+                                         timeout=options.get('timeout', 60))
+        return self.outlet_statuses.get(output.strip(), None)
+
     def handle(self, fqdn, pdu, port, *args, **options):
         self.tower, self.infeed, self.outlet = self._parse_port(port)
 
@@ -118,7 +414,13 @@ class Command(BaseCommand):
 
         if options['delay'] > 0:
             logger.info('Powering down {} ...'.format(fqdn))
-            output += self.run_cmd(pdu, self.cmds['off'], **options)
+            output += self.set_outlet(pdu, port, self.cmds['off'], **options)
+            output += self.confirm(pdu, port, options['timeout'])
+
+            if options['delay'] > settings.POWER_ON_INLINE_DELAY:
+                power_timer.schedule_on('snmp_reboot', pdu, options['delay'], port=port, timeout=options['timeout'])
+                output += ' power on scheduled in {}s'.format(options['delay'])
+                return output
 
             delay_note = ' wait {}s ... '.format(options['delay'])
             logger.info(delay_note)
@@ -126,8 +428,9 @@ class Command(BaseCommand):
             output += delay_note
 
             logger.info('Powering up {} ...'.format(fqdn))
-            output += self.run_cmd(pdu, self.cmds['on'], **options)
+            output += self.set_outlet(pdu, port, self.cmds['on'], **options)
         else:
-            output += self.run_cmd(pdu, self.cmds['reboot'], **options)
+            output += self.set_outlet(pdu, port, self.cmds['reboot'], **options)
+            output += self.confirm(pdu, port, options['timeout'])
 
         return output
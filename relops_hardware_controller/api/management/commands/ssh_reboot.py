@@ -1,6 +1,15 @@
+import asyncio
+import collections
+import json
 import logging
+import os
+import re
 import subprocess
+import threading
+import time
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.management.base import BaseCommand, CommandError
 
 from relops_hardware_controller.api.validators import validate_host
@@ -8,6 +17,194 @@ from relops_hardware_controller.api.validators import validate_host
 
 logger = logging.getLogger(__name__)
 
+# ssh exits 255 for its own errors, these mean no command can get through
+CONNECT_ERROR_RE = re.compile(r'Connection timed out|Connection refused|No route to host|Permission denied'
+                              r'|Could not resolve hostname|Host key verification failed')
+
+
+# By trying a few different reboot commands we don't need to special case
+# different types of hosts. The "shutdown" command is for Windows, but uses
+# hyphens because it gets run through a bash shell. We also delay the
+# shutdown for a few seconds so that we have time to read the exit status
+# of the shutdown command.
+REBOOT_COMMANDS = collections.OrderedDict([
+    ('unix', 'reboot'),
+    ('windows', 'shutdown -f -t 3 -r'),
+])
+
+KEY = 'ssh:reboot:{}'
+TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _host(hostname):
+    return hostname.split('.')[0]
+
+
+def remember(hostname, os_family, reboot_command):
+    cache.set(KEY.format(_host(hostname)), dict(os=os_family, command=reboot_command), TIMEOUT)
+
+
+def forget(hostname):
+    cache.delete(KEY.format(_host(hostname)))
+
+
+def reboot_candidates(hostname, os_family=None, reboot_command=None):
+    """Returns the (os family, reboot command) to try in order: only the
+    configured one when given, otherwise every REBOOT_COMMANDS entry with
+    the one that last worked for hostname first.
+    """
+    if reboot_command:
+        return [(os_family, reboot_command)]
+    if os_family:
+        return [(os_family, REBOOT_COMMANDS[os_family])]
+
+    candidates = list(REBOOT_COMMANDS.items())
+    worked = cache.get(KEY.format(_host(hostname)))
+    if worked is not None and (worked['os'], worked['command']) in candidates:
+        candidates.remove((worked['os'], worked['command']))
+        candidates.insert(0, (worked['os'], worked['command']))
+    return candidates
+
+
+def control_args(connect_timeout):
+    """Returns the ssh options sharing one authenticated connection per
+    user, host and port between the commands of a reboot, and the jobs
+    within SSH_CONTROL_PERSIST seconds.
+    """
+    os.makedirs(settings.SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={}'.format(os.path.join(settings.SSH_CONTROL_DIR, '%C')),
+        '-o', 'ControlPersist={}'.format(settings.SSH_CONTROL_PERSIST),
+        '-o', 'ConnectTimeout={}'.format(connect_timeout),
+    ]
+
+
+def ssh_args(hostname, login_name, identity_file, port=22, connect_timeout=None):
+    """Returns the ssh argv up to the remote command."""
+    return [
+        'ssh',
+
+        '-o', 'PasswordAuthentication=no',
+        '-o', 'BatchMode=yes',
+        '-o', 'ServerAliveInterval=2',
+        '-o', 'LogLevel=ERROR',
+
+        # disable host key checks
+        '-o', 'StrictHostKeyChecking=no',
+        '-o', 'UserKnownHostsFile=/dev/null',
+    ] + control_args(connect_timeout or settings.SSH_CONNECT_TIMEOUT) + [
+        '-i', identity_file,
+        '-l', login_name,
+        '-p', str(port),
+        hostname,
+    ]
+
+
+def host_options(hostname):
+    """Returns the ssh_reboot options of hostname from the ssh config of
+    its WORKER_CONFIG server, the same ones the reboot command passes.
+    """
+    servers = settings.WORKER_CONFIG.get('servers', {})
+    ssh_config = servers.get(_host(hostname), servers.get(hostname, {})).get('ssh', {})
+    options = dict(login_name='roller', identity_file='ssh.key',
+                   os_family=ssh_config.get('os'), reboot_command=ssh_config.get('reboot_command'))
+    if 'user' in ssh_config and 'key_file' in ssh_config:
+        options.update(login_name=ssh_config['user'], identity_file=ssh_config['key_file'])
+    return options
+
+
+async def _run(args, timeout):
+    """Runs args and returns (returncode, output), or raises
+    asyncio.TimeoutError after killing it.
+    """
+    proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT)
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout.decode('utf-8', 'replace')
+
+
+async def reboot_host(hostname, login_name, identity_file, port=22, timeout=5, connect_timeout=None,
+                      os_family=None, reboot_command=None):
+    """Tries the reboot commands of hostname like the ssh_reboot command
+    does, without blocking the event loop. Returns a result dict with the
+    hostname, a status of ok, failed, unreachable, timeout or error, the
+    last reboot command tried, its output and the elapsed seconds.
+    """
+    start = time.time()
+    result = dict(hostname=hostname, status='error', command=None, output='')
+    try:
+        validate_host(hostname)
+        connect_timeout = connect_timeout or settings.SSH_CONNECT_TIMEOUT
+        call_args = ssh_args(hostname, login_name, identity_file, port, connect_timeout)
+        overridden = bool(os_family or reboot_command)
+        result['status'] = 'failed'
+        for index, (family, cmd) in enumerate(reboot_candidates(hostname, os_family, reboot_command)):
+            result['command'] = cmd
+            try:
+                returncode, result['output'] = await _run(call_args + [cmd], connect_timeout + timeout)
+            except asyncio.TimeoutError:
+                result['status'] = 'timeout'
+                break
+            if returncode == 0:
+                if not overridden:
+                    remember(hostname, family, cmd)
+                result['status'] = 'ok'
+                try:
+                    await _run(call_args[:-1] + ['-O', 'exit', call_args[-1]], 5)
+                except Exception as e:
+                    logger.debug('Could not close the ssh master connection: %s', e)
+                break
+            logger.info('{} ssh reboot with command {} failed with {}'.format(hostname, cmd, returncode))
+            if returncode == 255 and CONNECT_ERROR_RE.search(result['output']):
+                result['status'] = 'unreachable'
+                break
+            if index == 0 and not overridden:
+                forget(hostname)
+    except Exception as e:
+        logger.exception(e)
+        result.update(status='error', output=str(e))
+    result['output'] = ' '.join(result['output'].split())
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
+
+
+def fan_out(hostnames, max_concurrency=None, **options):
+    """Reboots hostnames with ssh, up to max_concurrency (default
+    SSH_FANOUT_CONCURRENCY) at once on an event loop of its own. Each
+    host gets its options from host_options, updated with the options
+    that are not None. Returns the reboot_host results in the order of
+    hostnames.
+
+    Must run on the main thread, which the event loop's child watcher
+    needs to reap the ssh processes.
+    """
+    max_concurrency = max_concurrency or settings.SSH_FANOUT_CONCURRENCY
+    loop = asyncio.new_event_loop()
+    if threading.current_thread() is threading.main_thread():
+        asyncio.get_child_watcher().attach_loop(loop)
+
+    async def bounded(semaphore, hostname):
+        host = host_options(hostname)
+        host.update({name: value for name, value in options.items() if value is not None})
+        async with semaphore:
+            return await reboot_host(hostname, **host)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        return await asyncio.gather(*[bounded(semaphore, hostname) for hostname in hostnames])
+
+    try:
+        return loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+
 
 class Command(BaseCommand):
     help = '''Reboots a server with ssh. The account it uses should use
@@ -20,22 +217,23 @@ class Command(BaseCommand):
         parser.add_argument(
             'hostname',
             type=str,
-            help='Remote hostname to connect to.',
+            nargs='+',
+            help='Remote hostname to connect to. More than one reboots them all with --fan-out.',
         )
 
-        # Named (required) arguments
+        # Named arguments, required for a single host
         parser.add_argument(
             '-l',
             dest='login_name',
             type=str,
-            required=True,
+            default=None,
             help='Specifies the user to log in as on the remote machine.',
         )
         parser.add_argument(
             '-i',
             dest='identity_file',
             type=str,
-            required=True,
+            default=None,
             help='Selects a file from which the identity (private key) for public key authentication is read.',
         )
 
@@ -54,42 +252,104 @@ class Command(BaseCommand):
             dest='timeout',
             default=5,
             type=int,
-            help='stop after N seconds',
+            help='stop each reboot command N seconds after connecting',
+        )
+        parser.add_argument(
+            '--os',
+            dest='os_family',
+            choices=list(REBOOT_COMMANDS),
+            default=None,
+            help='only run the reboot command for this OS family',
+        )
+        parser.add_argument(
+            '--reboot-command',
+            dest='reboot_command',
+            type=str,
+            default=None,
+            help='only run this reboot command',
+        )
+        parser.add_argument(
+            '--connect-timeout',
+            dest='connect_timeout',
+            default=None,
+            type=int,
+            help='give up connecting after N seconds (default SSH_CONNECT_TIMEOUT)',
+        )
+        parser.add_argument(
+            '--fan-out',
+            dest='fan_out',
+            action='store_true',
+            default=False,
+            help='reboot every hostname concurrently, with the -l and -i of its WORKER_CONFIG server '
+                 'unless given, and print one JSON result per host',
+        )
+        parser.add_argument(
+            '--max-concurrency',
+            dest='max_concurrency',
+            default=None,
+            type=int,
+            help='reboot at most N hosts at once with --fan-out (default SSH_FANOUT_CONCURRENCY)',
         )
 
     def handle(self, hostname, *args, **options):
+        if options.get('fan_out') or len(hostname) > 1:
+            return self.fan_out(hostname, **options)
+        [hostname] = hostname
+        if not options.get('login_name') or not options.get('identity_file'):
+            raise CommandError('-l and -i are required to reboot a single host')
         validate_host(hostname)
 
-        call_args = [
-            'ssh',
-
-            '-o', 'PasswordAuthentication=no',
-            '-o', 'ServerAliveInterval=2',
-            '-o', 'LogLevel=ERROR',
-
-            # disable host key checks
-            '-o', 'StrictHostKeyChecking=no',
-            '-o', 'UserKnownHostsFile=/dev/null',
+        connect_timeout = options.get('connect_timeout') or settings.SSH_CONNECT_TIMEOUT
 
-            '-i', options['identity_file'],
-            '-l', options['login_name'],
-            '-p', str(options['port']),
-            hostname,
-        ]
+        call_args = ssh_args(hostname, options['login_name'], options['identity_file'], options['port'],
+                             connect_timeout)
         logger.debug('ssh reboot with base args: {}'.format(' '.join(call_args)))
 
-        # By trying a few different reboot commands we don't need to special case
-        # different types of hosts. The "shutdown" command is for Windows, but uses
-        # hyphens because it gets run through a bash shell. We also delay the
-        # shutdown for a few seconds so that we have time to read the exit status
-        # of the shutdown command.
-        for reboot_cmd in ['reboot', 'shutdown -f -t 3 -r']:
+        # Later commands go over the connection the first one opens.
+        overridden = bool(options.get('os_family') or options.get('reboot_command'))
+        candidates = reboot_candidates(hostname, options.get('os_family'), options.get('reboot_command'))
+        for index, (os_family, reboot_cmd) in enumerate(candidates):
             try:
-                return subprocess.check_output(call_args + [reboot_cmd],
-                                               stderr=subprocess.STDOUT,
-                                               encoding='utf-8',
-                                               timeout=options['timeout'])
+                output = subprocess.check_output(call_args + [reboot_cmd],
+                                                 stderr=subprocess.STDOUT,
+                                                 encoding='utf-8',
+                                                 timeout=connect_timeout + options['timeout'])
             except subprocess.CalledProcessError as error:
                 logger.info('{} ssh reboot with command {} failed: {}'.format(hostname, reboot_cmd, error))
+                if error.returncode == 255 and CONNECT_ERROR_RE.search(error.output or ''):
+                    raise CommandError('{} ssh connection failed: {}'.format(
+                        hostname, ' '.join(error.output.split())))
+                if index == 0 and not overridden:
+                    # it may be the remembered command, which no longer works
+                    forget(hostname)
+                continue
+
+            if not overridden:
+                remember(hostname, os_family, reboot_cmd)
+            # the host is going down, don't leave its master connection around
+            self.close_master(call_args)
+            return output
 
         raise CommandError('{} All ssh reboot commands failed.'.format(hostname))
+
+    def fan_out(self, hostnames, **options):
+        """Returns the fan_out results of hostnames as one JSON object per line."""
+        results = fan_out(hostnames,
+                          max_concurrency=options.get('max_concurrency'),
+                          login_name=options.get('login_name'),
+                          identity_file=options.get('identity_file'),
+                          port=options.get('port'),
+                          timeout=options.get('timeout'),
+                          connect_timeout=options.get('connect_timeout'),
+                          os_family=options.get('os_family'),
+                          reboot_command=options.get('reboot_command'))
+        return ''.join(json.dumps(result, sort_keys=True) + '\n' for result in results)
+
+    def close_master(self, call_args):
+        try:
+            subprocess.check_output(call_args[:-1] + ['-O', 'exit', call_args[-1]],
+                                    stderr=subprocess.STDOUT,
+                                    encoding='utf-8',
+                                    timeout=5)
+        except Exception as e:
+            logger.debug('Could not close the ssh master connection: %s', e)
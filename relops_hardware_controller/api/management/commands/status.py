@@ -0,0 +1,100 @@
+import json
+import logging
+import time
+from io import StringIO
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from django.conf import settings
+from django.core.management import (
+    call_command,
+    load_command_class,
+)
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+
+from relops_hardware_controller.api import (
+    pdu_cache,
+    power_cache,
+)
+from relops_hardware_controller.api.ipmi_config import get_ipmi_target
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_pdu_port(hostname):
+    """Returns the (pdu, port) of hostname's server entry or None."""
+    servers = settings.WORKER_CONFIG.get('servers', {})
+    server = servers.get(hostname.split('.')[0], servers.get(hostname, {}))
+    if 'pdu' not in server:
+        return None
+    return tuple(server['pdu'].rsplit(':', 1))
+
+
+class Command(BaseCommand):
+    help = ('Prints the chassis or outlet power state of a host cached by the power sweep. '
+            'Asks the BMC or PDU when the cached state is older than max age.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'hostname',
+            type=str,
+            help='A TC worker ID')
+
+        parser.add_argument('job_data', type=json.loads, nargs='?', default={})
+
+        parser.add_argument(
+            '--max-age',
+            dest='max_age',
+            type=int,
+            default=None,
+            help='seconds a cached power state is served, 0 always asks the BMC '
+                 '(default job_data max_age or POWER_STATUS_MAX_AGE)')
+
+    def handle(self, hostname, job_data=None, *args, **options):
+        max_age = options.get('max_age')
+        if max_age is None:
+            max_age = (job_data or {}).get('max_age', settings.POWER_STATUS_MAX_AGE)
+
+        try:
+            get_ipmi_target(hostname)
+        except KeyError as e:
+            pdu_port = get_pdu_port(hostname)
+            if pdu_port is None:
+                raise CommandError('No IPMI or PDU config for {}: {}'.format(hostname, e))
+            return self.outlet_status(*pdu_port, max_age=int(max_age))
+
+        entry = power_cache.get(hostname)
+        if entry is None or time.time() - entry['checked'] > int(max_age):
+            logger.debug('Reading power status of %s from its BMC', hostname)
+            try:
+                ipmi_cls = load_command_class('relops_hardware_controller.api', 'ipmi')
+                result = call_command(ipmi_cls, hostname, 'ipmi_status', stdout=StringIO())
+            except SoftTimeLimitExceeded as e:
+                raise e
+            except Exception as e:
+                result = e
+            entry = power_cache.store({hostname: result})[hostname]
+
+        return power_cache.format_entry(entry) + '\n'
+
+    def outlet_status(self, pdu, port, max_age):
+        snmp = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+        index = snmp.outlet_index(port)
+        entry = pdu_cache.get(pdu, index)
+        if entry is None or time.time() - entry['checked'] > max_age:
+            # one walk caches every outlet of the PDU for the hosts next to this one
+            logger.debug('Reading the outlet table of %s', pdu)
+            try:
+                entry = snmp.walk_outlets(pdu).get(index)
+            except SoftTimeLimitExceeded as e:
+                raise e
+            except Exception as e:
+                return 'Outlet Power unknown, error: {}: {}\n'.format(e.__class__.__name__, e)
+            if entry is None:
+                return 'Outlet Power unknown, no outlet {} on {}\n'.format(index, pdu)
+
+        return pdu_cache.format_entry(entry) + '\n'
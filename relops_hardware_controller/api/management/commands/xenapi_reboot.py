@@ -1,6 +1,8 @@
 
+import atexit
 import contextlib
 import logging
+import threading
 import time
 
 import relops_hardware_controller.XenAPI as XenAPI
@@ -8,22 +10,179 @@ import relops_hardware_controller.XenAPI as XenAPI
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from relops_hardware_controller.api import power_timer
+
 
 logger = logging.getLogger(__name__)
 
+# seconds to wait for the VM to halt once its shutdown returned
+HALT_TIMEOUT = 60
+
+
+class SessionPool:
+    """Keeps logged in XenAPI sessions per server and user for reuse.
+
+    A login costs the login RPC and four more reading the pool master's
+    API version, so a reboot on a pooled session only makes its VM
+    calls. A session serves one job at a time, concurrent jobs log in
+    sessions of their own which are kept as well. Sessions idle for more
+    than max_idle seconds are logged out, and XenAPI.Session logs in
+    again by itself when xapi answers SESSION_INVALID.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def acquire(self, uri, username, password, max_idle):
+        """Returns an idle session for uri and username or a new one
+        logged in with password.
+        """
+        key = (uri, username)
+        stale = []
+        session = None
+        with self.lock:
+            idle = self.sessions.get(key, [])
+            while idle and session is None:
+                session, last_used = idle.pop()
+                if session.last_login_params[1:2] != (password,) or time.time() - last_used > max_idle:
+                    stale.append(session)
+                    session = None
+        for old in stale:
+            self.logout(old)
+
+        if session is not None:
+            logger.debug('Reusing XenAPI session with %s', uri)
+            return session
+        session = XenAPI.Session(uri=uri, timeout=settings.XEN_TIMEOUT)
+        session.login_with_password(username, password)
+        return session
+
+    def release(self, uri, username, session):
+        """Keeps session for the next acquire if it is logged in."""
+        if session.handle is None:
+            return
+        with self.lock:
+            self.sessions.setdefault((uri, username), []).append((session, time.time()))
+
+    def logout(self, session):
+        try:
+            session.xenapi.session.logout()
+        except Exception as e:
+            logger.debug('Could not log out of XenAPI session: %s', e)
+
+    def close_all(self):
+        with self.lock:
+            sessions = [session for idle in self.sessions.values() for session, _ in idle]
+            self.sessions = {}
+        for session in sessions:
+            self.logout(session)
+
+
+pool = SessionPool()
+atexit.register(pool.close_all)
+
 
 @contextlib.contextmanager
 def xen_session(api_server_uri, username, password):
-    session = XenAPI.Session(uri=api_server_uri)
+    """Yields a logged in XenAPI session, a pooled one unless
+    XEN_SESSION_IDLE is 0. A session failing with anything but a
+    XenAPI.Failure, e.g. a connection error, is dropped instead of
+    logged out since that could hang as well.
+    """
+    if settings.XEN_SESSION_IDLE <= 0:
+        session = XenAPI.Session(uri=api_server_uri, timeout=settings.XEN_TIMEOUT)
+        try:
+            session.login_with_password(username, password)
+        except Exception as error:
+            logger.info('Error logging into XenAPI session %s', error)
+
+        try:
+            yield session
+        finally:
+            session.xenapi.session.logout()
+        return
+
     try:
-        session.login_with_password(username, password)
-    except Exception as error:
+        session = pool.acquire(api_server_uri, username, password, settings.XEN_SESSION_IDLE)
+    except XenAPI.Failure as error:
         logger.info('Error logging into XenAPI session %s', error)
-
+        raise error
     try:
         yield session
-    finally:
-        session.xenapi.session.logout()
+    except XenAPI.Failure:
+        # xapi answered so the session is still good
+        pool.release(api_server_uri, username, session)
+        raise
+    else:
+        pool.release(api_server_uri, username, session)
+
+
+class VmEvents(object):
+    """Follows the record of a VM and the guest metrics xapi keeps for its
+    guest agent through event.from, which blocks until something changed
+    or its timeout passed.
+
+    The first event.from returns the VM record as it is. Later ones also
+    subscribe to guest metrics, so only the ones updated since then show
+    up and metrics of the previous boot do not count as a ready guest.
+    """
+
+    # longest single event.from, well below the XEN_TIMEOUT of the connection
+    poll = 30
+
+    def __init__(self, session, vm):
+        self.event_from = getattr(session.xenapi.event, 'from')
+        self.vm = vm
+        self.token = ''
+        self.record = None
+        self.guest_metrics = {}
+
+    def next(self, timeout):
+        classes = ['VM/{}'.format(self.vm)]
+        if self.token:
+            classes.append('VM_guest_metrics')
+        result = self.event_from(classes, self.token, float(timeout))
+        self.token = result['token']
+        for event in result['events']:
+            if event['class'].lower() == 'vm' and event['ref'] == self.vm:
+                self.record = event.get('snapshot', self.record)
+            elif event['class'].lower() == 'vm_guest_metrics':
+                if event['operation'] == 'del':
+                    self.guest_metrics.pop(event['ref'], None)
+                else:
+                    self.guest_metrics[event['ref']] = event['snapshot']
+
+    def wait(self, ready, timeout):
+        """Returns True as soon as ready() is, False after timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            self.next(max(0, min(remaining, self.poll)))
+            if self.record is not None and ready():
+                return True
+            if remaining <= 0:
+                return False
+
+    def power_state(self):
+        return self.record['power_state']
+
+    def forget_guest(self):
+        """Drops the guest metrics seen so far, e.g. before starting the VM."""
+        self.guest_metrics = {}
+
+    def guest(self):
+        """Returns the guest metrics of the running VM updated since
+        forget_guest or None.
+        """
+        if self.power_state() != 'Running':
+            return None
+        return self.guest_metrics.get(self.record['guest_metrics'])
+
+
+def guest_addresses(guest_metrics):
+    """Returns the addresses a guest agent reports, e.g. ['10.0.0.5']."""
+    return sorted(set(guest_metrics.get('networks', {}).values()))
 
 
 class Command(BaseCommand):
@@ -44,10 +203,29 @@ class Command(BaseCommand):
         parser.add_argument(
             '--delay',
             dest='delay',
-            default=5,
+            default=0,
             type=int,
             help='Wait N seconds before turning the power back on.',
         )
+        parser.add_argument(
+            '--guest-timeout',
+            dest='guest_timeout',
+            default=None,
+            type=int,
+            help='Wait up to N seconds for the guest agent to report after starting the VM, '
+            '0 to not wait. Defaults to XEN_GUEST_TIMEOUT.',
+        )
+
+    def power_on(self, host_uuid):
+        """Starts the VM for a power_timer entry unless it already runs."""
+        with xen_session(settings.XEN_URL,
+                         settings.XEN_USERNAME,
+                         settings.XEN_PASSWORD) as session:
+            vm = session.xenapi.VM.get_by_uuid(host_uuid)
+            if session.xenapi.VM.get_power_state(vm) == 'Running':
+                logger.info("xen VM %s is already running.", vm)
+                return
+            session.xenapi.VM.start(vm, False, False)
 
     def handle(self, host_uuid, *args, **options):
         logger.info("Powercycling %s via XenAPI.", host_uuid)
@@ -66,9 +244,35 @@ class Command(BaseCommand):
                 session.xenapi.VM.hard_shutdown(vm)  # if this fails it raises and error and we logout
                 logger.debug("hard shutdown of xen VM %s complete.", vm)
 
-            logger.debug("Power is off, waiting %d seconds before turning it back on.", options['delay'])
-            time.sleep(options['delay'])
+            if options['delay'] > settings.POWER_ON_INLINE_DELAY:
+                power_timer.schedule_on('xenapi_reboot', host_uuid, options['delay'])
+                logger.info("xen VM %s is off, start scheduled in %d seconds.", vm, options['delay'])
+                return
+
+            events = VmEvents(session, vm)
+            if not events.wait(lambda: events.power_state() == 'Halted', HALT_TIMEOUT):
+                raise Exception('xen VM {} is {} after shutting it down.'.format(host_uuid, events.power_state()))
+
+            if options['delay'] > 0:
+                logger.debug("Power is off, waiting %d seconds before turning it back on.", options['delay'])
+                time.sleep(options['delay'])
 
+            events.forget_guest()
+            started = time.time()
             session.xenapi.VM.start(vm, False, False)
             logger.info("Powercycle of %s completed.", host_uuid)
-            # TODO: poll for VM_guest_metrics?
+
+            guest_timeout = options['guest_timeout']
+            if guest_timeout is None:
+                guest_timeout = settings.XEN_GUEST_TIMEOUT
+            if guest_timeout <= 0:
+                return 'xen VM {} started'.format(host_uuid)
+            try:
+                ready = events.wait(lambda: events.guest() is not None, guest_timeout)
+            except XenAPI.Failure as error:
+                logger.info("Could not follow the guest of xen VM %s: %s", host_uuid, error)
+                return 'xen VM {} started'.format(host_uuid)
+            if not ready:
+                return 'xen VM {} started, guest agent not reporting after {}s'.format(host_uuid, guest_timeout)
+            return 'xen VM {} started, guest ready after {:.0f}s {}'.format(
+                host_uuid, time.time() - started, ' '.join(guest_addresses(events.guest()))).rstrip()
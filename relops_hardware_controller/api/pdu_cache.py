@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Sentry outlet status and load of PDU-powered hosts cached in Redis.
+
+snmp_reboot stores the outlet it just switched, and the power sweep
+stores every outlet of a PDU from one walk of its outlet table, so the
+status command and the PduVerifier can answer without an SNMP round
+trip. Outlets are keyed by PDU and the tower.infeed.outlet index of the
+Sentry outletTable.
+"""
+
+import time
+
+from django.core.cache import cache
+
+
+KEY = 'pdu:{}:{}'
+TIMEOUT = 60 * 60 * 24
+
+
+def outlet_power(status):
+    """Returns 'on', 'off' or None for a Sentry outletStatus name."""
+    if status in ('off', 'onWait', 'offWait'):
+        return 'off'
+    return 'on' if status == 'on' else None
+
+
+def make_entry(status, load):
+    """Returns the cache entry for an outletStatus name and an
+    outletLoadValue in hundredths of amps, negative when not measured.
+    """
+    load = load / 100.0 if load is not None and load >= 0 else None
+    return dict(status=status, power=outlet_power(status), load=load, checked=time.time())
+
+
+def store(pdu, outlets):
+    """Caches a dict of outlet index to (status, load) for pdu. Returns
+    the dict of outlet index to cache entry.
+    """
+    entries = {index: make_entry(status, load) for index, (status, load) in outlets.items()}
+    cache.set_many({KEY.format(pdu, index): entry for index, entry in entries.items()}, TIMEOUT)
+    return entries
+
+
+def get(pdu, index):
+    """Returns the cached entry of the outlet or None."""
+    return cache.get(KEY.format(pdu, index))
+
+
+def format_entry(entry):
+    age = max(0, time.time() - entry['checked'])
+    load = '' if entry['load'] is None else ', {:.2f}A'.format(entry['load'])
+    if entry['power'] is not None:
+        return 'Outlet Power is {} ({}{}, checked {:.0f}s ago)'.format(entry['power'], entry['status'], load, age)
+    return 'Outlet Power unknown, {}{} (checked {:.0f}s ago)'.format(entry['status'], load, age)
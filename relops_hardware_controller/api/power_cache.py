@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Chassis power state of IPMI hosts cached in Redis.
+
+The sweep_power_status task stores the ipmi_status result of every host
+in the IPMI table every POWER_SWEEP_INTERVAL seconds, so the status
+command can answer without a BMC round trip.
+"""
+
+import time
+
+from django.core.cache import cache
+
+from .management.commands.ipmitool import (
+    POWER_RE,
+    IpmiCommandError,
+)
+
+
+KEY = 'power:{}'
+TIMEOUT = 60 * 60 * 24
+
+
+def _host(hostname):
+    return hostname.split('.')[0]
+
+
+def make_entry(result):
+    """Returns the cache entry for the ipmi_status output or exception."""
+    power = None
+    if isinstance(result, IpmiCommandError):
+        status, detail = result.status, ' '.join((result.result.output or '').split())
+    elif isinstance(result, Exception):
+        status, detail = 'error', '{}: {}'.format(result.__class__.__name__, result)
+    elif result is None:
+        status, detail = 'timeout', ''
+    else:
+        match = POWER_RE.search(result)
+        power = match.group(1) if match else None
+        status, detail = 'ok' if match else 'unknown', result.strip()
+    return dict(power=power, status=status, detail=detail, checked=time.time())
+
+
+def store(results):
+    """Caches a dict of hostname to ipmi_status output or exception.
+    Returns the dict of hostname to cache entry.
+    """
+    entries = {hostname: make_entry(result) for hostname, result in results.items()}
+    cache.set_many({KEY.format(_host(hostname)): entry for hostname, entry in entries.items()}, TIMEOUT)
+    return entries
+
+
+def get(hostname):
+    """Returns the cached entry of hostname or None."""
+    return cache.get(KEY.format(_host(hostname)))
+
+
+def format_entry(entry):
+    age = max(0, time.time() - entry['checked'])
+    if entry['power'] is not None:
+        return 'Chassis Power is {} (checked {:.0f}s ago)'.format(entry['power'], age)
+    return 'Chassis Power unknown, {}: {} (checked {:.0f}s ago)'.format(entry['status'], entry['detail'], age)
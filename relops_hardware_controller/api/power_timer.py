@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Delayed power-on after a hard power cycle.
+
+Instead of sleeping between cutting and restoring power, snmp_reboot,
+ilo_reboot and xenapi_reboot cut it and schedule the power-on in a
+Redis sorted set scored by its due time. The power_on_due task runs the
+due entries. It is queued with a countdown of the delay and also sent
+by celery beat every POWER_ON_TICK seconds, so an entry whose countdown
+task was lost with a worker still runs.
+
+An entry stays in the set until its command's power_on succeeds. Running
+it leases the entry for POWER_ON_LEASE seconds, so a failed or
+interrupted power-on is tried again and a host is not left off.
+"""
+
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management import load_command_class
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from ..celery import app
+
+
+logger = logging.getLogger(__name__)
+
+DUE_KEY = 'power:on:due'
+TASK_NAME = 'relops_hardware_controller.api.tasks.power_on_due'
+
+# entries failing for longer than this are dropped
+GIVE_UP_AFTER = 60 * 60 * 24
+
+
+def schedule_on(command, target, delay, **params):
+    """Schedules command's power_on(target, **params) in delay seconds.
+    Returns the entry id.
+    """
+    entry = dict(id=uuid.uuid4().hex, command=command, target=target, params=params, created=time.time())
+    get_redis_connection('default').zadd(DUE_KEY, **{json.dumps(entry, sort_keys=True): time.time() + delay})
+    logger.info('Scheduled %s power on of %s in %ds', command, target, delay)
+    app.send_task(TASK_NAME, countdown=delay)
+    return entry['id']
+
+
+def pending():
+    """Returns the scheduled entries with their due time as 'due'."""
+    entries = []
+    for member, due in get_redis_connection('default').zrange(DUE_KEY, 0, -1, withscores=True):
+        entry = json.loads(member.decode('utf-8'))
+        entry['due'] = due
+        entries.append(entry)
+    return entries
+
+
+def _claim(redis, member, now):
+    """Moves a due entry's score past the lease. Returns False when it is
+    not due any more, e.g. another worker claimed it.
+    """
+    with redis.pipeline() as pipe:
+        try:
+            pipe.watch(DUE_KEY)
+            due = pipe.zscore(DUE_KEY, member)
+            if due is None or due > now:
+                return False
+            pipe.multi()
+            pipe.zadd(DUE_KEY, **{member: now + settings.POWER_ON_LEASE})
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+def run_due(now=None):
+    """Runs the power-on of every due entry. Returns the number of
+    entries that powered on.
+    """
+    redis = get_redis_connection('default')
+    now = time.time() if now is None else now
+    done = 0
+    for member in redis.zrangebyscore(DUE_KEY, 0, now):
+        member = member.decode('utf-8')
+        if not _claim(redis, member, now):
+            continue
+        entry = json.loads(member)
+        try:
+            command = load_command_class('relops_hardware_controller.api', entry['command'])
+            command.power_on(entry['target'], **entry['params'])
+        except Exception as e:
+            if now - entry['created'] > GIVE_UP_AFTER:
+                logger.error('Giving up powering on %s via %s: %s', entry['target'], entry['command'], e)
+                redis.zrem(DUE_KEY, member)
+            else:
+                logger.warning('Powering on %s via %s failed, retrying in %ds: %s',
+                               entry['target'], entry['command'], settings.POWER_ON_LEASE, e)
+            continue
+        redis.zrem(DUE_KEY, member)
+        logger.info('Powered on %s via %s', entry['target'], entry['command'])
+        done += 1
+    return done
@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import (
+    call_command,
+    load_command_class,
+)
+import hpilo
+
+from .management.commands.ipmi import lookup as ipmi_lookup
+from .management.commands.xenapi_reboot import xen_session
+
+
+logger = logging.getLogger(__name__)
+
+
+Capability = collections.namedtuple('Capability', ['usable', 'detail', 'elapsed'])
+
+# RMCP/ASF presence ping: RMCP v1.0 header (no ack, ASF class) then an ASF
+# message with the IANA enterprise number 4542, type 0x80 and no data.
+# https://www.dmtf.org/sites/default/files/standards/documents/DSP0136.pdf
+RMCP_PRESENCE_PING = b'\x06\x00\xff\x06\x00\x00\x11\xbe\x80%c\x00\x00'
+RMCP_PRESENCE_PONG = 0x40
+
+
+def rmcp_ping(host, port=623, timeout=2):
+    """Returns True if the BMC at host answers an RMCP presence ping."""
+    tag = os.urandom(1)[0]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(RMCP_PRESENCE_PING % tag, (host, port))
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data, _ = sock.recvfrom(512)
+            if len(data) >= 10 and data[8] == RMCP_PRESENCE_PONG and data[9] == tag:
+                return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return False
+
+
+def probe_ssh(hostname, server):
+    with socket.create_connection((hostname, 22), timeout=settings.PREFLIGHT_TIMEOUT):
+        return 'sshd listening'
+
+
+def probe_ipmi(hostname, server):
+    bmc, _, _, _, _ = ipmi_lookup(hostname, 'ipmi_status')
+    if not rmcp_ping(bmc, timeout=settings.PREFLIGHT_TIMEOUT):
+        raise Exception('BMC {} did not answer RMCP ping'.format(bmc))
+
+    # a session proves the credentials too
+    ipmi_cls = load_command_class('relops_hardware_controller.api', 'ipmi')
+    output = call_command(ipmi_cls, hostname, 'ipmi_status', stdout=StringIO()) or ''
+    if 'Chassis Power is' not in output:
+        raise Exception('BMC {} refused chassis power status'.format(bmc))
+    return output.strip()
+
+
+def probe_pdu(hostname, server):
+    pdu, port = server['pdu'].rsplit(':', 1)
+    snmp = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+    status = snmp.get_outlet_status(pdu, port, timeout=settings.PREFLIGHT_TIMEOUT)
+    if status in (None, 'noComm'):
+        raise Exception('PDU {} outlet {} status {}'.format(pdu, port, status))
+    return 'outlet {}'.format(status)
+
+
+def probe_ilo(hostname, server):
+    ilo = hpilo.Ilo(server['ilo'][0],
+                    login=settings.ILO_USERNAME,
+                    password=settings.ILO_PASSWORD,
+                    timeout=settings.PREFLIGHT_TIMEOUT)
+    return 'power {}'.format(ilo.get_host_power_status())
+
+
+def probe_xen(hostname, server):
+    host_uuid = server['xen']['reboot'][0]
+    with xen_session(settings.XEN_URL, settings.XEN_USERNAME, settings.XEN_PASSWORD) as session:
+        vm = session.xenapi.VM.get_by_uuid(host_uuid)
+        return 'VM {}'.format(session.xenapi.VM.get_power_state(vm))
+
+
+# reboot methods sharing a management path share one probe
+PATHS = {
+    'ssh_reboot': 'ssh',
+    'ipmi_on': 'ipmi',
+    'ipmi_reset': 'ipmi',
+    'ipmi_cycle': 'ipmi',
+    'ipmi_ensure_on': 'ipmi',
+    'ipmi_smart_reboot': 'ipmi',
+    'snmp_reboot': 'pdu',
+    'snmp_rebootdelay': 'pdu',
+    'ilo_reboot': 'ilo',
+    'xenapi_reboot': 'xen',
+}
+
+PROBES = {
+    'ssh': probe_ssh,
+    'ipmi': probe_ipmi,
+    'pdu': probe_pdu,
+    'ilo': probe_ilo,
+    'xen': probe_xen,
+}
+
+
+def _run_probe(path, hostname, server):
+    start = time.time()
+    try:
+        detail = PROBES[path](hostname, server)
+        usable = True
+    except KeyError as e:
+        detail = 'no {} config'.format(e)
+        usable = False
+    except Exception as e:
+        detail = '{}: {}'.format(e.__class__.__name__, e)
+        usable = False
+    logger.info('preflight %s %s for %s: %s', path, 'ok' if usable else 'failed', hostname, detail)
+    return Capability(usable, detail, time.time() - start)
+
+
+def preflight(hostname, server, reboot_methods):
+    """Probes every management path used by reboot_methods concurrently.
+
+    Returns a dict of reboot method to Capability. Methods without a
+    management path (e.g. file_bugzilla_bug) are always usable.
+    """
+    paths = set(PATHS[method] for method in reboot_methods if method in PATHS)
+    results = {}
+    if paths:
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            futures = {path: executor.submit(_run_probe, path, hostname, server) for path in paths}
+            results = {path: future.result() for path, future in futures.items()}
+
+    return collections.OrderedDict(
+        (method, results[PATHS[method]] if method in PATHS else Capability(True, 'not probed', 0))
+        for method in reboot_methods
+    )
+
+
+def format_preflight(capabilities):
+    return ', '.join('{} {} ({})'.format(method, 'ok' if capability.usable else 'skipped', capability.detail)
+                     for method, capability in capabilities.items())
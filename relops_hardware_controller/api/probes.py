@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import socket
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from io import StringIO
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from django.conf import settings
+from django.core.management import (
+    call_command,
+    load_command_class,
+)
+import taskcluster
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpCheck:
+    """A readiness probe for declaring a rebooted host up.
+
+    snapshot() is called before the power action and is_up() is polled
+    after the host went down. is_up() returns True only on a definitive
+    signal that the host is usable.
+    """
+
+    def __init__(self, fqdn, job_data):
+        self.fqdn = fqdn
+        self.job_data = job_data
+
+    def snapshot(self):
+        pass
+
+    def is_up(self):
+        raise NotImplementedError()
+
+    def dump(self):
+        """Returns the snapshot state as a JSON-serializable dict."""
+        return {key: value for key, value in vars(self).items() if key not in ('fqdn', 'job_data')}
+
+    def load(self, state):
+        vars(self).update(state)
+
+
+class PingCheck(UpCheck):
+
+    def is_up(self):
+        ping_cls = load_command_class('relops_hardware_controller.api', 'ping')
+        try:
+            call_command(ping_cls, self.fqdn, 'ping', '-c', 1, '-w', settings.UP_CHECK_TIMEOUT, stdout=StringIO())
+            return True
+        except SoftTimeLimitExceeded as e:
+            raise e
+        except Exception:
+            return False
+
+
+class TcpCheck(UpCheck):
+    """Up once a TCP connect to port succeeds e.g. sshd or RDP listening."""
+
+    def __init__(self, fqdn, job_data, port):
+        super().__init__(fqdn, job_data)
+        self.port = port
+
+    def is_up(self):
+        try:
+            with socket.create_connection((self.fqdn, self.port), timeout=settings.UP_CHECK_TIMEOUT):
+                return True
+        except OSError:
+            return False
+
+
+class TaskclusterQueueCheck(UpCheck):
+    """Up once the worker has claimed a new task from the Taskcluster queue."""
+
+    def __init__(self, fqdn, job_data):
+        super().__init__(fqdn, job_data)
+        self.latest_task = None
+
+    def _worker_args(self):
+        args = [self.job_data.get(key, '') for key in
+                ['provisioner_id', 'worker_type', 'worker_group', 'worker_id']]
+        if not all(args) or args[2] == 'none':
+            return None
+        return args
+
+    def _latest_task(self):
+        worker = taskcluster.Queue().getWorker(*self._worker_args())
+        recent_tasks = worker.get('recentTasks', [])
+        return recent_tasks[-1] if recent_tasks else None
+
+    def snapshot(self):
+        if self._worker_args() is None:
+            return
+        try:
+            self.latest_task = self._latest_task()
+        except Exception as e:
+            logger.info('Could not get taskcluster worker %s: %s', self.job_data['worker_id'], e)
+
+    def is_up(self):
+        if self._worker_args() is None:
+            return False
+        try:
+            latest_task = self._latest_task()
+        except Exception as e:
+            logger.info('Could not get taskcluster worker %s: %s', self.job_data['worker_id'], e)
+            return False
+        return latest_task is not None and latest_task != self.latest_task
+
+
+UP_CHECKS = {
+    'ping': PingCheck,
+    'ssh': lambda fqdn, job_data: TcpCheck(fqdn, job_data, 22),
+    'rdp': lambda fqdn, job_data: TcpCheck(fqdn, job_data, 3389),
+    'taskcluster': TaskclusterQueueCheck,
+}
+
+
+def get_up_checks(fqdn, job_data):
+    """Returns the UpChecks named in settings.UP_CHECKS."""
+    return [UP_CHECKS[name](fqdn, job_data or {}) for name in settings.UP_CHECKS]
+
+
+def any_up(checks):
+    """Runs checks concurrently and returns True on the first check that
+    reports the host up, or False once every check has said no.
+    """
+    if not checks:
+        return False
+
+    executor = ThreadPoolExecutor(max_workers=len(checks))
+    try:
+        pending = {executor.submit(check.is_up): check for check in checks}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                check = pending.pop(future)
+                if future.result():
+                    logger.info('%s is up according to %s', check.fqdn, check.__class__.__name__)
+                    return True
+        return False
+    finally:
+        # don't wait on slower probes once one has answered
+        executor.shutdown(wait=False)
@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""System event log entries of IPMI hosts cached in Redis.
+
+Each host has a cursor holding the record id of the newest SEL entry
+seen, so a refresh only fetches the entries after it, and a ring of the
+last IPMI_SEL_RING entries formatted like `ipmitool sel list` lines that
+can be read without asking the BMC.
+"""
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+CURSOR_KEY = 'ipmi:sel:cursor:{}'
+RING_KEY = 'ipmi:sel:ring:{}'
+
+
+def _host(hostname):
+    return hostname.split('.')[0]
+
+
+def record_id(line):
+    """Returns the record id of a `sel list` line or None for other lines."""
+    try:
+        return int(line.split('|')[0], 16)
+    except ValueError:
+        return None
+
+
+def get_cursors(hostnames):
+    """Returns the record id of the newest entry seen for each hostname,
+    None for hosts without one.
+    """
+    if not hostnames:
+        return []
+    values = get_redis_connection('default').mget([CURSOR_KEY.format(_host(hostname)) for hostname in hostnames])
+    return [None if value is None else int(value) for value in values]
+
+
+def new_lines(lines, cursor):
+    """Returns the `sel list` lines following record id cursor, all of
+    them when the cursor is not among them.
+    """
+    ids = [record_id(line) for line in lines]
+    if cursor in ids:
+        lines = lines[len(ids) - ids[::-1].index(cursor):]
+    return [line for line in lines if record_id(line) is not None]
+
+
+def store(hostname, lines):
+    """Appends new `sel list` lines to hostname's ring and moves its cursor."""
+    if not lines:
+        return
+    host = _host(hostname)
+    pipe = get_redis_connection('default').pipeline()
+    pipe.rpush(RING_KEY.format(host), *lines)
+    pipe.ltrim(RING_KEY.format(host), -settings.IPMI_SEL_RING, -1)
+    pipe.set(CURSOR_KEY.format(host), record_id(lines[-1]))
+    pipe.execute()
+
+
+def cached(hostname, last=None):
+    """Returns the cached `sel list` lines of hostname, only the newest
+    last if set.
+    """
+    start = -last if last else 0
+    lines = get_redis_connection('default').lrange(RING_KEY.format(_host(hostname)), start, -1)
+    return [line.decode('utf-8') for line in lines]
@@ -37,3 +37,31 @@ class JobSerializer(serializers.Serializer):
         r'^({})$'.format('|'.join(settings.TASK_NAMES)),
         required=True)
 
+    # seconds a cached result may be old, e.g. the swept power state for status
+    max_age = serializers.IntegerField(
+        min_value=0,
+        required=False)
+
+
+class BulkJobSerializer(serializers.Serializer):
+    task_id = serializers.UUIDField(
+        format='hex_verbose',
+        required=False)
+
+    http_origin = serializers.CharField(
+        allow_blank=True,
+        required=False)
+
+    client_id = serializers.RegexField(
+        r'^(mozilla.*)$',
+        required=False)
+
+    worker_ids = serializers.ListField(
+        child=serializers.CharField(max_length=128, min_length=1),
+        min_length=1,
+        required=True)
+
+    # what task to run on every machine
+    task_name = serializers.RegexField(
+        r'^({})$'.format('|'.join(settings.BULK_TASK_NAMES)),
+        required=True)
@@ -0,0 +1,678 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Async SNMP client.
+
+Encodes SNMPv2c and SNMPv3 (USM with HMAC-MD5-96/HMAC-SHA-96 and
+DES/AES-128 privacy) GET, GETBULK and SET requests directly over UDP,
+so a PDU outlet can be switched or its outlet table walked without
+forking snmpset.
+
+https://tools.ietf.org/html/rfc3416
+https://tools.ietf.org/html/rfc3414
+https://tools.ietf.org/html/rfc3826
+"""
+
+import asyncio
+import collections
+import hashlib
+import hmac
+import logging
+import random
+import struct
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import (
+    Cipher,
+    algorithms,
+    modes,
+)
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+SNMP_PORT = 161
+
+VERSION_2C = 1
+VERSION_3 = 3
+
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_IP_ADDRESS = 0x40
+TAG_COUNTER32 = 0x41
+TAG_GAUGE32 = 0x42
+TAG_TIMETICKS = 0x43
+TAG_OPAQUE = 0x44
+TAG_COUNTER64 = 0x46
+TAG_NO_SUCH_OBJECT = 0x80
+TAG_NO_SUCH_INSTANCE = 0x81
+TAG_END_OF_MIB_VIEW = 0x82
+
+PDU_GET = 0xa0
+PDU_GET_NEXT = 0xa1
+PDU_RESPONSE = 0xa2
+PDU_SET = 0xa3
+PDU_GET_BULK = 0xa5
+PDU_REPORT = 0xa8
+
+ERROR_STATUSES = [
+    'noError', 'tooBig', 'noSuchName', 'badValue', 'readOnly', 'genErr', 'noAccess', 'wrongType',
+    'wrongLength', 'wrongEncoding', 'wrongValue', 'noCreation', 'inconsistentValue', 'resourceUnavailable',
+    'commitFailed', 'undoFailed', 'authorizationError', 'notWritable', 'inconsistentName',
+]
+
+# msgFlags
+FLAG_AUTH = 0x01
+FLAG_PRIV = 0x02
+FLAG_REPORTABLE = 0x04
+
+USM_SECURITY_MODEL = 3
+MAX_MESSAGE_SIZE = 65507
+
+# usmStats counters an agent reports instead of answering
+USM_STATS = '1.3.6.1.6.3.15.1.1.'
+USM_UNSUPPORTED_SEC_LEVELS = USM_STATS + '1.0'
+USM_NOT_IN_TIME_WINDOWS = USM_STATS + '2.0'
+USM_UNKNOWN_USER_NAMES = USM_STATS + '3.0'
+USM_UNKNOWN_ENGINE_IDS = USM_STATS + '4.0'
+USM_WRONG_DIGESTS = USM_STATS + '5.0'
+USM_DECRYPTION_ERRORS = USM_STATS + '6.0'
+
+AUTH_PROTOCOLS = {
+    'MD5': hashlib.md5,
+    'SHA': hashlib.sha1,
+}
+PRIV_PROTOCOLS = ['DES', 'AES']
+AUTH_PARAMS_LENGTH = 12
+
+
+class SnmpError(Exception):
+    """An SNMP request failed. status is the agent's error-status name if
+    it answered with one and oid the varbind it blamed.
+    """
+
+    def __init__(self, message, status=None, oid=None):
+        super().__init__(message)
+        self.status = status
+        self.oid = oid
+
+
+class SnmpAuthError(SnmpError):
+    """The agent refused the SNMPv3 user or its keys."""
+
+
+class SnmpTimeoutError(SnmpError):
+    """The agent did not answer, e.g. a wrong v2c community string."""
+
+
+# varbind values without a python equivalent
+NoSuchObject = type('NoSuchObject', (), {'__repr__': lambda self: 'noSuchObject'})()
+NoSuchInstance = type('NoSuchInstance', (), {'__repr__': lambda self: 'noSuchInstance'})()
+EndOfMibView = type('EndOfMibView', (), {'__repr__': lambda self: 'endOfMibView'})()
+
+UsmUser = collections.namedtuple('UsmUser', ['name', 'auth_protocol', 'auth_password',
+                                             'priv_protocol', 'priv_password'])
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(encoded)]) + encoded
+
+
+def tlv(tag, content):
+    return bytes([tag]) + encode_length(len(content)) + content
+
+
+def encode_integer(value, tag=TAG_INTEGER):
+    length = max(1, (value.bit_length() + 8) // 8)
+    return tlv(tag, value.to_bytes(length, 'big', signed=True))
+
+
+def encode_oid(oid):
+    parts = [int(part) for part in oid.strip('.').split('.')]
+    if len(parts) < 2:
+        raise SnmpError('Invalid OID {}'.format(oid))
+    content = bytearray()
+    for part in [parts[0] * 40 + parts[1]] + parts[2:]:
+        chunk = [part & 0x7f]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7f))
+            part >>= 7
+        content.extend(reversed(chunk))
+    return tlv(TAG_OID, bytes(content))
+
+
+def encode_value(value):
+    if value is None:
+        return tlv(TAG_NULL, b'')
+    if isinstance(value, bool):
+        raise SnmpError('Cannot encode {!r}'.format(value))
+    if isinstance(value, int):
+        return encode_integer(value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return tlv(TAG_OCTET_STRING, value)
+    raise SnmpError('Cannot encode {!r}'.format(value))
+
+
+def sequence(*items, tag=TAG_SEQUENCE):
+    return tlv(tag, b''.join(items))
+
+
+def decode_tlv(data, offset=0):
+    """Returns (tag, content, next offset) of the BER element at offset."""
+    try:
+        tag, length = data[offset], data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+    except IndexError:
+        raise SnmpError('Truncated BER element')
+    if offset + length > len(data):
+        raise SnmpError('Truncated BER element')
+    return tag, data[offset:offset + length], offset + length
+
+
+def decode_sequence(content):
+    """Returns the (tag, content) of each element in a constructed value."""
+    elements = []
+    offset = 0
+    while offset < len(content):
+        tag, value, offset = decode_tlv(content, offset)
+        elements.append((tag, value))
+    return elements
+
+
+def decode_oid(content):
+    if not content:
+        raise SnmpError('Empty OID')
+    parts = []
+    value = 0
+    for byte in content:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            parts.append(value)
+            value = 0
+    first = min(parts[0] // 40, 2)
+    parts[:1] = [first, parts[0] - 40 * first]
+    return '.'.join(str(part) for part in parts)
+
+
+def decode_value(tag, content):
+    if tag == TAG_INTEGER:
+        return int.from_bytes(content, 'big', signed=True)
+    if tag in (TAG_COUNTER32, TAG_GAUGE32, TAG_TIMETICKS, TAG_COUNTER64):
+        return int.from_bytes(content, 'big')
+    if tag in (TAG_OCTET_STRING, TAG_OPAQUE):
+        return bytes(content)
+    if tag == TAG_NULL:
+        return None
+    if tag == TAG_OID:
+        return decode_oid(content)
+    if tag == TAG_IP_ADDRESS:
+        return '.'.join(str(byte) for byte in content)
+    if tag == TAG_NO_SUCH_OBJECT:
+        return NoSuchObject
+    if tag == TAG_NO_SUCH_INSTANCE:
+        return NoSuchInstance
+    if tag == TAG_END_OF_MIB_VIEW:
+        return EndOfMibView
+    raise SnmpError('Unknown BER tag 0x{:02x}'.format(tag))
+
+
+def encode_pdu(pdu_type, request_id, varbinds, error_status=0, error_index=0):
+    """Encodes a PDU. varbinds is a list of (oid, value), for GetBulk
+    error_status and error_index are non-repeaters and max-repetitions.
+    """
+    return sequence(
+        encode_integer(request_id),
+        encode_integer(error_status),
+        encode_integer(error_index),
+        sequence(*[sequence(encode_oid(oid), encode_value(value)) for oid, value in varbinds]),
+        tag=pdu_type)
+
+
+def decode_pdu(tag, content):
+    """Returns (pdu type, request id, error status, error index, varbinds)."""
+    elements = decode_sequence(content)
+    if len(elements) != 4 or elements[3][0] != TAG_SEQUENCE:
+        raise SnmpError('Malformed PDU')
+    request_id, error_status, error_index = [decode_value(*element) for element in elements[:3]]
+    varbinds = []
+    for _, varbind in decode_sequence(elements[3][1]):
+        (oid_tag, oid), value = decode_sequence(varbind)
+        varbinds.append((decode_oid(oid), decode_value(*value)))
+    return tag, request_id, error_status, error_index, varbinds
+
+
+def password_to_key(password, auth_protocol, engine_id):
+    """Returns the key localized to engine_id for password (RFC 3414 A.2)."""
+    hash_cls = AUTH_PROTOCOLS[auth_protocol]
+    password = password.encode('utf-8')
+    if not password:
+        raise SnmpAuthError('Empty SNMPv3 password')
+    repeated = (password * (1048576 // len(password) + 1))[:1048576]
+    key = hash_cls(repeated).digest()
+    return hash_cls(key + engine_id + key).digest()
+
+
+class _Engine:
+    """The authoritative engine of an agent and the USM keys for it."""
+
+    def __init__(self, engine_id, boots, engine_time, user):
+        self.engine_id = engine_id
+        self.update(boots, engine_time)
+        self.auth_key = self.priv_key = None
+        if user.auth_protocol is not None:
+            self.auth_key = password_to_key(user.auth_password, user.auth_protocol, engine_id)
+        if user.priv_protocol is not None:
+            self.priv_key = password_to_key(user.priv_password, user.auth_protocol, engine_id)
+
+    def update(self, boots, engine_time):
+        self.boots = boots
+        self.time = engine_time
+        self.synced = asyncio.get_event_loop().time()
+
+    def now(self):
+        return self.time + int(asyncio.get_event_loop().time() - self.synced)
+
+
+class _Protocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client._received(data)
+
+    def error_received(self, exc):
+        self.client._failed(SnmpTimeoutError('{}: {}'.format(self.client.host, exc)))
+
+
+class SnmpClient:
+    """An SNMP manager for one agent.
+
+    Uses SNMPv3 when user (a UsmUser) is set, SNMPv2c with community
+    otherwise. Every request is sent up to retries + 1 times and each
+    attempt waits timeout seconds for the answer.
+    """
+
+    def __init__(self, host, community=None, user=None, port=None, timeout=2, retries=3):
+        if user is None and community is None:
+            raise SnmpError('An SNMP community or SNMPv3 user is required')
+        if user is not None:
+            if user.auth_protocol is not None and user.auth_protocol not in AUTH_PROTOCOLS:
+                raise SnmpError('Unsupported SNMPv3 auth protocol {}'.format(user.auth_protocol))
+            if user.priv_protocol is not None and (user.priv_protocol not in PRIV_PROTOCOLS or
+                                                   user.auth_protocol is None):
+                raise SnmpError('Unsupported SNMPv3 privacy protocol {}'.format(user.priv_protocol))
+        self.host = host
+        self.port = port or SNMP_PORT
+        self.community = community
+        self.user = user
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None
+        self.engine = None
+        self.waiters = {}
+        self.wrong_digests = 0
+        self.next_id = random.randint(1, 0x3fffffff)
+        self.salt = random.getrandbits(64)
+
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _Protocol(self), remote_addr=(self.host, self.port))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self._failed(SnmpError('SNMP client for {} closed'.format(self.host)))
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def get(self, *oids):
+        """Returns the [(oid, value)] of a GET for oids."""
+        return await self.request(PDU_GET, [(oid, None) for oid in oids])
+
+    async def set(self, *varbinds):
+        """SETs [(oid, value)], ints as INTEGER and str/bytes as OCTET
+        STRING. Returns the [(oid, value)] the agent answered.
+        """
+        return await self.request(PDU_SET, varbinds)
+
+    async def get_bulk(self, non_repeaters, max_repetitions, *oids):
+        """Returns the [(oid, value)] of a GETBULK for oids."""
+        return await self.request(PDU_GET_BULK, [(oid, None) for oid in oids], non_repeaters, max_repetitions)
+
+    async def walk(self, *columns, max_repetitions=25):
+        """Returns {column: [(oid, value)]} of every instance under each
+        column oid, reading all columns together with GETBULK requests.
+        """
+        results = collections.OrderedDict((column, []) for column in columns)
+        cursors = collections.OrderedDict((column, column) for column in columns)
+        while cursors:
+            active = list(cursors)
+            previous = dict(cursors)
+            answered = await self.get_bulk(0, max_repetitions, *cursors.values())
+            finished = set()
+            # the answer has up to max_repetitions rows of one varbind per column
+            for position, (oid, value) in enumerate(answered):
+                column = active[position % len(active)]
+                if column in finished:
+                    continue
+                if value is EndOfMibView or not oid.startswith(column + '.'):
+                    finished.add(column)
+                    continue
+                results[column].append((oid, value))
+                cursors[column] = oid
+            for column in active:
+                if column in finished or cursors[column] == previous[column]:
+                    del cursors[column]
+        return results
+
+    async def request(self, pdu_type, varbinds, error_status=0, error_index=0):
+        if self.transport is None:
+            await self.open()
+        if self.user is not None and self.engine is None:
+            await self._discover()
+
+        for _ in range(2):
+            request_id = self._request_id()
+            pdu = encode_pdu(pdu_type, request_id, varbinds, error_status, error_index)
+            tag, _, status, index, answered = await self._exchange(request_id, self._message(request_id, pdu))
+            if tag != PDU_REPORT:
+                break
+            oids = [oid for oid, _ in answered]
+            # _parse took over the agent's engine time from the report
+            if USM_NOT_IN_TIME_WINDOWS not in oids and USM_UNKNOWN_ENGINE_IDS not in oids:
+                raise SnmpError('{} reported {}'.format(self.host, ', '.join(oids)))
+        else:
+            raise SnmpError('{} kept reporting {}'.format(self.host, ', '.join(oids)))
+
+        if status:
+            name = ERROR_STATUSES[status] if status < len(ERROR_STATUSES) else str(status)
+            oid = varbinds[index - 1][0] if 0 < index <= len(varbinds) else None
+            raise SnmpError('{} answered {} for {}'.format(self.host, name, oid), name, oid)
+        return answered
+
+    def _request_id(self):
+        request_id = self.next_id
+        self.next_id = self.next_id % 0x7fffffff + 1
+        return request_id
+
+    async def _discover(self):
+        """Learns the agent's engine id, boots and time (RFC 3414 4)."""
+        request_id = self._request_id()
+        pdu = encode_pdu(PDU_GET, request_id, [])
+        message = sequence(
+            encode_integer(VERSION_3),
+            self._global_data(request_id, FLAG_REPORTABLE),
+            tlv(TAG_OCTET_STRING, self._security_parameters(b'', 0, 0, b'', b'', b'')),
+            sequence(tlv(TAG_OCTET_STRING, b''), tlv(TAG_OCTET_STRING, b''), pdu))
+        await self._exchange(request_id, message)
+        if self.engine is None:
+            raise SnmpError('{} did not report its SNMPv3 engine id'.format(self.host))
+        logger.debug('SNMPv3 engine of %s is %s', self.host, self.engine.engine_id.hex())
+
+    def _global_data(self, msg_id, flags):
+        return sequence(
+            encode_integer(msg_id),
+            encode_integer(MAX_MESSAGE_SIZE),
+            tlv(TAG_OCTET_STRING, bytes([flags])),
+            encode_integer(USM_SECURITY_MODEL))
+
+    def _security_parameters(self, engine_id, boots, engine_time, user_name, auth_params, priv_params):
+        return sequence(
+            tlv(TAG_OCTET_STRING, engine_id),
+            encode_integer(boots),
+            encode_integer(engine_time),
+            tlv(TAG_OCTET_STRING, user_name),
+            tlv(TAG_OCTET_STRING, auth_params),
+            tlv(TAG_OCTET_STRING, priv_params))
+
+    def _message(self, request_id, pdu):
+        if self.user is None:
+            return sequence(encode_integer(VERSION_2C),
+                            tlv(TAG_OCTET_STRING, self.community.encode('utf-8')),
+                            pdu)
+
+        engine = self.engine
+        boots, engine_time = engine.boots, engine.now()
+        scoped_pdu = sequence(tlv(TAG_OCTET_STRING, engine.engine_id), tlv(TAG_OCTET_STRING, b''), pdu)
+        flags = FLAG_REPORTABLE
+        auth_params = priv_params = b''
+        if engine.auth_key is not None:
+            flags |= FLAG_AUTH
+            auth_params = b'\x00' * AUTH_PARAMS_LENGTH
+        if engine.priv_key is not None:
+            flags |= FLAG_PRIV
+            priv_params, scoped_pdu = self._encrypt(engine, boots, engine_time, scoped_pdu)
+            scoped_pdu = tlv(TAG_OCTET_STRING, scoped_pdu)
+
+        message = sequence(
+            encode_integer(VERSION_3),
+            self._global_data(request_id, flags),
+            tlv(TAG_OCTET_STRING, self._security_parameters(
+                engine.engine_id, boots, engine_time, self.user.name.encode('utf-8'), auth_params, priv_params)),
+            scoped_pdu)
+        if engine.auth_key is not None:
+            message = self._sign(engine, message)
+        return message
+
+    def _digest(self, engine, message):
+        hash_cls = AUTH_PROTOCOLS[self.user.auth_protocol]
+        return hmac.new(engine.auth_key, message, hash_cls).digest()[:AUTH_PARAMS_LENGTH]
+
+    def _sign(self, engine, message):
+        position = self._auth_params_offset(message)
+        digest = self._digest(engine, message)
+        return message[:position] + digest + message[position + AUTH_PARAMS_LENGTH:]
+
+    @staticmethod
+    def _auth_params_offset(message):
+        """Returns the offset of msgAuthenticationParameters' content."""
+        _, content, end = decode_tlv(message)
+        offset = end - len(content)
+        for _ in range(2):  # msgVersion, msgGlobalData
+            _, _, offset = decode_tlv(message, offset)
+        _, security, end = decode_tlv(message, offset)
+        _, parameters, end = decode_tlv(message, end - len(security))
+        offset = end - len(parameters)
+        for _ in range(4):  # engine id, boots, time, user name
+            _, _, offset = decode_tlv(message, offset)
+        _, auth_params, end = decode_tlv(message, offset)
+        return end - len(auth_params)
+
+    def _cipher(self, engine, boots, engine_time, salt):
+        if self.user.priv_protocol == 'AES':
+            iv = struct.pack('>II', boots, engine_time) + salt
+            return Cipher(algorithms.AES(engine.priv_key[:16]), modes.CFB(iv), backend=default_backend())
+        iv = bytes(a ^ b for a, b in zip(engine.priv_key[8:16], salt))
+        key = engine.priv_key[:8]
+        return Cipher(algorithms.TripleDES(key * 3), modes.CBC(iv), backend=default_backend())
+
+    def _encrypt(self, engine, boots, engine_time, scoped_pdu):
+        self.salt = (self.salt + 1) % (1 << 64)
+        if self.user.priv_protocol == 'AES':
+            salt = self.salt.to_bytes(8, 'big')
+        else:
+            salt = struct.pack('>I', boots) + (self.salt & 0xffffffff).to_bytes(4, 'big')
+            scoped_pdu += b'\x00' * (-len(scoped_pdu) % 8)
+        encryptor = self._cipher(engine, boots, engine_time, salt).encryptor()
+        return salt, encryptor.update(scoped_pdu) + encryptor.finalize()
+
+    def _decrypt(self, engine, boots, engine_time, salt, encrypted):
+        if self.user.priv_protocol == 'DES' and len(encrypted) % 8:
+            raise SnmpError('Bad DES ciphertext length from {}'.format(self.host))
+        decryptor = self._cipher(engine, boots, engine_time, salt).decryptor()
+        return decryptor.update(encrypted) + decryptor.finalize()
+
+    async def _exchange(self, request_id, message):
+        loop = asyncio.get_event_loop()
+        wrong_digests = self.wrong_digests
+        for attempt in range(self.retries + 1):
+            waiter = loop.create_future()
+            self.waiters[request_id] = waiter
+            self.transport.sendto(message)
+            try:
+                return await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+            except asyncio.TimeoutError:
+                logger.debug('No SNMP answer from %s, attempt %d', self.host, attempt + 1)
+            finally:
+                self.waiters.pop(request_id, None)
+        if self.wrong_digests > wrong_digests:
+            # only answers signed with other keys came back
+            raise SnmpAuthError('{} answered with a wrong digest, check the SNMPv3 passwords of {}'.format(
+                self.host, self.user.name))
+        raise SnmpTimeoutError('No SNMP answer from {} after {} attempts'.format(self.host, self.retries + 1))
+
+    def _failed(self, error):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(error)
+
+    def _received(self, data):
+        try:
+            request_id, response = self._parse(data)
+        except SnmpAuthError as e:
+            self._failed(e)
+            return
+        except SnmpError as e:
+            logger.info('Dropping SNMP message from %s: %s', self.host, e)
+            return
+        waiter = self.waiters.get(request_id)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(response)
+
+    def _parse(self, data):
+        """Returns (request or msg id, decoded PDU) of a received message."""
+        tag, content, _ = decode_tlv(data)
+        elements = decode_sequence(content) if tag == TAG_SEQUENCE else []
+        if len(elements) < 3:
+            raise SnmpError('Malformed message')
+        version = decode_value(*elements[0])
+
+        if self.user is None:
+            if version != VERSION_2C or len(elements) != 3:
+                raise SnmpError('Unexpected SNMP version {}'.format(version))
+            pdu = decode_pdu(*elements[2])
+            return pdu[1], pdu
+
+        if version != VERSION_3 or len(elements) != 4:
+            raise SnmpError('Unexpected SNMP version {}'.format(version))
+        msg_id, _, flags, _ = [decode_value(*element) for element in decode_sequence(elements[1][1])]
+        flags = flags[0] if flags else 0
+        (_, engine_id), (_, boots), (_, engine_time), _, (_, auth_params), (_, priv_params) = \
+            decode_sequence(decode_tlv(elements[2][1])[1])
+        engine_id = bytes(engine_id)
+        boots, engine_time = decode_value(TAG_INTEGER, boots), decode_value(TAG_INTEGER, engine_time)
+
+        if self.engine is None or self.engine.engine_id != engine_id:
+            if not engine_id:
+                raise SnmpError('No engine id')
+            self.engine = _Engine(engine_id, boots, engine_time, self.user)
+        engine = self.engine
+
+        authentic = False
+        if flags & FLAG_AUTH and engine.auth_key is not None:
+            offset = self._auth_params_offset(data)
+            zeroed = data[:offset] + b'\x00' * AUTH_PARAMS_LENGTH + data[offset + AUTH_PARAMS_LENGTH:]
+            authentic = hmac.compare_digest(self._digest(engine, zeroed), bytes(auth_params))
+        if authentic:
+            if boots > engine.boots or (boots == engine.boots and engine_time > engine.now()):
+                engine.update(boots, engine_time)
+        elif flags & FLAG_PRIV:
+            self.wrong_digests += 1
+            raise SnmpError('Wrong digest')
+        elif not flags & FLAG_AUTH:
+            # unauthenticated reports still carry the agent's clock
+            engine.update(boots, engine_time)
+
+        scoped = elements[3]
+        if flags & FLAG_PRIV:
+            if engine.priv_key is None:
+                raise SnmpError('Unexpected encrypted message')
+            scoped = decode_tlv(self._decrypt(engine, boots, engine_time, bytes(priv_params), bytes(scoped[1])))[:2]
+        _, _, pdu = decode_sequence(scoped[1])
+        pdu = decode_pdu(*pdu)
+        if pdu[0] == PDU_REPORT:
+            self._check_report(pdu[4])
+        if flags & FLAG_AUTH and not authentic:
+            self.wrong_digests += 1
+            raise SnmpError('Wrong digest')
+        return msg_id, pdu
+
+    def _check_report(self, varbinds):
+        """Raises SnmpAuthError for a report refusing the user."""
+        oids = [oid for oid, _ in varbinds]
+        for oid, reason in [(USM_UNKNOWN_USER_NAMES, 'unknown user name'),
+                            (USM_WRONG_DIGESTS, 'wrong digest'),
+                            (USM_UNSUPPORTED_SEC_LEVELS, 'unsupported security level'),
+                            (USM_DECRYPTION_ERRORS, 'decryption error')]:
+            if oid in oids:
+                raise SnmpAuthError('{} refused SNMPv3 user {}: {}'.format(self.host, self.user.name, reason))
+
+
+def client_from_config(host, config=None):
+    """Returns an SnmpClient for host with the credentials in WORKER_CONFIG:
+    an snmp_v3 dict (user, auth_protocol, auth_password, priv_protocol,
+    priv_password) or else snmp_community_string.
+    """
+    config = settings.WORKER_CONFIG if config is None else config
+    v3 = config.get('snmp_v3')
+    if v3 is not None:
+        user = UsmUser(v3['user'], v3.get('auth_protocol'), v3.get('auth_password'),
+                       v3.get('priv_protocol'), v3.get('priv_password'))
+        return SnmpClient(host, user=user, timeout=settings.SNMP_TIMEOUT, retries=settings.SNMP_RETRIES)
+    return SnmpClient(host, community=config['snmp_community_string'],
+                      timeout=settings.SNMP_TIMEOUT, retries=settings.SNMP_RETRIES)
+
+
+def run(host, method, *args, timeout=None):
+    """Calls SnmpClient method (e.g. 'set') for host on a new event loop
+    and returns its result. timeout caps the whole call.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        async def call():
+            async with client_from_config(host) as client:
+                return await getattr(client, method)(*args)
+
+        try:
+            return loop.run_until_complete(asyncio.wait_for(call(), timeout, loop=loop))
+        except asyncio.TimeoutError:
+            raise SnmpTimeoutError('SNMP {} on {} took more than {}s'.format(method, host, timeout))
+    finally:
+        loop.close()
+
+
+def format_varbinds(varbinds):
+    """Formats [(oid, value)] like snmpset's output lines."""
+    lines = []
+    for oid, value in varbinds:
+        if isinstance(value, int):
+            text = 'INTEGER: {}'.format(value)
+        elif isinstance(value, bytes):
+            text = 'STRING: "{}"'.format(value.decode('utf-8', 'replace'))
+        else:
+            text = repr(value)
+        lines.append('iso.{} = {}\n'.format(oid[2:] if oid.startswith('1.') else oid, text))
+    return ''.join(lines)
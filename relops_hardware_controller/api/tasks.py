@@ -0,0 +1,384 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Non-blocking reboot escalation and the periodic power sweep.
+
+The reboot escalation from the reboot command run as a state machine
+persisted in Redis. Each power action runs in a short reboot_step task
+and each down/up check is a reboot_check task that reschedules itself
+with a countdown, so a host waiting to come back holds no worker slot.
+
+Every scheduled task carries a token and the state only accepts the
+task holding the latest one. Resuming a stale job hands out a new token
+and continues from the last completed step, with the checks when its
+power action may have run.
+
+sweep_power_status runs from celery beat and fills the power_cache and
+pdu_cache the status command answers from. power_on_due restores power that a hard
+cycle cut, see power_timer.
+"""
+
+import functools
+import logging
+import time
+import uuid
+from io import StringIO
+
+from celery.signals import (
+    worker_process_shutdown,
+    worker_ready,
+)
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import load_command_class
+
+from ..celery import (
+    app,
+    notify_result,
+)
+from . import (
+    power_cache,
+    power_timer,
+)
+from .ipmi_config import get_ipmi_table
+from .management.commands import (
+    ipmi,
+    xenapi_reboot,
+)
+from .management.commands.reboot import (
+    Deadline,
+    NoTimeLeft,
+    format_attempt,
+    get_server,
+    plan_method,
+    preflight_methods,
+    run_method,
+    went_down,
+)
+from .probes import (
+    any_up,
+    get_up_checks,
+)
+from .verifiers import get_verifier
+
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = 'reboot:{}'
+STATE_TIMEOUT = 60 * 60 * 24
+
+DOWN_CHECK_INTERVAL = 1
+UP_CHECK_INTERVAL = 5
+
+SWEEP_LOCK_KEY = 'power:sweep'
+
+
+def load_state(job_id):
+    return cache.get(STATE_KEY.format(job_id))
+
+
+def save_state(state):
+    state['updated'] = time.time()
+    cache.set(STATE_KEY.format(state['job_id']), state, STATE_TIMEOUT)
+
+
+def schedule(state, task, countdown=0):
+    """Saves state and queues task as the only task allowed to advance it."""
+    state['token'] = uuid.uuid4().hex
+    save_state(state)
+    task.apply_async((state['job_id'], state['token']), countdown=countdown)
+
+
+def _current_state(job_id, token):
+    state = load_state(job_id)
+    if state is None or state['token'] != token or state['step'] == 'done':
+        logger.info('Dropping stale reboot task for job %s', job_id)
+        return None
+    return state
+
+
+def start_reboot(hostname, job_data, notification):
+    """Starts a non-blocking reboot escalation for hostname.
+
+    Param notification holds the subject, username and start_time for
+    notify_result once the escalation finishes. Returns the job id.
+    """
+    job_id = uuid.uuid4().hex
+    state = dict(
+        job_id=job_id,
+        hostname=hostname,
+        job_data=job_data,
+        notification=notification,
+        methods=settings.REBOOT_METHODS,
+        index=0,
+        step='preflight',
+        started=time.time(),
+        log='\\n',
+        log_short=' ',
+        stdout='',
+        preflight_note='',
+    )
+    schedule(state, reboot_step)
+    return job_id
+
+
+def _checks(state):
+    hostname = state['hostname']
+    method = state['methods'][state['index']]
+
+    up_checks = get_up_checks(hostname, state['job_data'])
+    for up_check, dump in zip(up_checks, state.get('up_checks', [])):
+        up_check.load(dump)
+
+    verifier = get_verifier(method, hostname, get_server(hostname))
+    if verifier is not None and state.get('verifier') is not None:
+        verifier.load(state['verifier'])
+
+    return verifier, up_checks
+
+
+def _fail_method(state, error):
+    method = state['methods'][state['index']]
+    log_entry, log_entry_short = format_attempt(method, state.get('reboot_args', []), error)
+    state['log'] += log_entry
+    state['log_short'] += log_entry_short
+    state['index'] += 1
+    state['step'] = 'action'
+    schedule(state, reboot_step)
+
+
+def _finish(state, message):
+    state['step'] = 'done'
+    save_state(state)
+    logger.info(message)
+    notification = state['notification']
+    notify_result(state['job_data'],
+                  notification['subject'],
+                  notification['username'],
+                  notification['start_time'],
+                  message)
+
+
+def _acting(state, method_call, verifier, up_checks):
+    """Saves that the power action of the current method is starting
+    with the snapshots to check it against, so a resumed job checks the
+    host instead of running the action again.
+    """
+    state.update(
+        step='acting',
+        up_checks=[up_check.dump() for up_check in up_checks],
+        verifier=verifier.dump() if verifier is not None else None,
+        method_started=time.time(),
+        phase_started=time.time(),
+        method_deadline=method_call.deadline,
+    )
+    save_state(state)
+
+
+def _resumed(state):
+    """Returns True when resume_reboots moved the job on while its power
+    action ran."""
+    if load_state(state['job_id'])['token'] == state['token']:
+        return False
+    logger.info('Reboot job %s was resumed during %s', state['job_id'], state['methods'][state['index']])
+    return True
+
+
+def _run_action(state, server):
+    """Runs the power action of the current reboot method then schedules
+    the first down check. Files the bug or gives up when out of methods.
+    """
+    hostname = state['hostname']
+    methods = state['methods']
+    # same budget as the blocking reboot command so jobs still end in bounded time
+    deadline = Deadline(int(settings.CELERY_TASK_SOFT_TIME_LIMIT) - settings.BUG_FILING_RESERVE, state['started'])
+
+    while state['index'] < len(methods):
+        method = methods[state['index']]
+        state['reboot_args'] = []
+        stdout = StringIO()
+        try:
+            method_call = plan_method(methods, state['index'], hostname, server, state['job_data'], deadline,
+                                      state['log'])
+            if method_call is None:
+                state['index'] += 1
+                continue
+            state['reboot_args'] = method_call.reboot_args
+            verifier, up_checks = run_method(method, method_call, hostname, server, state['job_data'], stdout,
+                                             started=functools.partial(_acting, state, method_call))
+        except NoTimeLeft as e:
+            logger.warn('No time left to try %s', method)
+            state['log_short'] += str(e)
+            state['index'] += 1
+            continue
+        except Exception as e:
+            logger.exception(e)
+            if not _resumed(state):
+                _fail_method(state, e)
+            return
+
+        if _resumed(state):
+            return
+
+        if method == 'file_bugzilla_bug':
+            _finish(state, 'failed. {}'.format(stdout.getvalue().replace('\n', '\r')))
+            return
+
+        state.update(
+            step='wait_down',
+            stdout=stdout.getvalue(),
+            phase_started=time.time(),
+        )
+        schedule(state, reboot_check, countdown=DOWN_CHECK_INTERVAL)
+        return
+
+    _finish(state, 'failed:{}{}'.format(state['log_short'], state['preflight_note']))
+
+
+@app.task
+def reboot_step(job_id, token):
+    """Runs the pre-flight probes or the next power action of a reboot job."""
+    state = _current_state(job_id, token)
+    if state is None:
+        return
+
+    try:
+        server = get_server(state['hostname'])
+    except KeyError as e:
+        # reported like celery_call_command reports it for the other commands
+        logger.exception(e)
+        _finish(state, 'Key error: {}'.format(e))
+        return
+
+    if state['step'] == 'preflight':
+        state['methods'], state['preflight_note'], preflight_log = preflight_methods(
+            state['hostname'], server, state['methods'])
+        state['log'] += preflight_log
+        state['step'] = 'action'
+        save_state(state)
+
+    _run_action(state, server)
+
+
+@app.task
+def reboot_check(job_id, token):
+    """Checks once whether the host went down or came back up and
+    reschedules itself, moves on to the next method on timeout.
+    """
+    state = _current_state(job_id, token)
+    if state is None:
+        return
+
+    hostname = state['hostname']
+    verifier, up_checks = _checks(state)
+    elapsed = time.time() - state['phase_started']
+    time_left = state['method_deadline'] - time.time()
+
+    if state['step'] == 'wait_down':
+        if went_down(hostname, verifier):
+            logger.debug('%s went down', hostname)
+            state.update(step='wait_up', phase_started=time.time())
+            schedule(state, reboot_check, countdown=UP_CHECK_INTERVAL)
+        elif elapsed >= settings.DOWN_TIMEOUT or time_left <= 0:
+            logger.error('Timeout of %d exceeded waiting for %s to go down', settings.DOWN_TIMEOUT, hostname)
+            _fail_method(state, Exception('Reboot did not cycle power.'))
+        else:
+            if verifier is not None:
+                state['verifier'] = verifier.dump()
+            schedule(state, reboot_check, countdown=DOWN_CHECK_INTERVAL)
+
+    elif state['step'] == 'wait_up':
+        if any_up(up_checks) or (verifier is not None and verifier.finished_boot()):
+            _finish(state, '{command}: {stdout} Completed in {time:.3g} seconds{preflight}'.format(
+                command=state['methods'][state['index']],
+                stdout=state['stdout'].replace('\n', '\r'),
+                time=time.time() - state['started'],
+                preflight=state['preflight_note']))
+        elif elapsed >= settings.UP_TIMEOUT or time_left <= 0:
+            logger.error('Timeout of %d exceeded waiting for %s to come up', settings.UP_TIMEOUT, hostname)
+            _fail_method(state, Exception('Reboot did not cycle power.'))
+        else:
+            if verifier is not None:
+                state['verifier'] = verifier.dump()
+            schedule(state, reboot_check, countdown=UP_CHECK_INTERVAL)
+
+
+@app.task
+def resume_reboots():
+    """Reschedules reboot jobs that stopped advancing, e.g. after a worker
+    was killed while holding their countdown task.
+    """
+    for key in cache.iter_keys(STATE_KEY.format('*')):
+        state = cache.get(key)
+        if state is None or state['step'] == 'done':
+            continue
+        if time.time() - state['updated'] < settings.REBOOT_RESUME_AFTER:
+            continue
+
+        logger.info('Resuming reboot job %s for %s at %s', state['job_id'], state['hostname'], state['step'])
+        if state['step'] in ['preflight', 'action']:
+            schedule(state, reboot_step)
+        elif state['step'] == 'acting' and state['methods'][state['index']] == 'file_bugzilla_bug':
+            # the bug may have been filed
+            _finish(state, 'failed:{}{}'.format(state['log_short'], state['preflight_note']))
+        else:
+            # the power action already ran or may have, only the checks are repeated
+            if state['step'] == 'acting':
+                state['step'] = 'wait_down'
+            state['phase_started'] = time.time()
+            schedule(state, reboot_check)
+
+
+@worker_ready.connect
+def resume_reboots_on_start(sender=None, **kwargs):
+    resume_reboots.apply_async(countdown=settings.REBOOT_RESUME_AFTER)
+
+
+@app.task
+def sweep_power_status():
+    """Reads chassis power status of every host in the IPMI table into
+    the power_cache, one command at a time per BMC and up to
+    POWER_SWEEP_CONCURRENCY BMCs at once, then walks the outlet table of
+    every PDU in WORKER_CONFIG into the pdu_cache.
+    """
+    # a slow sweep must not overlap the next one beat sends
+    if not cache.add(SWEEP_LOCK_KEY, time.time(), int(settings.CELERY_TASK_SOFT_TIME_LIMIT)):
+        logger.info('Skipping power sweep, the previous one is still running')
+        return
+    try:
+        hostnames = sorted(get_ipmi_table())
+        start = time.time()
+        results = ipmi.batch([(hostname, 'ipmi_status') for hostname in hostnames],
+                             max_workers=settings.POWER_SWEEP_CONCURRENCY)
+        entries = power_cache.store(dict(zip(hostnames, results)))
+        logger.info('Swept power status of %d hosts in %.1fs, %d failed', len(hostnames), time.time() - start,
+                    len([entry for entry in entries.values() if entry['power'] is None]))
+
+        pdus = sorted({server['pdu'].rsplit(':', 1)[0]
+                       for server in settings.WORKER_CONFIG.get('servers', {}).values() if 'pdu' in server})
+        start = time.time()
+        snmp = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+        walks = snmp.walk_pdus(pdus, max_workers=settings.POWER_SWEEP_CONCURRENCY)
+        logger.info('Walked the outlet tables of %d PDUs in %.1fs, %d failed', len(pdus), time.time() - start,
+                    len([walk for walk in walks.values() if isinstance(walk, Exception)]))
+    finally:
+        cache.delete(SWEEP_LOCK_KEY)
+
+
+@app.task
+def power_on_due():
+    """Powers on the hosts whose delayed power-on is due."""
+    power_timer.run_due()
+
+
+@worker_ready.connect
+def power_on_due_on_start(sender=None, **kwargs):
+    # entries that came due while no worker was running
+    power_on_due.apply_async()
+
+
+@worker_process_shutdown.connect
+def logout_xen_sessions(sender=None, **kwargs):
+    # pool processes exit without running atexit handlers
+    xenapi_reboot.pool.close_all()
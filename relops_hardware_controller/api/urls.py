@@ -11,4 +11,6 @@ urlpatterns = [
     url(r'^workers/(?P<worker_id>[-_0-9a-zA-Z]{1,128})/'
         'jobs$',
         views.queue_job, name='JobList'),
+    url(r'^workers/jobs$',
+        views.queue_bulk_job, name='BulkJobList'),
 ]
@@ -0,0 +1,263 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import re
+import time
+from io import StringIO
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from django.conf import settings
+from django.core.management import (
+    call_command,
+    load_command_class,
+)
+import hpilo
+
+from . import (
+    ilo as ilo_client,
+    pdu_cache,
+)
+from .management.commands.xenapi_reboot import xen_session
+
+
+logger = logging.getLogger(__name__)
+
+
+class Verifier:
+    """Reads a host's power state from the controller that rebooted it.
+
+    The reboot escalation calls snapshot() before running the power action
+    then polls power_cycled() until it returns True or times out. Unlike
+    ICMP this can't miss a reboot that finished between two pings.
+    """
+
+    def __init__(self, hostname, server):
+        self.hostname = hostname
+        self.server = server
+        self.seen_off = False
+
+    def snapshot(self):
+        """Record any state needed to tell a later boot from the current one."""
+        pass
+
+    def power_state(self):
+        """Returns 'on', 'off' or None when the state is unknown."""
+        raise NotImplementedError()
+
+    def dump(self):
+        """Returns the snapshot and seen state as a JSON-serializable dict."""
+        return {key: value for key, value in vars(self).items() if key not in ('hostname', 'server')}
+
+    def load(self, state):
+        vars(self).update(state)
+
+    def booted_since_snapshot(self):
+        return False
+
+    def finished_boot(self):
+        """Returns True once the controller reports the host booted
+        again, which ends the wait for it to come up without waiting on
+        the network.
+        """
+        return False
+
+    def power_cycled(self):
+        try:
+            if self.power_state() == 'off':
+                self.seen_off = True
+            return self.seen_off or self.booted_since_snapshot()
+        except SoftTimeLimitExceeded as e:
+            raise e
+        except Exception as e:
+            logger.info('%s verifier for %s failed: %s', self.__class__.__name__, self.hostname, e)
+            return False
+
+
+class IpmiVerifier(Verifier):
+    """Reads chassis power status and watches the SEL for a boot event.
+
+    A warm reset never reports power off so the SEL check is what catches
+    ipmi_reset.
+    """
+
+    sel_boot_re = re.compile(r'System Boot Initiated|System Restart|OS Boot', re.IGNORECASE)
+
+    def __init__(self, hostname, server):
+        super().__init__(hostname, server)
+        self.last_sel_id = None
+
+    def _ipmi(self, command):
+        ipmi_cls = load_command_class('relops_hardware_controller.api', 'ipmi')
+        return call_command(ipmi_cls, self.hostname, command, stdout=StringIO()) or ''
+
+    def _sel_entries(self):
+        for line in self._ipmi('ipmi_list').splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            try:
+                yield int(fields[0], 16), ' '.join(fields[1:])
+            except ValueError:
+                continue
+
+    def snapshot(self):
+        try:
+            self.last_sel_id = max((sel_id for sel_id, _ in self._sel_entries()), default=None)
+        except SoftTimeLimitExceeded as e:
+            raise e
+        except Exception as e:
+            logger.info('Could not read SEL for %s: %s', self.hostname, e)
+
+    def power_state(self):
+        match = re.search(r'Chassis Power is (on|off)', self._ipmi('ipmi_status'))
+        return match.group(1) if match else None
+
+    def booted_since_snapshot(self):
+        for sel_id, event in self._sel_entries():
+            if self.last_sel_id is not None and sel_id <= self.last_sel_id:
+                continue
+            if self.sel_boot_re.search(event):
+                logger.info('SEL boot event for %s: %s', self.hostname, event)
+                return True
+        return False
+
+
+class PduVerifier(Verifier):
+    """Reads the Sentry outletStatus of the host's PDU outlet.
+
+    snmp_reboot reads the outlet back right after its SET, so an off
+    state cached since the snapshot confirms the cycle without asking
+    the PDU again.
+    """
+
+    def __init__(self, hostname, server):
+        super().__init__(hostname, server)
+        self.snapshot_time = None
+
+    def snapshot(self):
+        self.snapshot_time = time.time()
+
+    def power_state(self):
+        pdu, port = self.server['pdu'].rsplit(':', 1)
+        snmp = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+        entry = pdu_cache.get(pdu, snmp.outlet_index(port))
+        if self.snapshot_time is not None and entry is not None and entry['checked'] >= self.snapshot_time \
+                and entry['power'] == 'off':
+            logger.debug('PDU %s outlet %s read back %s', pdu, port, entry['status'])
+            return 'off'
+
+        status = snmp.get_outlet_status(pdu, port, timeout=10)
+        logger.debug('PDU %s outlet %s status %s', pdu, port, status)
+        return pdu_cache.outlet_power(status)
+
+
+class IloVerifier(Verifier):
+    """Reads the host power status and the POST state from HP iLO.
+
+    Both go out as one RIBCL request over the iLO client's remembered
+    protocol and TLS session. A warm reset never reports power off but
+    goes through POST, and FinishedPost after that means the server is
+    up. iLOs that don't know GET_POST_STATE are only asked for power.
+    """
+
+    post_states = ('Reset', 'PowerOff', 'InPost', 'InPostDiscoveryComplete')
+
+    def __init__(self, hostname, server):
+        super().__init__(hostname, server)
+        self.post_state_supported = True
+        self.post_state = None
+        self.seen_post = False
+
+    def _read(self):
+        ilo = ilo_client.get_ilo(self.server['ilo'][0],
+                                 settings.ILO_USERNAME,
+                                 settings.ILO_PASSWORD,
+                                 timeout=10,
+                                 delayed=True)
+        ilo.get_host_power_status()
+        if self.post_state_supported:
+            ilo_client.get_post_state(ilo)
+        try:
+            values = ilo.call_delayed()
+        except hpilo.IloCommunicationError as e:
+            ilo_client.forget(self.server['ilo'][0])
+            raise e
+        except hpilo.IloError as e:
+            if not self.post_state_supported:
+                raise e
+            logger.info('iLO of %s does not report the POST state: %s', self.hostname, e)
+            self.post_state_supported = False
+            return self._read()
+        ilo_client.remember(ilo)
+        return values[0], values[1] if self.post_state_supported else None
+
+    def power_state(self):
+        power_status, self.post_state = self._read()
+        logger.debug('iLO of %s reports power %s POST state %s', self.hostname, power_status, self.post_state)
+        if self.post_state in self.post_states:
+            self.seen_post = True
+        if self.post_state == 'PowerOff':
+            return 'off'
+        return power_status.lower()
+
+    def booted_since_snapshot(self):
+        return self.seen_post
+
+    def finished_boot(self):
+        return self.power_cycled() and self.post_state == 'FinishedPost'
+
+
+class XenVerifier(Verifier):
+    """Reads the VM power_state and boot time from XenAPI."""
+
+    def __init__(self, hostname, server):
+        super().__init__(hostname, server)
+        self.host_uuid = server['xen']['reboot'][0]
+        self.start_time = None
+
+    def _vm_record(self):
+        with xen_session(settings.XEN_URL,
+                         settings.XEN_USERNAME,
+                         settings.XEN_PASSWORD) as session:
+            vm = session.xenapi.VM.get_by_uuid(self.host_uuid)
+            metrics = session.xenapi.VM.get_metrics(vm)
+            # an xmlrpc.client.DateTime, which the reboot job state can't store as JSON
+            start_time = str(session.xenapi.VM_metrics.get_start_time(metrics))
+            return session.xenapi.VM.get_power_state(vm), start_time
+
+    def snapshot(self):
+        try:
+            _, self.start_time = self._vm_record()
+        except SoftTimeLimitExceeded as e:
+            raise e
+        except Exception as e:
+            logger.info('Could not read xen VM %s start time: %s', self.host_uuid, e)
+
+    def power_state(self):
+        power_state, start_time = self._vm_record()
+        if self.start_time is not None and start_time != self.start_time:
+            logger.info('xen VM %s restarted at %s', self.host_uuid, start_time)
+            self.seen_off = True
+        return {'Running': 'on', 'Halted': 'off'}.get(power_state)
+
+
+VERIFIERS = {
+    'ipmi_on': IpmiVerifier,
+    'ipmi_reset': IpmiVerifier,
+    'ipmi_cycle': IpmiVerifier,
+    'ipmi_ensure_on': IpmiVerifier,
+    'ipmi_smart_reboot': IpmiVerifier,
+    'snmp_reboot': PduVerifier,
+    'snmp_rebootdelay': PduVerifier,
+    'ilo_reboot': IloVerifier,
+    'xenapi_reboot': XenVerifier,
+}
+
+
+def get_verifier(reboot_method, hostname, server):
+    """Returns a Verifier for reboot_method or None if it has no out-of-band state."""
+    verifier_cls = VERIFIERS.get(reboot_method, None)
+    if verifier_cls is None:
+        return None
+    return verifier_cls(hostname, server)
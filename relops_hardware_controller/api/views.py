@@ -19,13 +19,17 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 from .authentication import TaskclusterAuthentication
-from ..celery import celery_call_command
+from ..celery import (
+    celery_bulk_call_command,
+    celery_call_command,
+)
 from .decorators import (
     set_cors_headers,
     require_taskcluster_scope_sets,
 )
 from .permissions import HasTaskclusterScopes
 from .serializers import (
+    BulkJobSerializer,
     JobSerializer,
 )
 
@@ -63,7 +67,7 @@ def is_managed_host(worker_id):
 @renderer_classes((JSONRenderer,))
 def queue_job_create(request, worker_id, format=None):
     task_name = request.GET.get('task_name', '')
-    serializer = JobSerializer(data=dict(
+    job_data = dict(
         worker_id=worker_id.lower(),
         worker_group=request.GET.get('worker_group', 'none'),
         client_id=request.user.client_id,
@@ -71,7 +75,10 @@ def queue_job_create(request, worker_id, format=None):
         provisioner_id=request.GET.get('provisioner_id', ''),
         worker_type=request.GET.get('worker_type', ''),
         http_origin=request.META.get('HTTP_ORIGIN', ''),
-    ))
+    )
+    if 'max_age' in request.GET:
+        job_data['max_age'] = request.GET['max_age']
+    serializer = JobSerializer(data=job_data)
 
     if task_name != 'ping' and not is_managed_host(worker_id):
         return Response('Not a managed host.', status=status.HTTP_404_NOT_FOUND)
@@ -85,3 +92,53 @@ def queue_job_create(request, worker_id, format=None):
 
     serializer.validated_data['task_id'] = result.id
     return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@csrf_exempt
+@set_cors_headers(origin=settings.CORS_ORIGIN, methods=['OPTIONS', 'POST'])
+@api_view(['OPTIONS', 'POST'])
+@authentication_classes((TaskclusterAuthentication,))
+@renderer_classes((JSONRenderer,))
+def queue_bulk_job(request, format=None):
+    if request.method == 'OPTIONS':
+        return Response({}, status=status.HTTP_200_OK)
+    elif request.method == 'POST':
+        return queue_bulk_job_create(request._request, format=None)
+    else:
+        return Response({}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@require_taskcluster_scope_sets(settings.REQUIRED_BULK_TASKCLUSTER_SCOPE_SETS)
+@api_view(['POST'])
+@authentication_classes((TaskclusterAuthentication,))
+@permission_classes((IsAuthenticated, HasTaskclusterScopes,))
+@renderer_classes((JSONRenderer,))
+def queue_bulk_job_create(request, format=None):
+    if not isinstance(request.data, dict):
+        return Response('Expected an object with worker_ids.', status=status.HTTP_400_BAD_REQUEST)
+
+    job_data = dict(
+        worker_ids=request.data.get('worker_ids'),
+        client_id=request.user.client_id,
+        task_name=request.GET.get('task_name', ''),
+        http_origin=request.META.get('HTTP_ORIGIN', ''),
+    )
+    serializer = BulkJobSerializer(data=job_data)
+
+    if not serializer.is_valid():
+        logger.warn('serializing failed: {}'.format(serializer.errors))
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    worker_ids = [worker_id.lower() for worker_id in serializer.validated_data['worker_ids']]
+    serializer.validated_data['worker_ids'] = worker_ids
+
+    unmanaged = [worker_id for worker_id in serializer.validated_data['worker_ids']
+                 if not is_managed_host(worker_id)]
+    if unmanaged:
+        return Response('Not managed hosts: {}'.format(', '.join(unmanaged)), status=status.HTTP_404_NOT_FOUND)
+
+    result = celery_bulk_call_command.delay(serializer.validated_data)
+    logger.info('queued a bulk {} task for {} hosts with id: {}'.format(
+        serializer.validated_data['task_name'], len(serializer.validated_data['worker_ids']), result.id))
+
+    serializer.validated_data['task_id'] = result.id
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -32,3 +32,7 @@ class RelopsHardwareControllerAppConfig(AppConfig):
         if 'LocMemCache' not in settings.CACHES['default']['BACKEND']:
             connection = get_redis_connection('default')
             connection.info()
+
+        # fail on a bad IPMI config at startup rather than mid-reboot
+        from .api.ipmi_config import get_ipmi_table
+        get_ipmi_table()
@@ -39,6 +39,7 @@ app = Celery('relops_hardware_controller')
 # - namespace='CELERY' means all celery-related configuration keys
 #   should have a `CELERY_` prefix.
 app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
 
 search = [dns.name.from_text('')]
 for os in ['', 'win']:
@@ -95,10 +96,20 @@ def celery_call_command(job_data):
         except Exception as e:
             logging.warn(e)
 
+    if task == 'reboot' and settings.REBOOT_ASYNC:
+        # the escalation continues in short self-rescheduling tasks which
+        # send the notifications when it finishes
+        from .api.tasks import start_reboot
+        start_reboot(str(hostname), job_data, dict(subject=subject, username=username, start_time=start_time))
+        return
+
     stdout = StringIO()
     message = ''
     try:
-        call_command(cmd_class, hostname, json.dumps(job_data), stdout=stdout, stderr=stdout)
+        if task == 'ipmi':
+            call_command(cmd_class, hostname, command, stdout=stdout, stderr=stdout)
+        else:
+            call_command(cmd_class, hostname, json.dumps(job_data), stdout=stdout, stderr=stdout)
     except KeyError as e:
         logging.exception(e)
         message = 'Key error: {}'.format(e)
@@ -112,6 +123,38 @@ def celery_call_command(job_data):
         message = stdout.getvalue()
         logging.info(message)
 
+    notify_result(job_data, subject, username, start_time, message)
+
+
+@app.task
+def celery_bulk_call_command(job_data):
+    """Runs the management command task_name over all worker_ids at once
+    with its --fan-out mode and returns its result per host.
+    """
+    command = job_data['task_name']
+    hostnames = [str(dns_lookup(worker_id)[0]).rstrip('.') for worker_id in job_data['worker_ids']]
+    logging.info('{} of {} hosts requested by {}'.format(command, len(hostnames), job_data['client_id']))
+
+    stdout = StringIO()
+    cmd_class = load_command_class('relops_hardware_controller.api', command)
+    call_command(cmd_class, '--fan-out', *hostnames, stdout=stdout, stderr=stdout)
+    results = [json.loads(line) for line in stdout.getvalue().splitlines() if line]
+
+    failed = ['{hostname} {status}'.format(**result) for result in results if result['status'] != 'ok']
+    message = '{} of {} hosts: {} ok{}'.format(
+        command, len(results), len(results) - len(failed), ', ' + ', '.join(failed) if failed else '')
+    logging.info(message)
+    try:
+        taskcluster.Notify().irc({'channel': settings.NOTIFY_IRC_CHANNEL, 'message': message[:510]})
+    except Exception as e:
+        logging.warn(e)
+    return results
+
+
+def notify_result(job_data, subject, username, start_time, message):
+    """Emails and IRCs the result message of a job to the requester."""
+    notify = taskcluster.Notify()
+
     # Ignore most Notify logging
     log_level = logging.getLogger().level
     logging.getLogger().setLevel(logging.CRITICAL)
@@ -174,6 +174,8 @@ class Base(Configuration, Celery):
         'ipmi_list',
         'ipmi_cycle',
         'ipmi_reset',
+        'ipmi_ensure_on',
+        'ipmi_smart_reboot',
         'reimage',
         'loan',
         'return_loan',
@@ -184,6 +186,16 @@ class Base(Configuration, Celery):
         for task_name in TASK_NAMES.value
     ], seq_separator=',', environ_prefix=None)
 
+    # management commands run over a list of hosts at once from the bulk API
+    BULK_TASK_NAMES = values.ListValue([
+        'ssh_reboot',
+    ], environ_prefix=None)
+
+    REQUIRED_BULK_TASKCLUSTER_SCOPE_SETS = values.SingleNestedListValue([
+        ['project:releng:roller:{}'.format(task_name)]
+        for task_name in BULK_TASK_NAMES.value
+    ], seq_separator=',', environ_prefix=None)
+
     VALID_WORKER_ID_REGEX = values.Value('^.*', environ_prefix=None)
 
     # Worker Settings
@@ -217,20 +229,107 @@ class Base(Configuration, Celery):
     XEN_URL = values.URLValue('', environ_prefix=None)
     XEN_USERNAME = values.Value('', environ_prefix=None)
     XEN_PASSWORD = values.Value('', environ_prefix=None)
+    # seconds an idle XenAPI session is kept logged in for later jobs,
+    # 0 logs in and out for every job
+    XEN_SESSION_IDLE = values.IntegerValue(600, environ_prefix=None)
+    # seconds a single XenAPI call may take, VM.clean_shutdown waits for the guest
+    XEN_TIMEOUT = values.IntegerValue(300, environ_prefix=None)
+    # seconds xenapi_reboot waits for the guest agent of the started VM to report
+    XEN_GUEST_TIMEOUT = values.IntegerValue(120, environ_prefix=None)
 
     ILO_USERNAME = values.Value('', environ_prefix=None)
     ILO_PASSWORD = values.Value('', environ_prefix=None)
 
+    # 'native' runs ipmi commands over RMCP+ from python instead of forking ipmitool
+    IPMI_CLIENT = values.Value('ipmitool', environ_prefix=None)
+    # seconds an idle native IPMI session is kept open for reuse,
+    # 0 opens and closes a session for every command
+    IPMI_SESSION_IDLE = values.IntegerValue(30, environ_prefix=None)
+    # seconds to collect native power actions for other nodes of a chassis
+    # and run them as one batch, 0 runs each action on its own
+    IPMI_COALESCE_WINDOW = values.IntegerValue(1, environ_prefix=None)
+    # SEL entries kept in Redis per host for ipmi_list
+    IPMI_SEL_RING = values.IntegerValue(200, environ_prefix=None)
+
+    # seconds ssh_reboot waits for the TCP connection and authentication,
+    # on top of each command's --timeout
+    SSH_CONNECT_TIMEOUT = values.IntegerValue(5, environ_prefix=None)
+    # ssh master connections shared between commands to the same host and
+    # kept SSH_CONTROL_PERSIST seconds after the last one
+    SSH_CONTROL_DIR = values.Value('/tmp/relops-ssh', environ_prefix=None)
+    SSH_CONTROL_PERSIST = values.IntegerValue(60, environ_prefix=None)
+    # hosts ssh_reboot --fan-out and bulk API jobs reboot at once
+    SSH_FANOUT_CONCURRENCY = values.IntegerValue(32, environ_prefix=None)
+
+    # native to send SNMP requests from python or net-snmp to run snmpset/snmpget
+    SNMP_CLIENT = values.Value('native', environ_prefix=None)
+    # seconds the native client waits for each SNMP answer and how often it resends
+    SNMP_TIMEOUT = values.IntegerValue(2, environ_prefix=None)
+    SNMP_RETRIES = values.IntegerValue(3, environ_prefix=None)
+    # seconds to collect outlet SETs for the same PDU from other jobs and
+    # send them as one request, 0 sends each SET on its own
+    SNMP_COALESCE_WINDOW = values.IntegerValue(1, environ_prefix=None)
+
+    # seconds between celery beat sweeps reading the power state of every
+    # IPMI host and how many BMCs a sweep talks to at once
+    POWER_SWEEP_INTERVAL = values.IntegerValue(300, environ_prefix=None)
+    POWER_SWEEP_CONCURRENCY = values.IntegerValue(16, environ_prefix=None)
+    # seconds the status command serves a swept power state before asking the BMC
+    POWER_STATUS_MAX_AGE = values.IntegerValue(900, environ_prefix=None)
+    # hard power cycles with a longer delay than POWER_ON_INLINE_DELAY cut
+    # power and leave the power-on to the timer, which beat checks every
+    # POWER_ON_TICK seconds. A power-on is retried after POWER_ON_LEASE.
+    POWER_ON_INLINE_DELAY = values.IntegerValue(1, environ_prefix=None)
+    POWER_ON_TICK = values.IntegerValue(5, environ_prefix=None)
+    POWER_ON_LEASE = values.IntegerValue(120, environ_prefix=None)
+
+    @property
+    def CELERY_BEAT_SCHEDULE(self):
+        return {
+            'sweep-power-status': {
+                'task': 'relops_hardware_controller.api.tasks.sweep_power_status',
+                'schedule': float(self.POWER_SWEEP_INTERVAL),
+            },
+            'power-on-due': {
+                'task': 'relops_hardware_controller.api.tasks.power_on_due',
+                'schedule': float(self.POWER_ON_TICK),
+            },
+        }
+
     WORKER_CONFIG = JSONFileValue('', environ_prefix=None, environ_name='WORKER_CONFIG_PATH')
 
     # how many seconds to wait for a machine to go down and come back up
     DOWN_TIMEOUT = values.IntegerValue(60, environ_prefix=None)
     UP_TIMEOUT = values.IntegerValue(300, environ_prefix=None)
 
+    # seconds of CELERY_TASK_SOFT_TIME_LIMIT kept back for file_bugzilla_bug,
+    # the rest is shared between the other reboot methods
+    BUG_FILING_RESERVE = values.IntegerValue(60, environ_prefix=None)
+
+    # also accept ICMP loss as proof of a power cycle when a method has an
+    # out-of-band verifier (BMC, PDU or hypervisor power state)
+    REBOOT_VERIFY_WITH_PING = values.BooleanValue(True, environ_prefix=None)
+
+    # readiness probes run concurrently to declare a rebooted host up,
+    # any of: ping, ssh, rdp, taskcluster (worker claimed a new task)
+    UP_CHECKS = values.ListValue(['ping', 'ssh', 'rdp'], environ_prefix=None)
+    UP_CHECK_TIMEOUT = values.IntegerValue(10, environ_prefix=None)
+
+    # run reboot jobs from the API as a state machine in redis so waiting
+    # for a host to go down and come back up holds no worker slot
+    REBOOT_ASYNC = values.BooleanValue(True, environ_prefix=None)
+    # seconds without progress before a reboot job is resumed on worker start
+    REBOOT_RESUME_AFTER = values.IntegerValue(120, environ_prefix=None)
+
+    # probe every management path concurrently before the escalation and
+    # only try the reboot methods that are usable
+    REBOOT_PREFLIGHT = values.BooleanValue(True, environ_prefix=None)
+    PREFLIGHT_TIMEOUT = values.IntegerValue(10, environ_prefix=None)
+
     REBOOT_METHODS = values.ListValue([
         'ssh_reboot',
+        'ipmi_smart_reboot',  # power on, or cycle when already on
         'ipmi_reset',
-        'ipmi_cycle',
         'snmp_reboot',  # snmp pdu for mac minis
         'file_bugzilla_bug',  # give up and file a bug
     ], environ_prefix=None)
@@ -263,6 +362,8 @@ class Test(Base):
     XEN_URL = 'https://xenapiserver/'
     XEN_USERNAME = 'xen_dev_username'
     XEN_PASSWORD = values.Value('anything_zen_password')
+    XEN_SESSION_IDLE = 0
+    XEN_GUEST_TIMEOUT = 0
 
     ILO_USERNAME = 'ilo_dev_username'
     ILO_PASSWORD = values.Value('anything_ilo_password')
@@ -278,3 +379,12 @@ class Test(Base):
         ['project:relops-hardware-controller:{}'.format(task_name)]
         for task_name in TASK_NAMES
     ]
+
+    BULK_TASK_NAMES = [
+        'ssh_reboot',
+    ]
+
+    REQUIRED_BULK_TASKCLUSTER_SCOPE_SETS = [
+        ['project:relops-hardware-controller:{}'.format(task_name)]
+        for task_name in BULK_TASK_NAMES
+    ]
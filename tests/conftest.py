@@ -0,0 +1,18 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from django_redis import get_redis_connection
+
+
+@pytest.fixture
+def sel_redis():
+    """Yields the redis connection with the cached SEL entries cleared."""
+    redis = get_redis_connection('default')
+    for key in redis.keys('ipmi:sel:*'):
+        redis.delete(key)
+    yield redis
+    for key in redis.keys('ipmi:sel:*'):
+        redis.delete(key)
@@ -2,8 +2,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
+
 import mock
 import mohawk
+import pytest
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.http import urlencode
@@ -324,3 +327,94 @@ def test_job_list_returns_403_for_different_task_name_scope(client):
             'authorization': auth_header,
         })
         assert tc_auth_ctor.called
+
+
+def test_bulk_job_list_queues_one_job_for_all_workers(client):
+    uri = reverse('api:BulkJobList') + '?' + urlencode(dict(task_name='ssh_reboot'))
+
+    host = '127.0.0.1:9091'
+    url = 'http://' + host + uri
+    auth_header = get_hawk_auth_header('POST', url)
+
+    with mock.patch('taskcluster.Auth') as tc_auth_ctor, \
+            mock.patch('relops_hardware_controller.api.views.celery_bulk_call_command') as task_mock:
+        tc_client = tc_auth_ctor.return_value
+        tc_client.authenticateHawk.return_value = {
+            'scopes': ['project:relops-hardware-controller:ssh_reboot'],
+            'status': 'auth-success',
+            'clientId': 'mozilla-ldap/test@mozilla.com',
+        }
+        task_mock.delay.return_value.id = 'e62c4d06-8101-4074-b3c2-c639005a4430'
+
+        response = client.post(uri,
+                               data=json.dumps({'worker_ids': ['T-W1064-MS-001', 't-linux64-ms-002']}),
+                               content_type='application/json',
+                               HTTP_HOST=host,
+                               HTTP_AUTHORIZATION=auth_header)
+
+        assert response.status_code == 201
+        has_cors_headers(response)
+        job_data = task_mock.delay.call_args[0][0]
+        assert job_data['worker_ids'] == ['t-w1064-ms-001', 't-linux64-ms-002']
+        assert job_data['task_name'] == 'ssh_reboot'
+        assert response.json()['task_id'] == 'e62c4d06-8101-4074-b3c2-c639005a4430'
+
+
+def test_bulk_job_list_rejects_tasks_not_in_bulk_task_names(client):
+    uri = reverse('api:BulkJobList') + '?' + urlencode(dict(task_name='reboot'))
+
+    host = '127.0.0.1:9091'
+    url = 'http://' + host + uri
+    auth_header = get_hawk_auth_header('POST', url)
+
+    with mock.patch('taskcluster.Auth') as tc_auth_ctor, \
+            mock.patch('relops_hardware_controller.api.views.celery_bulk_call_command') as task_mock:
+        tc_client = tc_auth_ctor.return_value
+        tc_client.authenticateHawk.return_value = {
+            'scopes': ['project:relops-hardware-controller:ssh_reboot'],
+            'status': 'auth-success',
+        }
+
+        response = client.post(uri,
+                               data=json.dumps({'worker_ids': ['t-linux64-ms-002']}),
+                               content_type='application/json',
+                               HTTP_HOST=host,
+                               HTTP_AUTHORIZATION=auth_header)
+
+        assert response.status_code == 400
+        assert 'task_name' in response.json()
+        assert not task_mock.delay.called
+
+
+@pytest.mark.parametrize(
+    "body", [
+        ['t-linux64-ms-002'],
+        {'worker_ids': ['t-linux64-ms-002', None]},
+        {'worker_ids': 't-linux64-ms-002'},
+        {},
+    ], ids=['array', 'non_string_worker_id', 'string_worker_ids', 'no_worker_ids']
+)
+def test_bulk_job_list_rejects_malformed_bodies(client, body):
+    uri = reverse('api:BulkJobList') + '?' + urlencode(dict(task_name='ssh_reboot'))
+
+    host = '127.0.0.1:9091'
+    url = 'http://' + host + uri
+    auth_header = get_hawk_auth_header('POST', url)
+
+    with mock.patch('taskcluster.Auth') as tc_auth_ctor, \
+            mock.patch('relops_hardware_controller.api.views.celery_bulk_call_command') as task_mock:
+        tc_client = tc_auth_ctor.return_value
+        tc_client.authenticateHawk.return_value = {
+            'scopes': ['project:relops-hardware-controller:ssh_reboot'],
+            'status': 'auth-success',
+            'clientId': 'mozilla-ldap/test@mozilla.com',
+        }
+
+        response = client.post(uri,
+                               data=json.dumps(body),
+                               content_type='application/json',
+                               HTTP_HOST=host,
+                               HTTP_AUTHORIZATION=auth_header)
+
+        assert response.status_code == 400
+        assert not task_mock.delay.called
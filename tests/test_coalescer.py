@@ -0,0 +1,53 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+import pytest
+
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django_redis import get_redis_connection
+
+from relops_hardware_controller.api import coalescer
+
+
+@pytest.fixture
+def device():
+    def clear():
+        get_redis_connection('default').delete(coalescer.QUEUE_KEY.format('test', 'device'))
+        cache.delete(coalescer.LEADER_KEY.format('test', 'device'))
+
+    clear()
+    with mock.patch.object(coalescer, 'GRACE', 0):
+        yield 'device'
+    clear()
+
+
+def slow_batch(requests):
+    time.sleep(2)
+    return [request.upper() for request in requests]
+
+
+@pytest.mark.coalescer
+def test_waiter_outlasts_its_timeout_while_the_leader_runs(device):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(coalescer.run, 'test', device, 'a', 3, 0, slow_batch)
+        time.sleep(0.5)
+        # queued behind a batch taking longer than its own timeout
+        waiter = executor.submit(coalescer.run, 'test', device, 'b', 1, 0, lambda requests: ['B'])
+
+        assert leader.result() == 'A'
+        assert waiter.result() == 'B'
+
+
+@pytest.mark.coalescer
+def test_waiter_gives_up_on_a_stuck_queue(device):
+    # e.g. a leader whose worker died
+    cache.set(coalescer.LEADER_KEY.format('test', device), time.time(), 3)
+
+    with pytest.raises(CommandError, match='Timed out waiting for the coalesced test requests on device'):
+        coalescer.run('test', device, 'a', 1, 0, slow_batch)
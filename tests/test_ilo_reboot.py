@@ -2,6 +2,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import logging
+
+import hpilo
 import mock
 import pytest
 
@@ -9,6 +12,8 @@ from django.core.exceptions import ValidationError
 from django.core.management import call_command
 from django.core.management.base import CommandError
 
+from relops_hardware_controller.api import ilo as ilo_client
+
 
 @pytest.mark.ilo_reboot
 @pytest.mark.parametrize(
@@ -35,104 +40,173 @@ def test_ilo_reboot_requires_valid_arg(args):
 # TODO: test invalid kwargs
 
 
+@pytest.fixture
+def ilo_state():
+    ilo_client.forget('test.ilo.hostname')
+    yield
+    ilo_client.forget('test.ilo.hostname')
+
+
+def assert_ilo_ctor_called(mock_ilo_ctor, delayed=True, protocol=None):
+    mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
+                                          login='ilo_dev_username',
+                                          password='anything_ilo_password',
+                                          timeout=60,
+                                          delayed=delayed,
+                                          protocol=protocol,
+                                          ssl_context=mock.ANY)
+    assert isinstance(mock_ilo_ctor.call_args[1]['ssl_context'], ilo_client.ResumingContext)
+
+
 @pytest.mark.ilo_reboot
-def test_ilo_login_fails():
+def test_ilo_login_fails(ilo_state):
     with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
         mock_ilo_ctor.side_effect = Exception('ilo error logging in!')
 
         with pytest.raises(Exception):
             call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
 
-        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
-                                              login='ilo_dev_username',
-                                              password='anything_ilo_password',
-                                              timeout=60)
+        assert_ilo_ctor_called(mock_ilo_ctor)
 
 
 @pytest.mark.ilo_reboot
-def test_ilo_get_power_status_fails():
+def test_ilo_request_fails(ilo_state):
     with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
         mock_ilo = mock_ilo_ctor.return_value
-        mock_ilo.get_host_power_status.side_effect = Exception('ilo.get_power_status failed!')
+        mock_ilo.call_delayed.side_effect = hpilo.IloCommunicationError('Timeout connecting to test.ilo.hostname')
 
-        with pytest.raises(Exception):
+        with pytest.raises(hpilo.IloCommunicationError):
             call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
 
-        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
-                                              login='ilo_dev_username',
-                                              password='anything_ilo_password',
-                                              timeout=60)
+        assert_ilo_ctor_called(mock_ilo_ctor)
 
         mock_ilo.get_host_power_status.assert_called_once_with()
+        mock_ilo.reset_server.assert_called_once_with()
+        assert not mock_ilo.set_host_power.called
 
 
 @pytest.mark.ilo_reboot
-def test_ilo_soft_reboot_success():
+def test_ilo_soft_reboot_success(ilo_state, caplog):
+    caplog.set_level(logging.DEBUG)
     with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
         mock_ilo = mock_ilo_ctor.return_value
-        mock_ilo.get_host_power_status.return_value = 'ON'
+        mock_ilo.call_delayed.return_value = ['ON']
 
         call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
+        assert 'Got power status ON for ilo server test.ilo.hostname.' in caplog.messages
 
-        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
-                                              login='ilo_dev_username',
-                                              password='anything_ilo_password',
-                                              timeout=60)
+        assert_ilo_ctor_called(mock_ilo_ctor)
 
+        # status and reset go out as one request
         mock_ilo.get_host_power_status.assert_called_once_with()
         mock_ilo.reset_server.assert_called_once_with()
+        mock_ilo.call_delayed.assert_called_once_with()
+        assert not mock_ilo.set_host_power.called
+
+
+@pytest.mark.ilo_reboot
+def test_ilo_reboot_remembers_the_protocol(ilo_state):
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        mock_ilo_ctor.return_value.hostname = 'test.ilo.hostname'
+        mock_ilo_ctor.return_value.protocol = hpilo.ILO_HTTP
+        mock_ilo_ctor.return_value.call_delayed.return_value = ['ON']
+
+        call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
+        first_context = mock_ilo_ctor.call_args[1]['ssl_context']
+
+        mock_ilo_ctor.reset_mock()
+        call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
+
+        assert_ilo_ctor_called(mock_ilo_ctor, protocol=hpilo.ILO_HTTP)
+        assert mock_ilo_ctor.call_args[1]['ssl_context'] is first_context
+
+        # a communication error forgets it
+        mock_ilo_ctor.reset_mock()
+        mock_ilo_ctor.return_value.call_delayed.side_effect = hpilo.IloCommunicationError('Connection refused')
+        with pytest.raises(hpilo.IloCommunicationError):
+            call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
+        assert not ilo_client.knows_protocol('test.ilo.hostname')
+
+
+@pytest.mark.ilo_reboot
+def test_ilo_reboot_raises_on_a_failed_power_status(ilo_state):
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        mock_ilo = mock_ilo_ctor.return_value
+        mock_ilo.call_delayed.side_effect = hpilo.IloError('get_host_power_status failed!')
+        mock_ilo.get_host_power_status.side_effect = [None, hpilo.IloError('get_host_power_status failed!')]
+
+        with pytest.raises(hpilo.IloError):
+            call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
+
+        # only the batched reset went out
+        mock_ilo.reset_server.assert_called_once_with()
+        assert not mock_ilo.set_host_power.called
+
+
+@pytest.mark.ilo_reboot
+def test_ilo_reboot_does_not_resend_the_reset_of_a_batch_failing_on_the_status_read(ilo_state):
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        mock_ilo = mock_ilo_ctor.return_value
+        mock_ilo.call_delayed.side_effect = hpilo.IloError('get_host_power_status failed!')
+
+        call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
+
+        # the iLO ran the batched reset anyway
+        mock_ilo.reset_server.assert_called_once_with()
+        assert mock_ilo.get_host_power_status.mock_calls == [mock.call(), mock.call()]
+        assert not mock_ilo.set_host_power.called
 
 
 @pytest.mark.ilo_reboot
-def test_ilo_hard_reboot_success():
+@pytest.mark.parametrize(
+    "error", [
+        hpilo.IloError('ilo.reset_server failed!'),
+        hpilo.IloPermissionError('User does NOT have correct privilege for action. RESET_SERVER_PRIV required.',
+                                 0x0023),
+    ], ids=['reset_error', 'reset_privilege']
+)
+def test_ilo_hard_reboot_success(ilo_state, error):
     with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
         mock_ilo = mock_ilo_ctor.return_value
-        mock_ilo.get_host_power_status.return_value = 'ON'
-        mock_ilo.reset_server.side_effect = Exception('ilo.reset_server failed!')
+        mock_ilo.call_delayed.side_effect = error
+        mock_ilo.reset_server.side_effect = [None, error]
 
         call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
 
-        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
-                                              login='ilo_dev_username',
-                                              password='anything_ilo_password',
-                                              timeout=60)
+        assert_ilo_ctor_called(mock_ilo_ctor)
 
+        # batched, then only the reset again
         mock_ilo.get_host_power_status.assert_called_once_with()
-        mock_ilo.reset_server.assert_called_once_with()
+        assert mock_ilo.reset_server.mock_calls == [mock.call(), mock.call()]
 
-        assert len(mock_ilo.set_host_power.mock_calls) == 2, 'set_host_power not called twice'
-        mock_ilo.set_host_power.mock_calls[0] == mock.call(host_power=False)
-        mock_ilo.set_host_power.assert_called_with(host_power=True)  # check last call
+        assert mock_ilo.delayed is False
+        assert mock_ilo.set_host_power.mock_calls == [mock.call(host_power=False), mock.call(host_power=True)]
 
 
 @pytest.mark.ilo_reboot
-def test_ilo_hard_reboot_power_off_fails():
+def test_ilo_hard_reboot_power_off_fails(ilo_state):
     with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
         mock_ilo = mock_ilo_ctor.return_value
-        mock_ilo.get_host_power_status.return_value = 'ON'
-        mock_ilo.reset_server.side_effect = Exception('ilo.reset_server failed!')
+        mock_ilo.call_delayed.side_effect = hpilo.IloError('ilo.reset_server failed!')
+        mock_ilo.reset_server.side_effect = [None, hpilo.IloError('ilo.reset_server failed!')]
         mock_ilo.set_host_power.side_effect = Exception('ilo.set_host_power off failed!')
 
         with pytest.raises(Exception):
             call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
 
-        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
-                                              login='ilo_dev_username',
-                                              password='anything_ilo_password',
-                                              timeout=60)
+        assert_ilo_ctor_called(mock_ilo_ctor)
 
-        mock_ilo.get_host_power_status.assert_called_once_with()
-        mock_ilo.reset_server.assert_called_once_with()
+        assert mock_ilo.reset_server.call_count == 2
 
         mock_ilo.set_host_power.assert_called_once_with(host_power=False)
 
 
 @pytest.mark.ilo_reboot
-def test_ilo_hard_reboot_power_on_fails():
+def test_ilo_hard_reboot_power_on_fails(ilo_state):
     with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
         mock_ilo = mock_ilo_ctor.return_value
-        mock_ilo.get_host_power_status.return_value = 'ON'
-        mock_ilo.reset_server.side_effect = Exception('ilo.reset_server failed!')
+        mock_ilo.call_delayed.side_effect = hpilo.IloError('ilo.reset_server failed!')
+        mock_ilo.reset_server.side_effect = [None, hpilo.IloError('ilo.reset_server failed!')]
         mock_ilo.set_host_power.side_effect = [
             None,
             Exception('ilo.set_host_power off failed!')
@@ -141,14 +215,8 @@ def test_ilo_hard_reboot_power_on_fails():
         with pytest.raises(Exception):
             call_command('ilo_reboot', 'test.ilo.hostname', delay=1)
 
-        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
-                                              login='ilo_dev_username',
-                                              password='anything_ilo_password',
-                                              timeout=60)
+        assert_ilo_ctor_called(mock_ilo_ctor)
 
-        mock_ilo.get_host_power_status.assert_called_once_with()
-        mock_ilo.reset_server.assert_called_once_with()
+        assert mock_ilo.reset_server.call_count == 2
 
-        assert len(mock_ilo.set_host_power.mock_calls) == 2, 'set_host_power not called twice'
-        mock_ilo.set_host_power.mock_calls[0] == mock.call(host_power=False)
-        mock_ilo.set_host_power.assert_called_with(host_power=True)  # check last call
+        assert mock_ilo.set_host_power.mock_calls == [mock.call(host_power=False), mock.call(host_power=True)]
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from django.core.exceptions import ImproperlyConfigured
+
+from relops_hardware_controller.api.ipmi_config import (
+    compile_ipmi_config,
+    get_ipmi_target,
+)
+from relops_hardware_controller.api.management.commands.ipmi import lookup
+
+
+worker_config = {
+    'types': {
+        'moonshot': {
+            'args': ['-B 0', '-b 7'],
+            'map': {
+                'c1n1': ['-T 0x82', '-t 0x72'],
+            },
+            'commands': {
+                'ipmi_reset': ['chassis', 'power', 'reset'],
+            },
+        },
+    },
+    'servers': {
+        'moon-chassis-1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass', 'type': 'moonshot'},
+        't-linux64-ms-001': {'parent': 'moon-chassis-1', 'addr': 'c1n1'},
+        't-w1064-ms-001': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'},
+        'test_tc_worker_id': {'pdu': 'pdu1.r201-6.ops.releng.mdc1.mozilla.com:AA1'},
+    },
+}
+
+
+@pytest.mark.ipmi_config
+def test_compile_ipmi_config():
+    table = compile_ipmi_config(worker_config)
+
+    assert sorted(table) == ['moon-chassis-1', 't-linux64-ms-001', 't-w1064-ms-001']
+
+    cartridge = table['t-linux64-ms-001']
+    assert cartridge.bmc == 'moon-chassis-1'
+    assert cartridge.args == ('-B 0', '-b 7', '-T 0x82', '-t 0x72')
+    assert cartridge.commands['ipmi_reset'] == ('chassis', 'power', 'reset')
+    assert cartridge.commands['ipmi_status'] == ('chassis', 'power', 'status')
+
+    assert table['t-w1064-ms-001'].args == ()
+
+    with pytest.raises(TypeError):
+        table['t-linux64-ms-002'] = cartridge
+    with pytest.raises(TypeError):
+        cartridge.commands['ipmi_reset'] = ('mc', 'reset', 'cold')
+
+
+@pytest.mark.ipmi_config
+def test_compile_ipmi_config_lists_every_bad_entry():
+    with pytest.raises(ImproperlyConfigured) as excinfo:
+        compile_ipmi_config({
+            'types': {'moonshot': {'args': '-B 0', 'map': {}}},
+            'servers': {
+                'moon-chassis-1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass', 'type': 'moonshot'},
+                'moon-chassis-2': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass', 'type': 'mystery'},
+                't-linux64-ms-001': {'parent': 'moon-chassis-1', 'addr': 'c9n1'},
+                't-linux64-ms-002': {'parent': 'moon-chassis-3', 'addr': 'c1n1'},
+                't-w1064-ms-001': {'user': 'test_ipmi_user'},
+            },
+        })
+
+    message = str(excinfo.value)
+    assert 'types.moonshot.args must be a list of strings' in message
+    assert 'servers.moon-chassis-2: unknown type mystery' in message
+    assert 'servers.t-linux64-ms-001: addr c9n1 is not in types.moonshot.map' in message
+    assert 'servers.t-linux64-ms-002: parent moon-chassis-3 is not in servers' in message
+    assert 'servers.t-w1064-ms-001: no IPMI user and password' in message
+
+
+@pytest.mark.ipmi_config
+def test_lookup_uses_the_compiled_table(settings):
+    settings.WORKER_CONFIG = worker_config
+
+    assert lookup('t-linux64-ms-001.test.releng.mdc1.mozilla.com', 'ipmi_reset') == (
+        'moon-chassis-1', 'test_ipmi_user', 'test_ipmi_pass',
+        ['-B 0', '-b 7', '-T 0x82', '-t 0x72'], ['chassis', 'power', 'reset'])
+    assert lookup('t-w1064-ms-001', 'chassis power status')[4] == ['chassis', 'power', 'status']
+
+    with pytest.raises(KeyError):
+        get_ipmi_target('test_tc_worker_id')
+
+    settings.WORKER_CONFIG = {'servers': {}}
+    with pytest.raises(KeyError):
+        get_ipmi_target('t-w1064-ms-001')
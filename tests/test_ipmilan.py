@@ -0,0 +1,599 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import hmac
+import os
+import socket
+import struct
+import threading
+
+import mock
+import pytest
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import (
+    Cipher,
+    algorithms,
+    modes,
+)
+from django.core.management import call_command
+
+from relops_hardware_controller.api import ipmilan
+
+
+def _checksum(data):
+    return -sum(data) & 0xff
+
+
+def _message(first, netfn, second, seq, cmd, data):
+    header = bytes([first, netfn << 2])
+    body = bytes([second, seq << 2, cmd]) + bytes(data)
+    return header + bytes([_checksum(header)]) + body + bytes([_checksum(body)])
+
+
+class FakeBmc(threading.Thread):
+    """An IPMI simulator answering RMCP+ sessions with cipher suite 3 on
+    localhost, Send Message bridging and the chassis and SEL commands.
+    """
+
+    def __init__(self, username, password):
+        super().__init__()
+        self.username = username.encode()
+        self.kuid = password.encode().ljust(20, b'\x00')
+        self.power = 'on'
+        self.sel = []
+        self.requests = []
+        self.opened_sessions = 0
+        self.closed_sessions = 0
+        self.session_open = False
+        self.dead_targets = set()
+        self.refused_controls = set()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        self.seq = 0
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                packet, self.client = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            payload_type = packet[5]
+            length = struct.unpack('<H', packet[14:16])[0]
+            payload = packet[16:16 + length]
+            if payload_type == 0x10:
+                self.open_session(payload)
+            elif payload_type == 0x12:
+                self.rakp1(payload)
+            elif payload_type == 0x14:
+                self.rakp3(payload)
+            elif payload_type == 0xc0 and self.session_open:
+                expected = hmac.new(self.k1, packet[4:-12], hashlib.sha1).digest()[:12]
+                assert packet[-12:] == expected
+                decryptor = self.cipher(payload[:16]).decryptor()
+                plain = decryptor.update(payload[16:]) + decryptor.finalize()
+                self.request(plain[:-1 - plain[-1]])
+
+    def send(self, payload_type, payload):
+        if payload_type != 0x00:
+            self.sock.sendto(b'\x06\x00\xff\x07' + struct.pack('<BBIIH', 6, payload_type, 0, 0, len(payload)) +
+                             payload, self.client)
+            return
+
+        iv = os.urandom(16)
+        pad = -(len(payload) + 1) % 16
+        encryptor = self.cipher(iv).encryptor()
+        payload = iv + encryptor.update(payload + bytes(range(1, pad + 1)) + bytes([pad])) + encryptor.finalize()
+        self.seq += 1
+        packet = struct.pack('<BBIIH', 6, 0xc0, self.console_id, self.seq, len(payload)) + payload
+        pad = -(len(packet) + 2) % 4
+        packet += b'\xff' * pad + bytes([pad, 7])
+        self.sock.sendto(b'\x06\x00\xff\x07' + packet + hmac.new(self.k1, packet, hashlib.sha1).digest()[:12],
+                         self.client)
+
+    def cipher(self, iv):
+        return Cipher(algorithms.AES(self.k2[:16]), modes.CBC(iv), backend=default_backend())
+
+    def open_session(self, payload):
+        self.console_id = struct.unpack('<I', payload[4:8])[0]
+        self.bmc_id = b'\x0a\x0b\x0c\x0d'
+        self.opened_sessions += 1
+        self.session_open = True
+        self.send(0x11, payload[:1] + b'\x00\x03\x00' + payload[4:8] + self.bmc_id + payload[8:32])
+
+    def rakp1(self, payload):
+        self.rm = payload[8:24]
+        self.role = payload[24:25] + payload[27:28] + payload[28:28 + payload[27]]
+        self.rc = os.urandom(16)
+        self.guid = os.urandom(16)
+        console_id = struct.pack('<I', self.console_id)
+        if self.role[2:] != self.username:
+            self.send(0x13, payload[:1] + b'\x0d\x00\x00' + console_id)
+            return
+        auth_code = hmac.new(self.kuid, console_id + self.bmc_id + self.rm + self.rc + self.guid + self.role,
+                             hashlib.sha1).digest()
+        self.send(0x13, payload[:1] + b'\x00\x00\x00' + console_id + self.rc + self.guid + auth_code)
+
+    def rakp3(self, payload):
+        console_id = struct.pack('<I', self.console_id)
+        expected = hmac.new(self.kuid, self.rc + console_id + self.role, hashlib.sha1).digest()
+        if payload[8:28] != expected:
+            self.send(0x15, payload[:1] + b'\x0f\x00\x00' + console_id)
+            return
+        sik = hmac.new(self.kuid, self.rm + self.rc + self.role, hashlib.sha1).digest()
+        self.k1 = hmac.new(sik, b'\x01' * 20, hashlib.sha1).digest()
+        self.k2 = hmac.new(sik, b'\x02' * 20, hashlib.sha1).digest()
+        self.send(0x15, payload[:1] + b'\x00\x00\x00' + console_id +
+                  hmac.new(sik, self.rm + self.bmc_id + self.guid, hashlib.sha1).digest()[:12])
+
+    def request(self, message, hops=()):
+        rs_addr, netfn, rq_addr, seq, cmd = message[0], message[1] >> 2, message[3], message[4] >> 2, message[5]
+        data = message[6:-1]
+
+        if netfn == 0x06 and cmd == 0x34:
+            hop = (data[0] & 0x0f, data[1])
+            if not hops:
+                self.send(0x00, _message(rq_addr, netfn + 1, rs_addr, seq, cmd, b'\x00'))
+            if hop[1] in self.dead_targets:
+                return None
+            inner = self.request(data[1:], hops + (hop,))
+            if inner is None:
+                return None
+            response = b'\x00' + inner
+        else:
+            self.requests.append((hops, netfn, cmd, bytes(data)))
+            response = self.command(netfn, cmd, data)
+
+        message = _message(rq_addr, netfn + 1, rs_addr, seq, cmd, response)
+        if not hops:
+            self.send(0x00, message)
+        return message
+
+    def command(self, netfn, cmd, data):
+        if (netfn, cmd) == (0x06, 0x3b):
+            return b'\x00' + data[:1]
+        if (netfn, cmd) == (0x06, 0x3c):
+            self.closed_sessions += 1
+            self.session_open = False
+            return b'\x00'
+        if (netfn, cmd) == (0x00, 0x01):
+            return bytes([0, 0x01 if self.power == 'on' else 0x00, 0, 0])
+        if (netfn, cmd) == (0x00, 0x02):
+            if data[0] in self.refused_controls:
+                return b'\xd5'
+            self.power = {0: 'off', 1: 'on', 2: 'on', 3: 'on'}[data[0]]
+            return b'\x00'
+        if (netfn, cmd) == (0x0a, 0x43):
+            record_id = struct.unpack('<H', data[2:4])[0]
+            index = 0 if record_id == 0 else [entry[0] for entry in self.sel].index(record_id)
+            if not self.sel:
+                return b'\xcb'
+            next_id = self.sel[index + 1][0] if index + 1 < len(self.sel) else 0xffff
+            return b'\x00' + struct.pack('<H', next_id) + self.sel[index][1]
+        return b'\xc1'
+
+    def add_sel(self, record_id, timestamp, sensor_type, offset):
+        self.sel.append((record_id, struct.pack('<HBIHBBBBBBB', record_id, 0x02, timestamp, 0x0020, 0x04,
+                                                sensor_type, 0x01, 0x6f, offset, 0xff, 0xff)))
+
+
+@pytest.fixture
+def fake_bmc():
+    bmc = FakeBmc('test_ipmi_user', 'test_ipmi_pass')
+    bmc.start()
+    with mock.patch.object(ipmilan, 'RMCP_PORT', bmc.port):
+        yield bmc
+        ipmilan.pool.close_all()
+    bmc.stop()
+
+
+@pytest.mark.ipmilan
+def test_parse_bridge_args():
+    assert ipmilan.parse_bridge_args([]) == []
+    assert ipmilan.parse_bridge_args(['-B 0', '-b 7', '-T 0x82', '-t 0x72']) == [(0, 0x82), (7, 0x72)]
+    assert ipmilan.parse_bridge_args(['-b', '7', '-t', '0x72']) == [(7, 0x72)]
+
+    with pytest.raises(ipmilan.IpmiError):
+        ipmilan.parse_bridge_args(['-I', 'lan'])
+
+
+@pytest.mark.ipmilan
+def test_chassis_power_over_rmcp_plus(settings, fake_bmc):
+    settings.IPMI_SESSION_IDLE = 0
+
+    def run(*command):
+        return ipmilan.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', [], list(command))
+
+    assert run('chassis', 'power', 'status') == 'Chassis Power is on\n'
+    assert run('chassis', 'power', 'off') == 'Chassis Power Control: Down/Off\n'
+    assert run('chassis', 'power', 'status') == 'Chassis Power is off\n'
+    assert run('chassis', 'power', 'on') == 'Chassis Power Control: Up/On\n'
+    assert fake_bmc.power == 'on'
+
+    assert fake_bmc.closed_sessions == 4
+    assert (0x00, 0x02, b'\x00') in [request[1:] for request in fake_bmc.requests]
+
+
+@pytest.mark.ipmilan
+def test_bridged_commands_reach_the_moonshot_cartridge(fake_bmc):
+    output = ipmilan.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass',
+                         ['-B 0', '-b 7', '-T 0x82', '-t 0x72'], ['chassis', 'power', 'reset'])
+
+    assert output == 'Chassis Power Control: Reset\n'
+    assert ((0, 0x82), (7, 0x72)) in [request[0] for request in fake_bmc.requests]
+    bridged = [request for request in fake_bmc.requests if request[0]]
+    assert bridged == [(((0, 0x82), (7, 0x72)), 0x00, 0x02, b'\x03')]
+
+
+@pytest.mark.ipmilan
+def test_sel_list_last(fake_bmc):
+    fake_bmc.add_sel(0x01, 1527152400, 0x12, 0x05)
+    fake_bmc.add_sel(0x02, 1527152460, 0x1d, 0x00)
+    fake_bmc.add_sel(0x0a, 1527152520, 0x1f, 0x01)
+
+    output = ipmilan.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', [], ['sel', 'list', 'last', '2'])
+
+    assert output.splitlines() == [
+        '   2 | 05/24/2018 | 09:01:00 | System Boot Initiated #0x01 | Initiated by power up | Asserted',
+        '   a | 05/24/2018 | 09:02:00 | OS Boot #0x01 | C: boot completed | Asserted',
+    ]
+
+
+@pytest.mark.ipmilan
+def test_wrong_password_fails_the_session(fake_bmc):
+    with pytest.raises(ipmilan.IpmiError) as excinfo:
+        ipmilan.run('127.0.0.1', 'test_ipmi_user', 'not_the_pass', [], ['chassis', 'power', 'status'])
+
+    assert 'RAKP2' in str(excinfo.value)
+    assert not fake_bmc.requests
+
+
+@pytest.mark.ipmilan
+def test_ipmi_command_reports_auth_errors(settings, fake_bmc):
+    from relops_hardware_controller.api.management.commands.ipmitool import IpmiCommandError
+
+    settings.IPMI_CLIENT = 'native'
+    settings.WORKER_CONFIG = {
+        'servers': {'127.0.0.1': {'user': 'test_ipmi_user', 'password': 'not_the_pass'}},
+    }
+
+    with pytest.raises(IpmiCommandError) as excinfo:
+        call_command('ipmi', '127.0.0.1', 'ipmi_status')
+
+    assert excinfo.value.status == 'auth_error'
+
+
+@pytest.mark.ipmilan
+def test_sel_list_empty(fake_bmc):
+    assert ipmilan.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', [], ['sel', 'list']) == ''
+
+
+@pytest.mark.ipmilan
+def test_unsupported_command_does_not_open_a_session(fake_bmc):
+    with pytest.raises(ipmilan.IpmiError):
+        ipmilan.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', [], ['mc', 'info'])
+
+
+@pytest.mark.ipmilan
+def test_ipmi_command_uses_native_client(settings, fake_bmc):
+    settings.IPMI_CLIENT = 'native'
+    settings.WORKER_CONFIG = {
+        'types': {
+            'moonshot': {
+                'args': ['-B 0', '-b 7'],
+                'map': {'c1n1': ['-T 0x82', '-t 0x72']},
+                'commands': {'ipmi_status': ['chassis', 'power', 'status']},
+            },
+        },
+        'servers': {
+            '127.0.0.1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass', 'type': 'moonshot'},
+            't-linux64-ms-001': {'parent': '127.0.0.1', 'addr': 'c1n1'},
+        },
+    }
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        output = call_command('ipmi', 't-linux64-ms-001.test.releng.mdc1.mozilla.com', 'ipmi_status')
+
+        assert not cmd_mock.called
+    assert output == 'Chassis Power is on\n'
+    assert ((0, 0x82), (7, 0x72)) in [request[0] for request in fake_bmc.requests]
+
+
+@pytest.mark.ipmilan
+def test_pool_reuses_one_session_per_bmc(fake_bmc):
+    pool = ipmilan.SessionPool()
+    cartridges = [['-B 0', '-b 7', '-T 0x{:x}'.format(0x82 + 2 * index), '-t 0x72'] for index in range(3)]
+
+    for bridge_args in cartridges:
+        pool.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', 'OPERATOR',
+                 ipmilan.parse_bridge_args(bridge_args), lambda session: session.power('reset'), 30)
+
+    assert fake_bmc.opened_sessions == 1
+    assert [request[0][0] for request in fake_bmc.requests if request[0]] == [(0, 0x82), (0, 0x84), (0, 0x86)]
+
+    pool.close_all()
+    assert fake_bmc.closed_sessions == 1
+
+
+@pytest.mark.ipmilan
+def test_pool_serialises_concurrent_requests(fake_bmc):
+    pool = ipmilan.SessionPool()
+    results = []
+
+    def status():
+        results.append(pool.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', 'OPERATOR', [],
+                                lambda session: session.power_status(), 30))
+
+    threads = [threading.Thread(target=status) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['on'] * 5
+    assert fake_bmc.opened_sessions == 1
+    pool.close_all()
+
+
+@pytest.mark.ipmilan
+def test_pool_reopens_idle_and_stale_sessions(fake_bmc):
+    pool = ipmilan.SessionPool(timeout=0.2, retries=1)
+
+    def status(max_idle=30):
+        return pool.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', 'OPERATOR', [],
+                        lambda session: session.power_status(), max_idle)
+
+    status()
+    status(max_idle=-1)
+    assert fake_bmc.opened_sessions == 2
+
+    fake_bmc.session_open = False  # the BMC expired the session
+
+    assert status() == 'on'
+    assert fake_bmc.opened_sessions == 3
+    pool.close_all()
+
+
+@pytest.mark.ipmilan
+def test_pool_does_not_repeat_a_power_action_on_a_stale_session(fake_bmc):
+    pool = ipmilan.SessionPool(timeout=0.2, retries=1)
+
+    def run(command):
+        return pool.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', 'OPERATOR', [],
+                        ipmilan.command_action(command), 30)
+
+    run(['chassis', 'power', 'status'])
+    fake_bmc.session_open = False  # the BMC expired the session
+
+    with pytest.raises(ipmilan.IpmiError) as excinfo:
+        run(['chassis', 'power', 'reset'])
+    assert excinfo.value.code == ipmilan.COMPLETION_TIMEOUT
+    assert fake_bmc.opened_sessions == 1
+
+    # reads still reopen the session
+    assert run(['chassis', 'power', 'status']) == 'Chassis Power is on\n'
+    assert fake_bmc.opened_sessions == 2
+    pool.close_all()
+
+
+@pytest.mark.ipmilan
+def test_batch_on_a_stale_session_sends_each_power_action_once(settings, fake_bmc):
+    settings.IPMI_SESSION_IDLE = 30
+    with mock.patch.object(ipmilan, 'pool', ipmilan.SessionPool(timeout=0.2, retries=1)):
+        ipmilan.run('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', [], ['chassis', 'power', 'status'])
+        fake_bmc.session_open = False
+
+        first, second = ipmilan.run_batch('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', [
+            ([], ['chassis', 'power', 'reset']),
+            ([], ['chassis', 'power', 'cycle']),
+        ])
+        ipmilan.pool.close_all()
+
+    assert first.code == ipmilan.COMPLETION_TIMEOUT
+    assert second == 'Chassis Power Control: Cycle\n'
+    assert fake_bmc.opened_sessions == 2
+
+
+@pytest.mark.ipmilan
+def test_ipmi_command_shares_the_pooled_session(settings, fake_bmc):
+    settings.IPMI_CLIENT = 'native'
+    settings.IPMI_SESSION_IDLE = 30
+    settings.WORKER_CONFIG = {
+        'types': {},
+        'servers': {
+            '127.0.0.1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'},
+        },
+    }
+
+    for _ in range(3):
+        assert call_command('ipmi', '127.0.0.1', 'chassis power status') == 'Chassis Power is on\n'
+
+    assert fake_bmc.opened_sessions == 1
+
+
+moonshot_config = {
+    'types': {
+        'moonshot': {
+            'args': ['-B 0', '-b 7'],
+            'map': {
+                'c1n1': ['-T 0x82', '-t 0x72'],
+                'c2n1': ['-T 0x84', '-t 0x72'],
+                'c3n1': ['-T 0x86', '-t 0x72'],
+            },
+            'commands': {
+                'ipmi_status': ['chassis', 'power', 'status'],
+                'ipmi_reset': ['chassis', 'power', 'reset'],
+            },
+        },
+    },
+    'servers': {
+        '127.0.0.1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass', 'type': 'moonshot'},
+        't-linux64-ms-001': {'parent': '127.0.0.1', 'addr': 'c1n1'},
+        't-linux64-ms-002': {'parent': '127.0.0.1', 'addr': 'c2n1'},
+        't-linux64-ms-003': {'parent': '127.0.0.1', 'addr': 'c3n1'},
+    },
+}
+
+
+@pytest.mark.ipmilan
+def test_bridged_target_timeout_keeps_the_session(fake_bmc):
+    fake_bmc.dead_targets.add(0x84)
+
+    with ipmilan.Session('127.0.0.1', 'test_ipmi_user', 'test_ipmi_pass', timeout=0.2, retries=1,
+                         hops=[(0, 0x84), (7, 0x72)]) as session:
+        with pytest.raises(ipmilan.IpmiError) as excinfo:
+            session.power('reset')
+
+        assert excinfo.value.code == ipmilan.COMPLETION_TIMEOUT
+
+        session.hops = [(0, 0x82), (7, 0x72)]
+        session.power('reset')
+
+    assert fake_bmc.opened_sessions == 1
+
+
+@pytest.mark.ipmilan
+def test_ipmi_batch_runs_a_chassis_over_one_session(settings, fake_bmc):
+    settings.IPMI_CLIENT = 'native'
+    settings.IPMI_SESSION_IDLE = 0
+    settings.WORKER_CONFIG = moonshot_config
+
+    output = call_command('ipmi', 't-linux64-ms-001', 't-linux64-ms-002', 't-linux64-ms-003', 'unknown-host',
+                          'ipmi_reset')
+
+    assert output.splitlines() == [
+        't-linux64-ms-001: Chassis Power Control: Reset',
+        't-linux64-ms-002: Chassis Power Control: Reset',
+        't-linux64-ms-003: Chassis Power Control: Reset',
+        "unknown-host: error No IPMI config for unknown-host: 'unknown-host'",
+    ]
+    assert fake_bmc.opened_sessions == 1
+    assert [request[0][0][1] for request in fake_bmc.requests if request[0]] == [0x82, 0x84, 0x86]
+
+
+@pytest.mark.ipmilan
+def test_ipmi_coalesces_concurrent_chassis_requests(settings, fake_bmc):
+    settings.IPMI_CLIENT = 'native'
+    settings.IPMI_SESSION_IDLE = 0
+    settings.IPMI_COALESCE_WINDOW = 1
+    settings.WORKER_CONFIG = moonshot_config
+    outputs = {}
+
+    def reset(hostname):
+        outputs[hostname] = call_command('ipmi', hostname, 'ipmi_reset')
+
+    threads = [threading.Thread(target=reset, args=('t-linux64-ms-00{}'.format(node),)) for node in range(1, 4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outputs == {'t-linux64-ms-00{}'.format(node): 'Chassis Power Control: Reset\n' for node in range(1, 4)}
+    assert fake_bmc.opened_sessions == 1
+
+    # status reads are not held back for a batch
+    assert call_command('ipmi', 't-linux64-ms-001', 'ipmi_status') == 'Chassis Power is on\n'
+
+
+@pytest.mark.ipmilan
+def test_ipmitool_chassis_requests_are_not_coalesced(settings):
+    settings.IPMI_CLIENT = 'ipmitool'
+    settings.IPMI_COALESCE_WINDOW = 1
+    settings.WORKER_CONFIG = moonshot_config
+
+    with mock.patch('relops_hardware_controller.api.coalescer.run') as run_mock, \
+            mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.return_value = 'Chassis Power Control: Reset\n'
+        assert call_command('ipmi', 't-linux64-ms-001', 'ipmi_reset') == 'Chassis Power Control: Reset\n'
+    assert not run_mock.called
+
+
+@pytest.mark.ipmilan
+def test_ipmi_smart_reboot_reads_power_first(settings, fake_bmc):
+    settings.IPMI_CLIENT = 'native'
+    settings.IPMI_SESSION_IDLE = 0
+    settings.WORKER_CONFIG = {
+        'servers': {'127.0.0.1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'}},
+    }
+
+    fake_bmc.power = 'off'
+    assert call_command('ipmi', '127.0.0.1', 'ipmi_smart_reboot') == (
+        'Chassis Power was off\nChassis Power Control: Up/On\nChassis Power is on\n')
+
+    assert call_command('ipmi', '127.0.0.1', 'ipmi_smart_reboot') == (
+        'Chassis Power was on\nChassis Power Control: Cycle\nChassis Power is on\n')
+
+    fake_bmc.refused_controls.add(0x02)  # cycle
+    assert call_command('ipmi', '127.0.0.1', 'ipmi_smart_reboot') == (
+        'Chassis Power was on\nChassis Power Control: Reset\nChassis Power is on\n')
+
+    assert fake_bmc.opened_sessions == 3
+    assert [request[1:] for request in fake_bmc.requests if request[1:3] == (0x00, 0x02)] == [
+        (0x00, 0x02, b'\x01'), (0x00, 0x02, b'\x02'), (0x00, 0x02, b'\x02'), (0x00, 0x02, b'\x03')]
+
+
+@pytest.mark.ipmilan
+def test_ipmi_ensure_on_leaves_a_running_node_alone(settings, fake_bmc):
+    settings.IPMI_CLIENT = 'native'
+    settings.WORKER_CONFIG = moonshot_config
+
+    output = call_command('ipmi', 't-linux64-ms-001', 't-linux64-ms-002', 'ipmi_ensure_on')
+
+    assert output.splitlines() == [
+        't-linux64-ms-001: Chassis Power was on Chassis Power is on',
+        't-linux64-ms-002: Chassis Power was on Chassis Power is on',
+    ]
+    assert not [request for request in fake_bmc.requests if request[1:3] == (0x00, 0x02)]
+
+
+@pytest.mark.ipmilan
+def test_ipmi_list_reads_only_new_sel_entries(settings, fake_bmc, sel_redis):
+    settings.IPMI_CLIENT = 'native'
+    settings.WORKER_CONFIG = {
+        'servers': {'127.0.0.1': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'}},
+    }
+    fake_bmc.add_sel(0x01, 1527152400, 0x12, 0x05)
+    fake_bmc.add_sel(0x02, 1527152460, 0x1d, 0x00)
+
+    def sel_reads():
+        return [request[3] for request in fake_bmc.requests if request[1:3] == (0x0a, 0x43)]
+
+    assert len(call_command('ipmi', '127.0.0.1', 'ipmi_list').splitlines()) == 2
+    assert len(sel_reads()) == 2
+
+    fake_bmc.add_sel(0x0a, 1527152520, 0x1f, 0x01)
+    output = call_command('ipmi', '127.0.0.1', 'ipmi_list')
+
+    assert output.splitlines()[-1] == (
+        '   a | 05/24/2018 | 09:02:00 | OS Boot #0x01 | C: boot completed | Asserted')
+    # the cursor entry for its next record id then the new entry
+    assert [struct.unpack('<H', data[2:4])[0] for data in sel_reads()[2:]] == [0x02, 0x0a]
+
+    assert call_command('ipmi', '127.0.0.1', 'ipmi_list', cached=True) == output
+    assert len(sel_reads()) == 4
+
+
+@pytest.mark.ipmilan
+def test_ipmi_list_refreshes_a_chassis_over_one_session(settings, fake_bmc, sel_redis):
+    settings.IPMI_CLIENT = 'native'
+    settings.IPMI_SESSION_IDLE = 0
+    settings.WORKER_CONFIG = moonshot_config
+    fake_bmc.add_sel(0x01, 1527152400, 0x12, 0x05)
+
+    output = call_command('ipmi', 't-linux64-ms-002', 'ipmi_list', chassis=True)
+
+    line = '   1 | 05/24/2018 | 09:00:00 | System Event #0x01 | Timestamp Clock Sync | Asserted'
+    assert output.splitlines() == ['{}: {}'.format(hostname, line) for hostname in [
+        '127.0.0.1', 't-linux64-ms-001', 't-linux64-ms-002', 't-linux64-ms-003']]
+    assert fake_bmc.opened_sessions == 1
@@ -2,6 +2,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import subprocess
+
 import mock
 import pytest
 
@@ -80,3 +82,80 @@ def test_ipmitool_localhost_success():
             'mc', 'info'], timeout=1, stderr=-2)
 
         assert output == 'output'
+
+
+@pytest.mark.ipmitool
+@pytest.mark.parametrize(
+    "returncode, output, status, power", [
+        (0, 'Chassis Power is on\n', 'ok', 'on'),
+        (0, 'Chassis Power Control: Cycle\n', 'ok', None),
+        (0, '   1 | 04/02/2018 | 10:11:12 | Session Audit #0xff | Invalid Username or Password | Asserted\n',
+         'ok', None),
+        (1, 'Error in open session response message : insufficient resources for session\n'
+            'Error: Unable to establish IPMI v2 / RMCP+ session\n', 'unreachable', None),
+        (1, 'RAKP 2 HMAC is invalid\nError: Unable to establish IPMI v2 / RMCP+ session\n', 'auth_error', None),
+        (1, 'Error: Unable to establish IPMI v2 / RMCP+ session\n', 'unreachable', None),
+        (1, 'Invalid chassis power command: bounce\n', 'unsupported', None),
+        (1, 'Set Chassis Power Control to Cycle failed: Command not supported in present state\n',
+         'unsupported', None),
+        (None, '', 'timeout', None),
+        (1, 'something else\n', 'unknown', None),
+    ], ids=['power_status', 'power_action', 'sel_session_audit', 'no_session', 'bad_password', 'no_bmc', 'bad_command',
+            'unsupported_state', 'timeout', 'unknown']
+)
+def test_ipmitool_parse_result(returncode, output, status, power):
+    from relops_hardware_controller.api.management.commands.ipmitool import parse_result
+
+    result = parse_result(returncode, output)
+    assert result.status == status
+    assert result.power == power
+    assert result.output == output
+
+
+@pytest.mark.ipmitool
+def test_ipmitool_raises_on_auth_error():
+    from relops_hardware_controller.api.management.commands.ipmitool import IpmiCommandError
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = subprocess.CalledProcessError(
+            1, 'ipmitool', output='RAKP 2 HMAC is invalid\nError: Unable to establish IPMI v2 / RMCP+ session\n')
+        with pytest.raises(IpmiCommandError) as excinfo:
+            call_command('ipmitool', *[
+                '-H', '127.0.0.1',
+                '-U', 'test_reboot_user',
+                '-P', 'test_ipmitool_pass',
+                'chassis', 'power', 'cycle',
+            ], timeout=1)
+
+    assert excinfo.value.status == 'auth_error'
+    assert excinfo.value.result.returncode == 1
+
+
+@pytest.mark.ipmitool
+def test_ipmitool_timeout_returns_output():
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = subprocess.TimeoutExpired('ipmitool', 1, output=b'partial')
+        output = call_command('ipmitool', *[
+            '-H', '127.0.0.1',
+            '-U', 'test_reboot_user',
+            '-P', 'test_ipmitool_pass',
+            'chassis', 'power', 'cycle',
+        ], timeout=1)
+
+    assert output == 'partial'
+
+
+@pytest.mark.ipmitool
+def test_ipmi_smart_reboot_powers_on_a_node_that_is_off(settings):
+    settings.IPMI_CLIENT = 'ipmitool'
+    settings.WORKER_CONFIG = {
+        'servers': {'test_ipmi_worker_id': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'}},
+    }
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = ['Chassis Power is off\n', 'Chassis Power Control: Up/On\n', 'Chassis Power is on\n']
+        output = call_command('ipmi', 'test_ipmi_worker_id', 'ipmi_smart_reboot')
+
+    assert output == 'Chassis Power was off\nChassis Power Control: Up/On\nChassis Power is on\n'
+    assert [call[0][0][-3:] for call in cmd_mock.call_args_list] == [
+        ['chassis', 'power', 'status'], ['chassis', 'power', 'on'], ['chassis', 'power', 'status']]
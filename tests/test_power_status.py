@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import subprocess
+import time
+
+import mock
+import pytest
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from relops_hardware_controller.api import (
+    power_cache,
+    tasks,
+)
+
+
+@pytest.fixture
+def power_settings(settings):
+    settings.IPMI_CLIENT = 'ipmitool'
+    settings.POWER_STATUS_MAX_AGE = 900
+    settings.WORKER_CONFIG = {
+        'servers': {
+            'test_ipmi_worker_id': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'},
+            'test_ipmi_worker_id_2': {'user': 'test_ipmi_user', 'password': 'wrong_pass'},
+            'test_ssh_worker_id': {'ssh': {'user': 'root', 'key_file': '~/.ssh/id_rsa'}},
+        },
+    }
+    cache.delete_pattern('power:*')
+    yield settings
+    cache.delete_pattern('power:*')
+
+
+def ipmitool_side_effect(args, **kwargs):
+    if 'wrong_pass' in args:
+        raise subprocess.CalledProcessError(
+            1, args, output='RAKP 2 HMAC is invalid\nError: Unable to establish IPMI v2 / RMCP+ session\n')
+    return 'Chassis Power is on\n'
+
+
+@pytest.mark.power_status
+def test_sweep_caches_every_ipmi_host(power_settings):
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = ipmitool_side_effect
+        tasks.sweep_power_status()
+
+        assert cmd_mock.call_count == 2
+
+    assert power_cache.get('test_ipmi_worker_id')['power'] == 'on'
+    assert power_cache.get('test_ipmi_worker_id_2.test.releng.mdc1.mozilla.com')['status'] == 'auth_error'
+    assert power_cache.get('test_ssh_worker_id') is None
+    assert cache.get(tasks.SWEEP_LOCK_KEY) is None
+
+
+@pytest.mark.power_status
+def test_sweep_skips_while_another_runs(power_settings):
+    cache.set(tasks.SWEEP_LOCK_KEY, time.time())
+    try:
+        with mock.patch('subprocess.check_output') as cmd_mock:
+            tasks.sweep_power_status()
+
+            assert not cmd_mock.called
+    finally:
+        cache.delete(tasks.SWEEP_LOCK_KEY)
+
+
+@pytest.mark.power_status
+def test_status_is_served_from_the_cache(power_settings):
+    power_cache.store({'test_ipmi_worker_id': 'Chassis Power is off\n'})
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        output = call_command('status', 'test_ipmi_worker_id.test.releng.mdc1.mozilla.com.', json.dumps({}))
+
+        assert not cmd_mock.called
+    assert output == 'Chassis Power is off (checked 0s ago)\n'
+
+
+@pytest.mark.power_status
+@pytest.mark.parametrize(
+    "args, kwargs", [
+        ([], dict(max_age=0)),
+        ([json.dumps(dict(max_age=0))], {}),
+        ([json.dumps({})], {}),
+    ], ids=['option', 'job_data', 'not_cached']
+)
+def test_status_asks_the_bmc_for_old_or_missing_states(power_settings, args, kwargs):
+    if kwargs or args != [json.dumps({})]:
+        power_cache.store({'test_ipmi_worker_id': 'Chassis Power is off\n'})
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = ipmitool_side_effect
+        output = call_command('status', 'test_ipmi_worker_id', *args, **kwargs)
+
+        assert cmd_mock.call_count == 1
+    assert output == 'Chassis Power is on (checked 0s ago)\n'
+    assert power_cache.get('test_ipmi_worker_id')['power'] == 'on'
+
+
+@pytest.mark.power_status
+def test_status_reports_bmc_errors(power_settings):
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = ipmitool_side_effect
+        output = call_command('status', 'test_ipmi_worker_id_2')
+
+    assert output.startswith('Chassis Power unknown, auth_error: RAKP 2 HMAC is invalid')
+
+    with pytest.raises(CommandError):
+        call_command('status', 'test_ssh_worker_id')
@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+import hpilo
+import mock
+import pytest
+
+from django.core.management import call_command
+from django_redis import get_redis_connection
+
+from relops_hardware_controller.api import (
+    ilo as ilo_client,
+    power_timer,
+    tasks,
+)
+
+
+@pytest.fixture
+def timer(settings):
+    settings.POWER_ON_INLINE_DELAY = 1
+    settings.POWER_ON_LEASE = 120
+    redis = get_redis_connection('default')
+    redis.delete(power_timer.DUE_KEY)
+    with mock.patch.object(power_timer.app, 'send_task') as send_mock:
+        yield send_mock
+    redis.delete(power_timer.DUE_KEY)
+
+
+@pytest.mark.power_timer
+def test_ilo_hard_reboot_schedules_power_on(timer):
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        mock_ilo = mock_ilo_ctor.return_value
+        mock_ilo.call_delayed.side_effect = Exception('ilo.reset_server failed!')
+        mock_ilo.reset_server.side_effect = [None, Exception('ilo.reset_server failed!')]
+
+        with mock.patch('time.sleep') as sleep_mock:
+            call_command('ilo_reboot', 'test.ilo.hostname', delay=60)
+            assert not sleep_mock.called
+
+        mock_ilo.set_host_power.assert_called_once_with(host_power=False)
+
+    timer.assert_called_once_with(power_timer.TASK_NAME, countdown=60)
+    [entry] = power_timer.pending()
+    assert entry['command'] == 'ilo_reboot'
+    assert entry['target'] == 'test.ilo.hostname'
+    # the ILO_PASSWORD is read again when the power-on runs
+    assert entry['params'] == {'timeout': 60}
+    assert entry['due'] == pytest.approx(time.time() + 60, abs=5)
+
+    # not due yet
+    ilo_client.forget('test.ilo.hostname')
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        mock_ilo_ctor.return_value.hostname = 'test.ilo.hostname'
+        mock_ilo_ctor.return_value.protocol = hpilo.ILO_HTTP
+        assert power_timer.run_due() == 0
+        assert power_timer.run_due(now=entry['due']) == 1
+
+        mock_ilo_ctor.assert_called_once_with('test.ilo.hostname',
+                                              login='ilo_dev_username',
+                                              password='anything_ilo_password',
+                                              timeout=60,
+                                              delayed=False,
+                                              protocol=None,
+                                              ssl_context=mock.ANY)
+        mock_ilo_ctor.return_value.set_host_power.assert_called_once_with(host_power=True)
+    assert power_timer.pending() == []
+    assert ilo_client.knows_protocol('test.ilo.hostname')
+    ilo_client.forget('test.ilo.hostname')
+
+
+@pytest.mark.power_timer
+def test_snmp_rebootdelay_schedules_outlet_on(timer, settings):
+    settings.SNMP_COALESCE_WINDOW = 0
+    with mock.patch('relops_hardware_controller.api.management.commands.snmp_reboot.Command.run_cmd') as cmd_mock, \
+            mock.patch('relops_hardware_controller.api.management.commands.snmp_reboot.Command.confirm') \
+            as confirm_mock:
+        cmd_mock.return_value = 'off\n'
+        confirm_mock.return_value = ''
+        output = call_command('snmp_reboot', 'mini1', 'pdu1', 'AB12', delay=60, timeout=5)
+
+        assert cmd_mock.call_args[0] == ('pdu1', '2')
+    assert output == 'SNMP to pdu1: off\n power on scheduled in 60s'
+
+    [entry] = power_timer.pending()
+    assert entry['command'] == 'snmp_reboot'
+    assert entry['target'] == 'pdu1'
+    assert entry['params'] == {'port': 'AB12', 'timeout': 5}
+
+    with mock.patch('relops_hardware_controller.api.management.commands.snmp_reboot.Command.set_outlets') \
+            as set_mock:
+        set_mock.return_value = ['on\n']
+        assert power_timer.run_due(now=entry['due']) == 1
+        set_mock.assert_called_once_with('pdu1', [('AB12', '1')], 5)
+
+
+@pytest.mark.power_timer
+def test_failed_power_on_is_retried_after_the_lease(timer):
+    power_timer.schedule_on('xenapi_reboot', 'test_xen_vm_uuid', 5)
+    due = power_timer.pending()[0]['due']
+
+    with mock.patch('relops_hardware_controller.api.management.commands'
+                    '.xenapi_reboot.XenAPI.Session') as mock_session_ctor:
+        mock_xenapi = mock_session_ctor.return_value.xenapi
+        mock_xenapi.VM.get_power_state.return_value = 'Halted'
+        mock_xenapi.VM.start.side_effect = Exception('HOST_OFFLINE')
+
+        assert power_timer.run_due(now=due) == 0
+        [entry] = power_timer.pending()
+        assert entry['due'] == due + 120
+
+        # claimed by the failed attempt
+        assert power_timer.run_due(now=due + 60) == 0
+        assert mock_xenapi.VM.start.call_count == 1
+
+        mock_xenapi.VM.start.side_effect = None
+        assert power_timer.run_due(now=due + 120) == 1
+        assert mock_xenapi.VM.start.call_count == 2
+    assert power_timer.pending() == []
+
+
+@pytest.mark.power_timer
+def test_power_on_skips_running_vm(timer):
+    power_timer.schedule_on('xenapi_reboot', 'test_xen_vm_uuid', 0)
+
+    with mock.patch('relops_hardware_controller.api.management.commands'
+                    '.xenapi_reboot.XenAPI.Session') as mock_session_ctor:
+        mock_xenapi = mock_session_ctor.return_value.xenapi
+        mock_xenapi.VM.get_power_state.return_value = 'Running'
+
+        tasks.power_on_due()
+
+        assert not mock_xenapi.VM.start.called
+    assert power_timer.pending() == []
+
+
+@pytest.mark.power_timer
+def test_power_on_gives_up_after_a_day(timer):
+    power_timer.schedule_on('ilo_reboot', 'test.ilo.hostname', 5, login='a', password='b', timeout=1)
+    due = power_timer.pending()[0]['due']
+
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        mock_ilo_ctor.side_effect = Exception('ilo error logging in!')
+        assert power_timer.run_due(now=due + power_timer.GIVE_UP_AFTER) == 0
+    assert power_timer.pending() == []
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import socket
+import threading
+
+import mock
+import pytest
+
+from django.core.management import call_command
+
+from relops_hardware_controller.api.preflight import (
+    Capability,
+    format_preflight,
+    preflight,
+    rmcp_ping,
+)
+
+
+worker_config = {
+    'snmp_community_string': 'private',
+    'types': {},
+    'servers': {
+        'test_tc_worker_id': {
+            'pdu': 'pdu1.r201-6.ops.releng.mdc1.mozilla.com:AA1',
+        },
+        'test_ipmi_worker_id': {
+            'user': 'test_reboot_user',
+            'password': 'test_ipmitool_pass',
+        },
+    },
+}
+
+
+@pytest.fixture
+def fake_bmc():
+    """A UDP socket on localhost that answers RMCP presence pings."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(2)
+
+    def pong():
+        try:
+            data, address = sock.recvfrom(512)
+        except OSError:
+            return
+        sock.sendto(data[:8] + b'\x40' + data[9:10] + b'\x00\x10' + b'\x00' * 16, address)
+
+    thread = threading.Thread(target=pong)
+    thread.start()
+    yield sock.getsockname()[1]
+    thread.join()
+    sock.close()
+
+
+@pytest.mark.preflight
+def test_rmcp_ping_gets_pong(fake_bmc):
+    assert rmcp_ping('127.0.0.1', port=fake_bmc, timeout=2)
+
+
+@pytest.mark.preflight
+def test_rmcp_ping_times_out():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    try:
+        assert not rmcp_ping('127.0.0.1', port=sock.getsockname()[1], timeout=0.1)
+    finally:
+        sock.close()
+
+
+@pytest.mark.preflight
+def test_preflight_shares_probes_and_skips_missing_config(settings):
+    settings.WORKER_CONFIG = worker_config
+    settings.SNMP_CLIENT = 'net-snmp'
+    server = worker_config['servers']['test_tc_worker_id']
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.return_value = '0\n'  # outlet on
+
+        capabilities = preflight('test_tc_worker_id', server, [
+            'snmp_reboot',
+            'snmp_rebootdelay',
+            'ilo_reboot',
+            'file_bugzilla_bug',
+        ])
+
+        assert cmd_mock.call_count == 1
+
+    assert list(capabilities) == ['snmp_reboot', 'snmp_rebootdelay', 'ilo_reboot', 'file_bugzilla_bug']
+    assert capabilities['snmp_reboot'].usable
+    assert capabilities['snmp_reboot'] is capabilities['snmp_rebootdelay']
+    assert not capabilities['ilo_reboot'].usable
+    assert capabilities['ilo_reboot'].detail == "no 'ilo' config"
+    assert capabilities['file_bugzilla_bug'].usable
+
+
+@pytest.mark.preflight
+def test_preflight_ipmi_unreachable_bmc(settings):
+    settings.WORKER_CONFIG = worker_config
+    settings.PREFLIGHT_TIMEOUT = 1
+
+    with mock.patch('relops_hardware_controller.api.preflight.rmcp_ping') as ping_mock, \
+            mock.patch('subprocess.check_output') as cmd_mock:
+        ping_mock.return_value = False
+
+        capabilities = preflight('test_ipmi_worker_id', {}, ['ipmi_reset', 'ipmi_cycle'])
+
+        ping_mock.assert_called_once_with('test_ipmi_worker_id', timeout=1)
+        assert not cmd_mock.called
+
+    assert not capabilities['ipmi_reset'].usable
+    assert 'did not answer RMCP ping' in capabilities['ipmi_cycle'].detail
+
+
+@pytest.mark.preflight
+def test_format_preflight():
+    assert format_preflight({
+        'ssh_reboot': Capability(False, 'timed out', 1),
+        'file_bugzilla_bug': Capability(True, 'not probed', 0),
+    }) == 'ssh_reboot skipped (timed out), file_bugzilla_bug ok (not probed)'
+
+
+@pytest.mark.preflight
+def test_reboot_only_runs_usable_methods(settings):
+    settings.WORKER_CONFIG = worker_config
+    settings.REBOOT_PREFLIGHT = True
+    settings.REBOOT_METHODS = ['ilo_reboot', 'file_bugzilla_bug']
+
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock:
+        cmd_mock.return_value = 'https://bugzilla/show_bug.cgi?id=1'
+
+        output = call_command('reboot', 'test_tc_worker_id', json.dumps({}))
+
+        assert cmd_mock.call_count == 1
+        assert cmd_mock.call_args[0][1] == 'test_tc_worker_id'
+        assert "Preflight: ilo_reboot skipped (no 'ilo' config)" in output
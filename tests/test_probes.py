@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import socket
+import threading
+
+import mock
+import pytest
+
+from relops_hardware_controller.api.probes import (
+    TaskclusterQueueCheck,
+    TcpCheck,
+    UpCheck,
+    any_up,
+    get_up_checks,
+)
+
+
+job_data = dict(
+    provisioner_id='releng-hardware',
+    worker_type='gecko-t-linux-talos',
+    worker_group='mdc1',
+    worker_id='t-linux64-ms-001',
+)
+
+
+class FakeCheck(UpCheck):
+    def __init__(self, up, event=None):
+        super().__init__('host', {})
+        self.up = up
+        self.event = event
+
+    def is_up(self):
+        if self.event is not None:
+            self.event.wait(5)
+        return self.up
+
+
+@pytest.mark.probes
+def test_get_up_checks_from_settings(settings):
+    settings.UP_CHECKS = ['ssh', 'rdp', 'taskcluster']
+
+    checks = get_up_checks('host', job_data)
+
+    assert [getattr(check, 'port', None) for check in checks] == [22, 3389, None]
+    assert isinstance(checks[2], TaskclusterQueueCheck)
+
+
+@pytest.mark.probes
+def test_tcp_check_connects_to_listening_port(settings):
+    settings.UP_CHECK_TIMEOUT = 1
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    try:
+        assert TcpCheck('127.0.0.1', {}, port).is_up()
+    finally:
+        server.close()
+
+    assert not TcpCheck('127.0.0.1', {}, port).is_up()
+
+
+@pytest.mark.probes
+def test_any_up_returns_on_first_definitive_signal():
+    slow_probe = threading.Event()
+
+    try:
+        assert any_up([FakeCheck(False, event=slow_probe), FakeCheck(True)])
+    finally:
+        slow_probe.set()
+
+
+@pytest.mark.probes
+def test_any_up_is_false_when_all_checks_say_no():
+    assert not any_up([FakeCheck(False), FakeCheck(False)])
+    assert not any_up([])
+
+
+@pytest.mark.probes
+def test_taskcluster_check_waits_for_a_new_task():
+    check = TaskclusterQueueCheck('host', job_data)
+
+    with mock.patch('taskcluster.Queue') as queue_ctor:
+        queue = queue_ctor.return_value
+        queue.getWorker.return_value = {'recentTasks': [{'taskId': 'a', 'runId': 0}]}
+
+        check.snapshot()
+        assert not check.is_up()
+
+        queue.getWorker.return_value = {'recentTasks': [{'taskId': 'a', 'runId': 0},
+                                                        {'taskId': 'b', 'runId': 0}]}
+        assert check.is_up()
+
+        queue.getWorker.assert_called_with('releng-hardware', 'gecko-t-linux-talos',
+                                           'mdc1', 't-linux64-ms-001')
+
+
+@pytest.mark.probes
+def test_taskcluster_check_skips_jobs_without_worker_info():
+    check = TaskclusterQueueCheck('host', dict(job_data, worker_group='none'))
+
+    with mock.patch('taskcluster.Queue') as queue_ctor:
+        check.snapshot()
+        assert not check.is_up()
+
+        assert not queue_ctor.called
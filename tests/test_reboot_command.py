@@ -2,11 +2,21 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
-from mock import patch
+import json
+import subprocess
+
+import pytest
+from mock import Mock, patch
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
 
+from relops_hardware_controller.api.management.commands.reboot import (
+    Deadline,
+    get_reboot_call,
+    reboot_succeeded,
+)
+
 
 def test_reboot_skips_ssh_reboot_when_ping_fails(settings):
     settings.DOWN_TIMEOUT = 1
@@ -148,7 +158,7 @@ def test_reboot_xenapi_success(settings):
         call_command('reboot', 'test_tc_worker_id', 'dne-dc-1')
 
         # just check one call since specifics tested in xenapi_reboot tests
-        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/')
+        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/', timeout=300)
 
         assert run_mock.call_count == 5
 
@@ -194,3 +204,80 @@ def test_reboot_bugzilla_success(settings):
         # just check one call since specifics tested in file_bugzilla_bug tests
         assert post_mock.called
         assert run_mock.call_count == 5
+
+
+def test_deadline_shares_remaining_time():
+    with patch('time.time') as time_mock:
+        time_mock.return_value = 1000
+        deadline = Deadline(540)
+
+        time_mock.return_value = 1140
+        assert deadline.remaining() == 400
+        assert deadline.share(4) == 1240
+
+        time_mock.return_value = 2000
+        assert deadline.remaining() == 0
+
+
+def test_reboot_succeeded_caps_timeouts_at_deadline(settings):
+    settings.DOWN_TIMEOUT = 60
+    settings.UP_TIMEOUT = 300
+
+    with patch('relops_hardware_controller.api.management.commands'
+               '.reboot.wait_for_state') as wait_mock, \
+            patch('time.time') as time_mock:
+        wait_mock.return_value = True
+        time_mock.return_value = 1000
+
+        assert reboot_succeeded('host', up_checks=[Mock()], deadline=1100)
+
+        assert [c[1]['timeout'] for c in wait_mock.call_args_list] == [60, 100]
+
+
+def test_reboot_keeps_time_for_filing_a_bug(settings):
+    settings.CELERY_TASK_SOFT_TIME_LIMIT = 60
+    settings.BUG_FILING_RESERVE = 60
+    settings.REBOOT_PREFLIGHT = False
+    settings.REBOOT_METHODS = ['ssh_reboot', 'ipmi_reset', 'file_bugzilla_bug']
+    settings.WORKER_CONFIG = {'servers': {'test_tc_worker_id': {}}}
+
+    with patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock:
+        cmd_mock.return_value = 'https://bugzilla/show_bug.cgi?id=1'
+
+        call_command('reboot', 'test_tc_worker_id', json.dumps({}))
+
+        assert cmd_mock.call_count == 1
+        assert '--log' in cmd_mock.call_args[0]
+
+
+def test_reboot_moves_on_when_the_bmc_refuses(settings):
+    settings.REBOOT_PREFLIGHT = False
+    settings.REBOOT_METHODS = ['ipmi_reset']
+    settings.WORKER_CONFIG = {
+        'servers': {'test_tc_worker_id': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'}},
+    }
+
+    with patch('subprocess.check_output') as check_output_mock, \
+            patch('relops_hardware_controller.api.management.commands.reboot.reboot_succeeded') as succeeded_mock:
+        check_output_mock.side_effect = subprocess.CalledProcessError(
+            1, 'ipmitool', output='RAKP 2 HMAC is invalid\nError: Unable to establish IPMI v2 / RMCP+ session\n')
+
+        with pytest.raises(Exception) as excinfo:
+            call_command('reboot', 'test_tc_worker_id', json.dumps({}))
+
+        # the verifier's sel snapshot then the reset
+        assert check_output_mock.call_args[0][0][-3:] == ['chassis', 'power', 'reset']
+        assert not succeeded_mock.called
+    assert 'ipmi IpmiCommandError auth_error' in str(excinfo.value)
+
+
+def test_get_reboot_call_passes_the_ssh_override():
+    server = {'ssh': {'user': 'cltbld', 'key_file': 'win.key', 'os': 'windows'}}
+    assert get_reboot_call('ssh_reboot', 't-w1064-ms-001', server, {}) == (
+        'ssh_reboot', 't-w1064-ms-001', ['-l', 'cltbld', '-i', 'win.key', '--os', 'windows'])
+
+    server = {'ssh': {'user': 'cltbld', 'key_file': 'win.key', 'reboot_command': 'shutdown /r /t 0'}}
+    assert get_reboot_call('ssh_reboot', 't-w1064-ms-001', server, {})[2][-2:] == [
+        '--reboot-command', 'shutdown /r /t 0']
+
+    assert get_reboot_call('ssh_reboot', 't-linux64-ms-001', {}, {})[2] == ['-l', 'roller', '-i', 'ssh.key']
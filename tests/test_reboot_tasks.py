@@ -0,0 +1,221 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+from xmlrpc.client import DateTime
+
+import mock
+import pytest
+
+from django.core.cache import cache
+
+from relops_hardware_controller.api import tasks
+
+
+job_data = dict(
+    worker_id='test_tc_worker_id',
+    client_id='mozilla-ldap/test@mozilla.com',
+    http_origin='https://tools.taskcluster.net',
+    provisioner_id='releng-hardware',
+    worker_type='gecko-t-linux-talos',
+    worker_group='mdc1',
+)
+
+notification = dict(subject='MDC1 test_tc_worker_id reboot', username='test', start_time='2018-05-24T09:00:00')
+
+
+@pytest.fixture
+def reboot_settings(settings):
+    settings.REBOOT_PREFLIGHT = False
+    settings.REBOOT_METHODS = ['ssh_reboot', 'file_bugzilla_bug']
+    settings.UP_CHECKS = ['ping']
+    settings.WORKER_CONFIG = {'servers': {'test_tc_worker_id': {}}}
+    cache.delete_pattern(tasks.STATE_KEY.format('*'))
+    yield settings
+    cache.delete_pattern(tasks.STATE_KEY.format('*'))
+
+
+@pytest.fixture
+def scheduled():
+    with mock.patch.object(tasks.reboot_step, 'apply_async') as step_mock, \
+            mock.patch.object(tasks.reboot_check, 'apply_async') as check_mock:
+        yield step_mock, check_mock
+
+
+def last_args(task_mock):
+    return task_mock.call_args[0][0]
+
+
+@pytest.mark.reboot_tasks
+def test_reboot_runs_as_short_tasks(reboot_settings, scheduled):
+    step_mock, check_mock = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+    assert last_args(step_mock)[0] == job_id
+
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock:
+        tasks.reboot_step(*last_args(step_mock))
+
+        assert cmd_mock.call_count == 1
+        assert cmd_mock.call_args[0][1] == 'test_tc_worker_id'
+    assert tasks.load_state(job_id)['step'] == 'wait_down'
+    assert check_mock.call_args[1] == {'countdown': tasks.DOWN_CHECK_INTERVAL}
+
+    with mock.patch('relops_hardware_controller.api.tasks.went_down') as went_down_mock:
+        went_down_mock.return_value = False
+        tasks.reboot_check(*last_args(check_mock))
+        assert tasks.load_state(job_id)['step'] == 'wait_down'
+
+        went_down_mock.return_value = True
+        tasks.reboot_check(*last_args(check_mock))
+    assert tasks.load_state(job_id)['step'] == 'wait_up'
+    assert check_mock.call_args[1] == {'countdown': tasks.UP_CHECK_INTERVAL}
+
+    with mock.patch('relops_hardware_controller.api.tasks.any_up') as any_up_mock, \
+            mock.patch('relops_hardware_controller.api.tasks.notify_result') as notify_mock:
+        any_up_mock.return_value = True
+        tasks.reboot_check(*last_args(check_mock))
+
+        assert notify_mock.call_args[0][4].startswith('ssh_reboot: ')
+    assert tasks.load_state(job_id)['step'] == 'done'
+
+
+@pytest.mark.reboot_tasks
+def test_reboot_task_moves_on_after_down_timeout(reboot_settings, scheduled):
+    reboot_settings.DOWN_TIMEOUT = 0
+    step_mock, check_mock = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command'):
+        tasks.reboot_step(*last_args(step_mock))
+
+    with mock.patch('relops_hardware_controller.api.tasks.went_down') as went_down_mock:
+        went_down_mock.return_value = False
+        tasks.reboot_check(*last_args(check_mock))
+
+    state = tasks.load_state(job_id)
+    assert state['index'] == 1
+    assert 'ssh_reboot Exception' in state['log_short']
+
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock, \
+            mock.patch('relops_hardware_controller.api.tasks.notify_result') as notify_mock:
+        cmd_mock.side_effect = lambda *args, **kwargs: kwargs['stdout'].write('https://bugzilla/1')
+        tasks.reboot_step(*last_args(step_mock))
+
+        assert cmd_mock.call_args[0][0].__module__.endswith('file_bugzilla_bug')
+        assert notify_mock.call_args[0][4] == 'failed. https://bugzilla/1'
+
+
+@pytest.mark.reboot_tasks
+def test_stale_reboot_tasks_are_dropped(reboot_settings, scheduled):
+    step_mock, _ = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock:
+        tasks.reboot_step(job_id, 'not-the-current-token')
+
+        assert not cmd_mock.called
+    assert tasks.load_state(job_id)['step'] == 'preflight'
+
+
+@pytest.mark.reboot_tasks
+def test_resume_reboots_does_not_repeat_power_actions(reboot_settings, scheduled):
+    reboot_settings.REBOOT_RESUME_AFTER = 60
+    step_mock, check_mock = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command'):
+        tasks.reboot_step(*last_args(step_mock))
+    lost_token = last_args(check_mock)[1]
+
+    tasks.resume_reboots()
+    assert check_mock.call_count == 1  # not stale yet
+
+    # the worker holding the check was lost two minutes ago
+    state = tasks.load_state(job_id)
+    state['updated'] -= 120
+    cache.set(tasks.STATE_KEY.format(job_id), state)
+    tasks.resume_reboots()
+
+    assert check_mock.call_count == 2
+    resumed_job_id, resumed_token = last_args(check_mock)
+    assert resumed_job_id == job_id
+    assert resumed_token != lost_token
+    assert tasks.load_state(job_id)['step'] == 'wait_down'
+    assert step_mock.call_count == 1
+
+
+@pytest.mark.reboot_tasks
+def test_reboot_task_reports_a_host_missing_from_the_worker_config(reboot_settings, scheduled):
+    reboot_settings.WORKER_CONFIG = {'servers': {}}
+    step_mock, _ = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock, \
+            mock.patch('relops_hardware_controller.api.tasks.notify_result') as notify_mock:
+        tasks.reboot_step(*last_args(step_mock))
+
+        assert not cmd_mock.called
+        assert notify_mock.call_args[0][4] == "Key error: 'test_tc_worker_id'"
+    assert tasks.load_state(job_id)['step'] == 'done'
+
+
+@pytest.mark.reboot_tasks
+def test_resume_reboots_during_a_power_action_checks_the_host(reboot_settings, scheduled):
+    reboot_settings.REBOOT_RESUME_AFTER = 60
+    step_mock, check_mock = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+
+    def slow_action(*args, **kwargs):
+        # e.g. a clean shutdown taking longer than REBOOT_RESUME_AFTER
+        state = tasks.load_state(job_id)
+        assert state['step'] == 'acting'
+        state['updated'] -= 120
+        cache.set(tasks.STATE_KEY.format(job_id), state)
+        tasks.resume_reboots()
+
+    with mock.patch('relops_hardware_controller.api.management.commands.reboot.call_command') as cmd_mock:
+        cmd_mock.side_effect = slow_action
+        tasks.reboot_step(*last_args(step_mock))
+
+        assert cmd_mock.call_count == 1
+    assert step_mock.call_count == 1
+    assert check_mock.call_count == 1
+    state = tasks.load_state(job_id)
+    assert state['step'] == 'wait_down'
+    assert state['token'] == last_args(check_mock)[1]
+
+
+@pytest.mark.reboot_tasks
+def test_xenapi_reboot_runs_as_short_tasks(reboot_settings, scheduled):
+    reboot_settings.REBOOT_METHODS = ['xenapi_reboot', 'file_bugzilla_bug']
+    reboot_settings.WORKER_CONFIG = {'servers': {'test_tc_worker_id': {'xen': {'reboot': ['test_xen_vm_uuid']}}}}
+    step_mock, check_mock = scheduled
+
+    job_id = tasks.start_reboot('test_tc_worker_id', job_data, notification)
+    with mock.patch('relops_hardware_controller.api.management.commands'
+                    '.xenapi_reboot.XenAPI.Session') as mock_session_ctor, \
+            mock.patch('time.sleep'):
+        mock_session = mock_session_ctor.return_value
+        mock_session.xenapi.VM.get_power_state.return_value = 'Running'
+        # the Session decodes dateTime.iso8601 values as DateTime
+        mock_session.xenapi.VM_metrics.get_start_time.return_value = DateTime('20180524T09:00:00')
+        getattr(mock_session.xenapi.event, 'from').return_value = dict(token='1', valid_ref_counts={}, events=[{
+            'class': 'vm',
+            'ref': mock_session.xenapi.VM.get_by_uuid.return_value,
+            'operation': 'mod',
+            'snapshot': dict(power_state='Halted', guest_metrics='OpaqueRef:NULL'),
+        }])
+
+        tasks.reboot_step(*last_args(step_mock))
+
+        assert mock_session.xenapi.VM.start.call_count == 1
+        state = tasks.load_state(job_id)
+        assert state['step'] == 'wait_down'
+        assert state['verifier']['start_time'] == '20180524T09:00:00'
+
+        mock_session.xenapi.VM_metrics.get_start_time.return_value = DateTime('20180524T09:01:00')
+        tasks.reboot_check(*last_args(check_mock))
+    assert tasks.load_state(job_id)['step'] == 'wait_up'
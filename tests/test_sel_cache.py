@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+import pytest
+
+from django.core.management import call_command
+
+from relops_hardware_controller.api import sel_cache
+
+
+SEL_LINES = [
+    '   1 | 05/24/2018 | 09:00:00 | Power Unit #0x01 | Power off/down | Asserted',
+    '   2 | 05/24/2018 | 09:01:00 | System Boot Initiated #0x01 | Initiated by power up | Asserted',
+    '   3 | 05/24/2018 | 09:02:00 | OS Boot #0x01 | C: boot completed | Asserted',
+    '   4 | 05/24/2018 | 09:03:00 | Power Unit #0x01 | Power off/down | Asserted',
+]
+
+
+@pytest.mark.ipmi
+def test_new_lines_follow_the_cursor():
+    assert sel_cache.new_lines(SEL_LINES[:3], None) == SEL_LINES[:3]
+    assert sel_cache.new_lines(SEL_LINES[1:], 2) == SEL_LINES[2:]
+    assert sel_cache.new_lines(SEL_LINES[1:], 4) == []
+    # the cursor entry rotated out of the output or the SEL was cleared
+    assert sel_cache.new_lines(SEL_LINES[2:], 1) == SEL_LINES[2:]
+    assert sel_cache.new_lines(['SEL has no entries'], None) == []
+
+
+@pytest.mark.ipmi
+def test_ring_keeps_the_newest_entries(settings, sel_redis):
+    settings.IPMI_SEL_RING = 3
+
+    sel_cache.store('test_ipmi_worker_id.test.releng.mdc1.mozilla.com', SEL_LINES[:2])
+    sel_cache.store('test_ipmi_worker_id', SEL_LINES[2:])
+
+    assert sel_cache.cached('test_ipmi_worker_id') == SEL_LINES[1:]
+    assert sel_cache.cached('test_ipmi_worker_id', last=1) == SEL_LINES[3:]
+    assert sel_cache.get_cursors(['test_ipmi_worker_id', 'unknown-host']) == [4, None]
+
+
+@pytest.mark.ipmi
+def test_ipmi_list_only_stores_new_entries(settings, sel_redis):
+    settings.IPMI_CLIENT = 'ipmitool'
+    settings.WORKER_CONFIG = {
+        'servers': {'test_ipmi_worker_id': {'user': 'test_ipmi_user', 'password': 'test_ipmi_pass'}},
+    }
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = [
+            ''.join(line + '\n' for line in SEL_LINES[:3]),
+            ''.join(line + '\n' for line in SEL_LINES[1:]),
+        ]
+        assert call_command('ipmi', 'test_ipmi_worker_id', 'ipmi_list').splitlines() == SEL_LINES[:3]
+        assert call_command('ipmi', 'test_ipmi_worker_id', 'ipmi_list').splitlines() == SEL_LINES
+        assert call_command('ipmi', 'test_ipmi_worker_id', 'ipmi_list', cached=True).splitlines() == SEL_LINES
+
+        assert cmd_mock.call_count == 2
+        assert cmd_mock.call_args[0][0][-4:] == ['sel', 'list', 'last', '15']
@@ -0,0 +1,393 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+import pytest
+
+from django.core.cache import cache
+from django.core.management import (
+    call_command,
+    load_command_class,
+)
+from django.core.management.base import CommandError
+from django_redis import get_redis_connection
+
+from relops_hardware_controller.api import (
+    pdu_cache,
+    snmp,
+    tasks,
+)
+from relops_hardware_controller.api.verifiers import PduVerifier
+
+
+OUTLET_CONTROL = '1.3.6.1.4.1.1718.3.2.3.1.11.1.1.8'
+OUTLET_STATUS = '1.3.6.1.4.1.1718.3.2.3.1.5.1.1.8'
+OUTLET_LOAD = '1.3.6.1.4.1.1718.3.2.3.1.7.1.1.8'
+READ_ONLY = '1.3.6.1.2.1.1.1.0'
+
+
+class FakeAgent(threading.Thread):
+    """An SNMPv2c agent on localhost answering GET and SET for a dict of
+    oids, with a v3 mode that refuses every user like an agent that does
+    not know it.
+    """
+
+    def __init__(self, community='private'):
+        super().__init__()
+        self.community = community.encode()
+        self.values = {OUTLET_CONTROL: 1, OUTLET_STATUS: 0, OUTLET_LOAD: 52, READ_ONLY: b'Sentry Switched CDU'}
+        self.read_only = {READ_ONLY}
+        self.requests = []
+        self.engine_id = b'\x80\x00\x1f\x88\x04fake'
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                packet, client = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            _, content, _ = snmp.decode_tlv(packet)
+            elements = snmp.decode_sequence(content)
+            version = snmp.decode_value(*elements[0])
+            if version == snmp.VERSION_3:
+                self.sock.sendto(self.report(elements), client)
+                continue
+            if bytes(elements[1][1]) != self.community:
+                continue
+            pdu_type, request_id, non_repeaters, max_repetitions, varbinds = snmp.decode_pdu(*elements[2])
+            self.requests.append((pdu_type, varbinds))
+            if pdu_type == snmp.PDU_GET_BULK:
+                answer = self.bulk(request_id, non_repeaters, max_repetitions, varbinds)
+            else:
+                answer = self.answer(pdu_type, request_id, varbinds)
+            self.sock.sendto(snmp.sequence(
+                snmp.encode_integer(snmp.VERSION_2C),
+                snmp.tlv(snmp.TAG_OCTET_STRING, self.community),
+                answer), client)
+
+    def answer(self, pdu_type, request_id, varbinds):
+        for index, (oid, value) in enumerate(varbinds, 1):
+            if oid not in self.values:
+                return snmp.encode_pdu(snmp.PDU_RESPONSE, request_id, varbinds, 2, index)  # noSuchName
+            if pdu_type == snmp.PDU_SET and oid in self.read_only:
+                return snmp.encode_pdu(snmp.PDU_RESPONSE, request_id, varbinds, 17, index)  # notWritable
+        if pdu_type == snmp.PDU_SET:
+            self.values.update(varbinds)
+        return snmp.encode_pdu(snmp.PDU_RESPONSE, request_id, [(oid, self.values[oid]) for oid, _ in varbinds])
+
+    def bulk(self, request_id, non_repeaters, max_repetitions, varbinds):
+        oids = sorted(self.values, key=lambda oid: [int(part) for part in oid.split('.')])
+        encoded = []
+        cursors = [oid for oid, _ in varbinds[non_repeaters:]]
+        for _ in range(max_repetitions):
+            for position, cursor in enumerate(cursors):
+                key = [int(part) for part in cursor.split('.')]
+                following = [oid for oid in oids if [int(part) for part in oid.split('.')] > key]
+                if following:
+                    cursors[position] = following[0]
+                    value = snmp.encode_value(self.values[following[0]])
+                else:
+                    value = snmp.tlv(snmp.TAG_END_OF_MIB_VIEW, b'')
+                encoded.append(snmp.sequence(snmp.encode_oid(cursors[position]), value))
+        return snmp.sequence(snmp.encode_integer(request_id), snmp.encode_integer(0), snmp.encode_integer(0),
+                             snmp.sequence(*encoded), tag=snmp.PDU_RESPONSE)
+
+    def report(self, elements):
+        """Reports an unknown engine id to discovery, an unknown user name
+        to everything else.
+        """
+        msg_id = snmp.decode_value(*snmp.decode_sequence(elements[1][1])[0])
+        engine_id = snmp.decode_sequence(snmp.decode_tlv(elements[2][1])[1])[0][1]
+        oid = snmp.USM_UNKNOWN_ENGINE_IDS if not engine_id else snmp.USM_UNKNOWN_USER_NAMES
+        return snmp.sequence(
+            snmp.encode_integer(snmp.VERSION_3),
+            snmp.sequence(snmp.encode_integer(msg_id), snmp.encode_integer(snmp.MAX_MESSAGE_SIZE),
+                          snmp.tlv(snmp.TAG_OCTET_STRING, b'\x00'), snmp.encode_integer(snmp.USM_SECURITY_MODEL)),
+            snmp.tlv(snmp.TAG_OCTET_STRING, snmp.sequence(
+                snmp.tlv(snmp.TAG_OCTET_STRING, self.engine_id), snmp.encode_integer(1), snmp.encode_integer(100),
+                snmp.tlv(snmp.TAG_OCTET_STRING, b''), snmp.tlv(snmp.TAG_OCTET_STRING, b''),
+                snmp.tlv(snmp.TAG_OCTET_STRING, b''))),
+            snmp.sequence(snmp.tlv(snmp.TAG_OCTET_STRING, self.engine_id), snmp.tlv(snmp.TAG_OCTET_STRING, b''),
+                          snmp.encode_pdu(snmp.PDU_REPORT, 0, [(oid, 1)])))
+
+
+@pytest.fixture
+def fake_agent(settings):
+    settings.SNMP_CLIENT = 'native'
+    settings.SNMP_TIMEOUT = 1
+    settings.SNMP_RETRIES = 0
+    settings.SNMP_COALESCE_WINDOW = 0
+    settings.WORKER_CONFIG = {'snmp_community_string': 'private'}
+    agent = FakeAgent()
+    agent.start()
+    with mock.patch.object(snmp, 'SNMP_PORT', agent.port):
+        yield agent
+    agent.stop()
+
+
+@pytest.mark.snmp
+@pytest.mark.parametrize('oid', [
+    '1.3.6.1.4.1.1718.3.2.3.1.11.1.1.8',
+    '1.3.6.1.2.1.1.1.0',
+    '2.999.3',
+    '1.3.0.128.16383',
+])
+def test_oid_round_trip(oid):
+    tag, content, _ = snmp.decode_tlv(snmp.encode_oid(oid))
+    assert tag == snmp.TAG_OID
+    assert snmp.decode_oid(content) == oid
+
+
+@pytest.mark.snmp
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 255, 256, -1, -129, 2 ** 31 - 1, -2 ** 31])
+def test_integer_round_trip(value):
+    tag, content, _ = snmp.decode_tlv(snmp.encode_integer(value))
+    assert snmp.decode_value(tag, content) == value
+
+
+@pytest.mark.snmp
+def test_long_length_round_trip():
+    value = b'x' * 300
+    encoded = snmp.encode_value(value)
+    assert encoded[:4] == b'\x04\x82\x01\x2c'
+    assert snmp.decode_value(*snmp.decode_tlv(encoded)[:2]) == value
+
+
+@pytest.mark.snmp
+def test_decode_truncated_element():
+    with pytest.raises(snmp.SnmpError):
+        snmp.decode_tlv(snmp.encode_value(b'outlet')[:-1])
+
+
+@pytest.mark.snmp
+def test_password_to_key():
+    # RFC 3414 A.3
+    engine_id = bytes.fromhex('000000000000000000000002')
+    assert snmp.password_to_key('maplesyrup', 'MD5', engine_id).hex() == '526f5eed9fcce26f8964c2930787d82b'
+    assert snmp.password_to_key('maplesyrup', 'SHA', engine_id).hex() == '6695febc9288e36282235fc7151f128497b38f3f'
+
+
+@pytest.mark.snmp
+def test_set_and_get(fake_agent):
+    assert snmp.run('127.0.0.1', 'set', (OUTLET_CONTROL, 3), timeout=5) == [(OUTLET_CONTROL, 3)]
+    assert snmp.run('127.0.0.1', 'get', OUTLET_CONTROL, READ_ONLY, timeout=5) == [
+        (OUTLET_CONTROL, 3), (READ_ONLY, b'Sentry Switched CDU')]
+    assert fake_agent.requests[0] == (snmp.PDU_SET, [(OUTLET_CONTROL, 3)])
+
+
+@pytest.mark.snmp
+def test_error_status(fake_agent):
+    with pytest.raises(snmp.SnmpError) as e:
+        snmp.run('127.0.0.1', 'set', (OUTLET_CONTROL, 2), (READ_ONLY, b'x'), timeout=5)
+    assert e.value.status == 'notWritable'
+    assert READ_ONLY in str(e.value)
+    assert fake_agent.values[OUTLET_CONTROL] == 1
+
+
+@pytest.mark.snmp
+def test_wrong_community_times_out(fake_agent, settings):
+    settings.WORKER_CONFIG = {'snmp_community_string': 'public'}
+    with pytest.raises(snmp.SnmpTimeoutError):
+        snmp.run('127.0.0.1', 'get', OUTLET_STATUS, timeout=5)
+    assert fake_agent.requests == []
+
+
+@pytest.mark.snmp
+def test_v3_unknown_user(fake_agent, settings):
+    settings.WORKER_CONFIG = {'snmp_v3': {'user': 'relops', 'auth_protocol': 'SHA', 'auth_password': 'maplesyrup'}}
+    with pytest.raises(snmp.SnmpAuthError) as e:
+        snmp.run('127.0.0.1', 'get', OUTLET_STATUS, timeout=5)
+    assert 'unknown user name' in str(e.value)
+
+
+@pytest.mark.snmp
+def test_unsupported_privacy_protocol():
+    with pytest.raises(snmp.SnmpError):
+        snmp.SnmpClient('127.0.0.1', user=snmp.UsmUser('relops', 'SHA', 'maplesyrup', '3DES', 'maplesyrup'))
+
+
+@pytest.mark.snmp
+def test_snmp_reboot_native(fake_agent):
+    output = call_command('snmp_reboot', 'host.test.releng.mdc1.mozilla.com', '127.0.0.1', 'AA8', delay=0, timeout=5)
+    assert output == 'SNMP to 127.0.0.1: iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.8 = INTEGER: 3\noutlet AA8 on 0.52A\n'
+    assert fake_agent.values[OUTLET_CONTROL] == 3
+    assert fake_agent.requests[1] == (snmp.PDU_GET, [(OUTLET_STATUS, None), (OUTLET_LOAD, None)])
+
+
+@pytest.mark.snmp
+def test_snmp_reboot_native_delay(fake_agent):
+    with mock.patch('time.sleep') as sleep:
+        call_command('snmp_reboot', 'host.test.releng.mdc1.mozilla.com', '127.0.0.1', 'AA8', delay=1, timeout=5)
+    sleep.assert_called_once_with(1)
+    assert [varbinds for pdu_type, varbinds in fake_agent.requests if pdu_type == snmp.PDU_SET] == [
+        [(OUTLET_CONTROL, 2)], [(OUTLET_CONTROL, 1)]]
+
+
+def outlet(number, column=11):
+    return '1.3.6.1.4.1.1718.3.2.3.1.{}.1.1.{}'.format(column, number)
+
+
+@pytest.fixture
+def shelf(fake_agent, settings):
+    """A PDU with outlets 1 to 4 powering the hosts of a shelf."""
+    for number in range(1, 5):
+        fake_agent.values[outlet(number)] = 1
+        fake_agent.values[outlet(number, column=5)] = 0
+        fake_agent.values[outlet(number, column=7)] = 10 * number
+    # outletLoadLowThresh, the column after the table's load column
+    fake_agent.values[outlet(1, column=8)] = 0
+    settings.WORKER_CONFIG = {
+        'snmp_community_string': 'private',
+        'servers': {'mini{}'.format(number): {'pdu': '127.0.0.1:AA{}'.format(number)} for number in range(1, 5)},
+    }
+    settings.WORKER_CONFIG['servers']['mini5'] = {}
+    redis = get_redis_connection('default')
+    for key in redis.keys('snmp:*'):
+        redis.delete(key)
+    cache.delete_pattern('pdu:*')
+    yield fake_agent
+    cache.delete_pattern('pdu:*')
+
+
+@pytest.mark.snmp
+def test_batch_hosts_sends_one_set_per_pdu(shelf):
+    snmp_reboot = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+    results = snmp_reboot.batch_hosts(['mini1', 'mini3', 'mini5', 'mini4'], 'off', timeout=5)
+
+    assert results[0] == 'iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.1 = INTEGER: 2\n'
+    assert results[1] == 'iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.3 = INTEGER: 2\n'
+    assert isinstance(results[2], CommandError)
+    assert results[3] == 'iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.4 = INTEGER: 2\n'
+    assert shelf.requests == [(snmp.PDU_SET, [(outlet(1), 2), (outlet(3), 2), (outlet(4), 2)])]
+
+
+@pytest.mark.snmp
+def test_batch_sends_again_without_the_blamed_outlet(shelf):
+    shelf.read_only.add(outlet(2))
+    snmp_reboot = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+    results = snmp_reboot.batch([('127.0.0.1', 'AA1', '3'), ('127.0.0.1', 'AA2', '3'), ('127.0.0.1', 'AA3', '3')],
+                                timeout=5)
+
+    assert isinstance(results[1], snmp.SnmpError)
+    assert results[1].status == 'notWritable'
+    assert results[0] == 'iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.1 = INTEGER: 3\n'
+    assert results[2] == 'iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.3 = INTEGER: 3\n'
+    assert [varbinds for _, varbinds in shelf.requests] == [
+        [(outlet(1), 3), (outlet(2), 3), (outlet(3), 3)],
+        [(outlet(1), 3), (outlet(3), 3)],
+    ]
+
+
+@pytest.mark.snmp
+def test_snmp_reboot_jobs_coalesce_per_pdu(shelf, settings):
+    settings.SNMP_COALESCE_WINDOW = 1
+
+    def reboot(port):
+        return call_command('snmp_reboot', 'mini', '127.0.0.1', port, delay=0, timeout=5)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        outputs = list(executor.map(reboot, ['AA1', 'AA2', 'AA3']))
+
+    assert outputs == ['SNMP to 127.0.0.1: iso.3.6.1.4.1.1718.3.2.3.1.11.1.1.{0} = INTEGER: 3\n'
+                       'outlet AA{0} on 0.{0}0A\n'.format(number) for number in range(1, 4)]
+    sets = [varbinds for pdu_type, varbinds in shelf.requests if pdu_type == snmp.PDU_SET]
+    assert len(sets) == 1
+    assert sorted(sets[0]) == [(outlet(1), 3), (outlet(2), 3), (outlet(3), 3)]
+
+
+@pytest.mark.snmp
+def test_coalesced_snmp_error_reaches_its_job(shelf, settings):
+    settings.SNMP_COALESCE_WINDOW = 1
+    shelf.read_only.add(outlet(2))
+
+    with pytest.raises(snmp.SnmpError) as e:
+        call_command('snmp_reboot', 'mini', '127.0.0.1', 'AA2', delay=0, timeout=5)
+    assert e.value.status == 'notWritable'
+
+
+@pytest.mark.snmp
+def test_walk_reads_whole_columns(fake_agent):
+    for number in range(1, 31):
+        fake_agent.values[outlet(number, column=5)] = number % 2
+
+    async def walk():
+        async with snmp.SnmpClient('127.0.0.1', community='private', timeout=1, retries=0) as client:
+            return await client.walk(outlet(0, column=5).rsplit('.', 3)[0], max_repetitions=10)
+
+    loop = asyncio.new_event_loop()
+    try:
+        [(column, varbinds)] = loop.run_until_complete(walk()).items()
+    finally:
+        loop.close()
+
+    assert varbinds == [(outlet(number, column=5), number % 2) for number in range(1, 31)]
+    assert [pdu_type for pdu_type, _ in fake_agent.requests] == [snmp.PDU_GET_BULK] * 4
+
+
+@pytest.mark.snmp
+def test_walk_outlets_caches_the_pdu(shelf):
+    shelf.values[outlet(3, column=5)] = 1
+    shelf.values[outlet(4, column=7)] = -1
+    snmp_reboot = load_command_class('relops_hardware_controller.api', 'snmp_reboot')
+    entries = snmp_reboot.walk_outlets('127.0.0.1', timeout=5)
+
+    assert sorted(entries) == ['1.1.1', '1.1.2', '1.1.3', '1.1.4', '1.1.8']
+    assert (entries['1.1.2']['power'], entries['1.1.2']['load']) == ('on', 0.2)
+    assert (entries['1.1.3']['status'], entries['1.1.3']['power']) == ('off', 'off')
+    assert entries['1.1.4']['load'] is None
+    assert pdu_cache.get('127.0.0.1', '1.1.3')['status'] == 'off'
+    assert [pdu_type for pdu_type, _ in shelf.requests] == [snmp.PDU_GET_BULK]
+
+
+@pytest.mark.snmp
+def test_status_of_pdu_hosts_is_served_from_one_walk(shelf):
+    assert call_command('status', 'mini2') == 'Outlet Power is on (on, 0.20A, checked 0s ago)\n'
+    assert call_command('status', 'mini3.test.releng.mdc1.mozilla.com') == \
+        'Outlet Power is on (on, 0.30A, checked 0s ago)\n'
+    assert len(shelf.requests) == 1
+
+    call_command('status', 'mini3', max_age=0)
+    assert len(shelf.requests) == 2
+
+    with pytest.raises(CommandError):
+        call_command('status', 'mini5')
+
+
+@pytest.mark.snmp
+def test_sweep_walks_every_pdu(shelf):
+    tasks.sweep_power_status()
+
+    assert pdu_cache.get('127.0.0.1', '1.1.4')['load'] == 0.4
+    assert [pdu_type for pdu_type, _ in shelf.requests] == [snmp.PDU_GET_BULK]
+
+
+@pytest.mark.snmp
+def test_pdu_verifier_uses_the_read_back(shelf):
+    shelf.values[outlet(2, column=5)] = 3  # offWait
+    verifier = PduVerifier('mini2', {'pdu': '127.0.0.1:AA2'})
+    verifier.snapshot()
+
+    output = call_command('snmp_reboot', 'mini2', '127.0.0.1', 'AA2', delay=0, timeout=5)
+    assert output.endswith('outlet AA2 offWait 0.20A\n')
+
+    snmp_reboot = 'relops_hardware_controller.api.management.commands.snmp_reboot.Command'
+    with mock.patch(snmp_reboot + '.get_outlet_status') as status_mock:
+        assert verifier.power_cycled()
+        assert not status_mock.called
@@ -2,11 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
+import json
 import subprocess
+from io import StringIO
 
 import mock
 import pytest
 
+from django.core.cache import cache
 from django.core.management import call_command
 from django.core.management.base import CommandError
 
@@ -111,3 +115,239 @@ def test_ssh_reboot_all_reboot_commands_fail():
         ]
         for i, call in enumerate(expected_calls):
             assert cmd_mock.mock_calls[i] == call
+
+
+@pytest.fixture
+def ssh_settings(settings, tmpdir):
+    settings.SSH_CONNECT_TIMEOUT = 7
+    settings.SSH_CONTROL_DIR = str(tmpdir.join('ssh'))
+    settings.SSH_CONTROL_PERSIST = 60
+    cache.delete_pattern('ssh:*')
+    yield settings
+    cache.delete_pattern('ssh:*')
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_commands_share_one_connection(ssh_settings):
+    def cmd_side_effect(args, **kwargs):
+        if args[-1] == 'reboot':
+            raise subprocess.CalledProcessError(cmd=args, returncode=127, output='reboot: not found\n')
+        return ''
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = cmd_side_effect
+        call_command('ssh_reboot', '-l', 'test_reboot_user', '-i', '~/.ssh/test.key', 'sshd', '--timeout', '3')
+
+    reboot_call, shutdown_call, exit_call = cmd_mock.call_args_list
+    for call in (reboot_call, shutdown_call, exit_call):
+        args = call[0][0]
+        assert 'ControlMaster=auto' in args
+        assert 'ControlPath={}/%C'.format(ssh_settings.SSH_CONTROL_DIR) in args
+        assert 'ConnectTimeout=7' in args
+    assert reboot_call[0][0][-2:] == ['sshd', 'reboot']
+    assert shutdown_call[0][0][-2:] == ['sshd', 'shutdown -f -t 3 -r']
+    assert shutdown_call[1]['timeout'] == 10
+    assert exit_call[0][0][-3:] == ['-O', 'exit', 'sshd']
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_stops_when_it_cannot_connect(ssh_settings):
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = subprocess.CalledProcessError(
+            cmd='ssh', returncode=255, output='ssh: connect to host sshd port 22: Connection timed out\r\n')
+
+        with pytest.raises(CommandError) as e:
+            call_command('ssh_reboot', '-l', 'test_reboot_user', '-i', '~/.ssh/test.key', 'sshd',
+                         '--connect-timeout', '2')
+
+        assert cmd_mock.call_count == 1
+        assert 'ConnectTimeout=2' in cmd_mock.call_args[0][0]
+    assert 'Connection timed out' in str(e.value)
+
+
+def windows_side_effect(args, **kwargs):
+    if args[-1] == 'reboot':
+        raise subprocess.CalledProcessError(cmd=args, returncode=1, output="'reboot' is not recognized\r\n")
+    return ''
+
+
+def reboot_commands_run(cmd_mock):
+    return [call[0][0][-1] for call in cmd_mock.call_args_list if '-O' not in call[0][0]]
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_remembers_the_working_command(ssh_settings):
+    args = ['-l', 'test_reboot_user', '-i', '~/.ssh/test.key']
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = windows_side_effect
+        call_command('ssh_reboot', *args, 't-w1064-ms-001.test.releng.mdc1.mozilla.com')
+        assert reboot_commands_run(cmd_mock) == ['reboot', 'shutdown -f -t 3 -r']
+
+        cmd_mock.reset_mock()
+        call_command('ssh_reboot', *args, 't-w1064-ms-001')
+        assert reboot_commands_run(cmd_mock) == ['shutdown -f -t 3 -r']
+
+    assert cache.get('ssh:reboot:t-w1064-ms-001') == {'os': 'windows', 'command': 'shutdown -f -t 3 -r'}
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_forgets_a_command_that_stopped_working(ssh_settings):
+    cache.set('ssh:reboot:t-linux64-ms-001', {'os': 'windows', 'command': 'shutdown -f -t 3 -r'})
+
+    def linux_side_effect(args, **kwargs):
+        if args[-1] != 'reboot' and '-O' not in args:
+            raise subprocess.CalledProcessError(cmd=args, returncode=1, output='shutdown: invalid option -- f\n')
+        return ''
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = linux_side_effect
+        call_command('ssh_reboot', '-l', 'test_reboot_user', '-i', '~/.ssh/test.key', 't-linux64-ms-001')
+        assert reboot_commands_run(cmd_mock) == ['shutdown -f -t 3 -r', 'reboot']
+
+    assert cache.get('ssh:reboot:t-linux64-ms-001') == {'os': 'unix', 'command': 'reboot'}
+
+
+@pytest.mark.ssh_reboot
+@pytest.mark.parametrize(
+    "options, expected", [
+        (['--os', 'windows'], 'shutdown -f -t 3 -r'),
+        (['--reboot-command', 'shutdown /r /t 0'], 'shutdown /r /t 0'),
+    ], ids=['os', 'reboot_command']
+)
+def test_ssh_reboot_override_runs_only_that_command(ssh_settings, options, expected):
+    cache.set('ssh:reboot:t-w1064-ms-001', {'os': 'unix', 'command': 'reboot'})
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = subprocess.CalledProcessError(cmd='ssh', returncode=1, output='')
+        with pytest.raises(CommandError):
+            call_command('ssh_reboot', '-l', 'test_reboot_user', '-i', '~/.ssh/test.key', 't-w1064-ms-001',
+                         *options)
+        assert reboot_commands_run(cmd_mock) == [expected]
+
+    assert cache.get('ssh:reboot:t-w1064-ms-001') == {'os': 'unix', 'command': 'reboot'}
+
+
+class FakeSsh(object):
+    """Stands in for asyncio.create_subprocess_exec, answering each reboot
+    command with (returncode, output) from replies[hostname][command].
+    """
+
+    def __init__(self, replies, delay=0):
+        self.replies = replies
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, *args, **kwargs):
+        self.calls.append(args)
+        fake = self
+
+        class Proc(object):
+            returncode = None
+            killed = False
+
+            async def communicate(self):
+                fake.running += 1
+                fake.max_running = max(fake.max_running, fake.running)
+                try:
+                    await asyncio.sleep(fake.delay)
+                finally:
+                    fake.running -= 1
+                if '-O' in args:
+                    self.returncode = 0
+                    return b'', None
+                self.returncode, output = fake.replies[args[-2]].get(args[-1], (0, ''))
+                return output.encode('utf-8'), None
+
+            def kill(self):
+                self.killed = True
+
+            async def wait(self):
+                return self.returncode
+
+        return Proc()
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_fan_out_returns_a_result_per_host(ssh_settings):
+    ssh_settings.WORKER_CONFIG = {'servers': {
+        't-w1064-ms-001': {'ssh': {'user': 'winroller', 'key_file': '/keys/win.key'}},
+    }}
+    fake = FakeSsh({
+        't-w1064-ms-001.test.releng.mdc1.mozilla.com': {'reboot': (1, "'reboot' is not recognized\r\n")},
+        't-linux64-ms-001': {},
+        't-linux64-ms-002': {'reboot': (255, 'ssh: connect to host t-linux64-ms-002 port 22: No route to host\r\n')},
+    })
+    stdout = StringIO()
+    with mock.patch('asyncio.create_subprocess_exec', new=fake):
+        call_command('ssh_reboot', 't-w1064-ms-001.test.releng.mdc1.mozilla.com', 't-linux64-ms-001',
+                     't-linux64-ms-002', stdout=stdout)
+
+    results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert [(r['hostname'], r['status'], r['command']) for r in results] == [
+        ('t-w1064-ms-001.test.releng.mdc1.mozilla.com', 'ok', 'shutdown -f -t 3 -r'),
+        ('t-linux64-ms-001', 'ok', 'reboot'),
+        ('t-linux64-ms-002', 'unreachable', 'reboot'),
+    ]
+    assert 'No route to host' in results[2]['output']
+
+    windows_call = [args for args in fake.calls if args[-1] == 'shutdown -f -t 3 -r'][0]
+    assert '/keys/win.key' in windows_call and 'winroller' in windows_call
+    linux_call = [args for args in fake.calls if args[-2] == 't-linux64-ms-001'][0]
+    assert 'ssh.key' in linux_call and 'roller' in linux_call
+    assert cache.get('ssh:reboot:t-w1064-ms-001') == {'os': 'windows', 'command': 'shutdown -f -t 3 -r'}
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_fan_out_bounds_concurrency(ssh_settings):
+    from relops_hardware_controller.api.management.commands import ssh_reboot
+
+    ssh_settings.WORKER_CONFIG = {'servers': {}}
+    hostnames = ['t-linux64-ms-{:03d}'.format(i) for i in range(10)]
+    fake = FakeSsh({hostname: {} for hostname in hostnames}, delay=0.01)
+    with mock.patch('asyncio.create_subprocess_exec', new=fake):
+        results = ssh_reboot.fan_out(hostnames, max_concurrency=3)
+
+    assert [result['status'] for result in results] == ['ok'] * 10
+    assert fake.max_running == 3
+
+
+@pytest.mark.ssh_reboot
+def test_ssh_reboot_fan_out_times_out_per_host(ssh_settings):
+    from relops_hardware_controller.api.management.commands import ssh_reboot
+
+    ssh_settings.WORKER_CONFIG = {'servers': {}}
+    fake = FakeSsh({'t-linux64-ms-001': {}}, delay=1)
+    with mock.patch('asyncio.create_subprocess_exec', new=fake):
+        [result] = ssh_reboot.fan_out(['t-linux64-ms-001'], timeout=0, connect_timeout=0.05)
+
+    assert result['status'] == 'timeout'
+    assert result['elapsed'] < 1
+    assert len(fake.calls) == 1
+
+
+@pytest.mark.ssh_reboot
+def test_bulk_task_fans_out_over_the_worker_ids(ssh_settings):
+    from relops_hardware_controller import celery
+
+    ssh_settings.WORKER_CONFIG = {'servers': {}}
+    fake = FakeSsh({'t-linux64-ms-001.test.releng.mdc1.mozilla.com': {},
+                    't-linux64-ms-002.test.releng.mdc1.mozilla.com': {'reboot': (1, ''),
+                                                                      'shutdown -f -t 3 -r': (1, '')}})
+
+    def lookup(worker_id):
+        return '{}.test.releng.mdc1.mozilla.com.'.format(worker_id), '10.0.0.1'
+
+    with mock.patch('asyncio.create_subprocess_exec', new=fake), \
+            mock.patch.object(celery, 'dns_lookup', side_effect=lookup), \
+            mock.patch('taskcluster.Notify') as notify_ctor:
+        results = celery.celery_bulk_call_command(dict(
+            task_name='ssh_reboot',
+            worker_ids=['t-linux64-ms-001', 't-linux64-ms-002'],
+            client_id='mozilla-ldap/test@mozilla.com',
+        ))
+
+    assert [result['status'] for result in results] == ['ok', 'failed']
+    message = notify_ctor.return_value.irc.call_args[0][0]['message']
+    assert message == 'ssh_reboot of 2 hosts: 1 ok, t-linux64-ms-002.test.releng.mdc1.mozilla.com failed'
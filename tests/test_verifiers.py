@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hpilo
+import mock
+import pytest
+
+from relops_hardware_controller.api import ilo as ilo_client
+from relops_hardware_controller.api.management.commands.reboot import reboot_succeeded
+from relops_hardware_controller.api.verifiers import (
+    IloVerifier,
+    IpmiVerifier,
+    PduVerifier,
+    XenVerifier,
+    get_verifier,
+)
+
+
+sel_before = '''   1 | 05/23/2018 | 17:30:01 | Power Unit #0x01 | Power off/down | Asserted
+   2 | 05/23/2018 | 17:30:05 | System Boot Initiated #0x02 | Initiated by power up | Asserted
+'''
+sel_after = sel_before + '''\
+   3 | 05/24/2018 | 09:00:00 | System Boot Initiated #0x02 | Initiated by hard reset | Asserted
+'''
+
+
+@pytest.mark.verifiers
+def test_get_verifier_returns_none_for_in_band_methods():
+    assert get_verifier('ssh_reboot', 'host', {}) is None
+    assert get_verifier('file_bugzilla_bug', 'host', {}) is None
+    assert isinstance(get_verifier('ipmi_reset', 'host', {}), IpmiVerifier)
+
+
+@pytest.mark.verifiers
+def test_ipmi_verifier_detects_warm_reset_from_sel():
+    verifier = IpmiVerifier('host', {})
+
+    with mock.patch.object(IpmiVerifier, '_ipmi') as ipmi_mock:
+        ipmi_mock.side_effect = lambda command: {
+            'ipmi_list': sel_before,
+            'ipmi_status': 'Chassis Power is on\n',
+        }[command]
+        verifier.snapshot()
+        assert verifier.last_sel_id == 2
+        assert not verifier.power_cycled()
+
+        ipmi_mock.side_effect = lambda command: {
+            'ipmi_list': sel_after,
+            'ipmi_status': 'Chassis Power is on\n',
+        }[command]
+        assert verifier.power_cycled()
+
+
+@pytest.mark.verifiers
+def test_ipmi_verifier_remembers_power_off():
+    verifier = IpmiVerifier('host', {})
+
+    with mock.patch.object(IpmiVerifier, '_ipmi') as ipmi_mock:
+        ipmi_mock.side_effect = lambda command: {
+            'ipmi_list': '',
+            'ipmi_status': 'Chassis Power is off\n',
+        }[command]
+        assert verifier.power_cycled()
+
+        # once seen off a host that is back on still counts as cycled
+        ipmi_mock.side_effect = lambda command: {
+            'ipmi_list': '',
+            'ipmi_status': 'Chassis Power is on\n',
+        }[command]
+        assert verifier.power_cycled()
+
+
+@pytest.mark.verifiers
+def test_pdu_verifier_reads_outlet_status(settings):
+    settings.WORKER_CONFIG = {'snmp_community_string': 'private'}
+    settings.SNMP_CLIENT = 'net-snmp'
+    verifier = PduVerifier('host', {'pdu': 'pdu1.r201-6.ops.releng.mdc1.mozilla.com:AA1'})
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.return_value = '3\n'  # offWait
+        assert verifier.power_cycled()
+
+        assert cmd_mock.call_args[0][0] == [
+            'snmpget', '-v', '2c', '-c', 'private', '-Oqve', 'pdu1.r201-6.ops.releng.mdc1.mozilla.com',
+            '1.3.6.1.4.1.1718.3.2.3.1.5.1.1.1']
+
+
+@pytest.mark.verifiers
+def test_verifier_errors_are_not_a_power_cycle(settings):
+    settings.WORKER_CONFIG = {'snmp_community_string': 'private'}
+    settings.SNMP_CLIENT = 'net-snmp'
+    verifier = PduVerifier('host', {'pdu': 'pdu1:AA1'})
+
+    with mock.patch('subprocess.check_output') as cmd_mock:
+        cmd_mock.side_effect = Exception('Timeout: No Response from pdu1')
+        assert not verifier.power_cycled()
+
+
+@pytest.mark.verifiers
+def test_xen_verifier_detects_restart_from_start_time():
+    verifier = XenVerifier('host', {'xen': {'reboot': ['test_xen_vm_uuid']}})
+
+    with mock.patch('relops_hardware_controller.api.management.commands'
+                    '.xenapi_reboot.XenAPI.Session') as mock_session_ctor:
+        mock_session = mock_session_ctor.return_value
+        mock_session.xenapi.VM.get_power_state.return_value = 'Running'
+        mock_session.xenapi.VM_metrics.get_start_time.return_value = '20180524T09:00:00Z'
+
+        verifier.snapshot()
+        assert not verifier.power_cycled()
+
+        mock_session.xenapi.VM_metrics.get_start_time.return_value = '20180524T09:01:00Z'
+        assert verifier.power_cycled()
+
+
+@pytest.mark.verifiers
+def test_reboot_succeeded_uses_verifier_without_ping(settings):
+    settings.DOWN_TIMEOUT = 1
+    settings.UP_TIMEOUT = 1
+    settings.REBOOT_VERIFY_WITH_PING = False
+
+    verifier = mock.Mock()
+    verifier.power_cycled.return_value = True
+    up_check = mock.Mock()
+    up_check.is_up.return_value = True
+
+    with mock.patch('relops_hardware_controller.api.management.commands'
+                    '.reboot.can_ping') as can_ping_mock, \
+            mock.patch('time.sleep'):
+        can_ping_mock.return_value = True  # never seen down by ICMP
+
+        assert reboot_succeeded('host', verifier=verifier, up_checks=[up_check])
+
+        verifier.power_cycled.assert_called_once_with()
+        up_check.is_up.assert_called_once_with()
+        assert not can_ping_mock.called
+
+
+@pytest.fixture
+def ilo_verifier():
+    ilo_client.forget('test.ilo.hostname')
+    with mock.patch('hpilo.Ilo') as mock_ilo_ctor:
+        # like python-hpilo 4.3
+        del mock_ilo_ctor.return_value.get_post_state
+        yield IloVerifier('host', {'ilo': ['test.ilo.hostname']}), mock_ilo_ctor.return_value
+    ilo_client.forget('test.ilo.hostname')
+
+
+@pytest.mark.verifiers
+def test_ilo_verifier_reads_a_warm_reset_from_the_post_state(ilo_verifier):
+    verifier, mock_ilo = ilo_verifier
+    mock_ilo._info_tag.return_value = None
+
+    mock_ilo.call_delayed.return_value = ['ON', 'FinishedPost']
+    verifier.snapshot()
+    assert not verifier.power_cycled()
+    assert not verifier.finished_boot()
+
+    mock_ilo.call_delayed.return_value = ['ON', 'InPost']
+    assert verifier.power_cycled()
+    assert not verifier.finished_boot()
+
+    mock_ilo.call_delayed.return_value = ['ON', 'FinishedPost']
+    assert verifier.finished_boot()
+
+    # power and POST state in one request per poll
+    assert mock_ilo.call_delayed.call_count == 5
+    assert mock_ilo.get_host_power_status.call_count == 5
+    mock_ilo._info_tag.assert_called_with('SERVER_INFO', 'GET_POST_STATE', 'POST_STATE', process=mock.ANY)
+
+
+@pytest.mark.verifiers
+def test_ilo_verifier_without_post_state_reads_power(ilo_verifier):
+    verifier, mock_ilo = ilo_verifier
+    mock_ilo.call_delayed.side_effect = [
+        hpilo.IloError('Syntax error: Line #0: syntax error near ">" in the line: " GET_POST_STATE>".'),
+        ['OFF'],
+        ['ON'],
+    ]
+
+    assert verifier.power_cycled()
+    assert not verifier.post_state_supported
+    assert not verifier.finished_boot()
+    assert mock_ilo._info_tag.call_count == 1
+
+
+@pytest.mark.verifiers
+def test_reboot_succeeded_ends_on_finished_post(settings, ilo_verifier):
+    settings.DOWN_TIMEOUT = 1
+    settings.UP_TIMEOUT = 60
+    settings.REBOOT_VERIFY_WITH_PING = False
+    verifier, mock_ilo = ilo_verifier
+    mock_ilo.call_delayed.side_effect = [['OFF', 'PowerOff'], ['ON', 'InPost'], ['ON', 'FinishedPost']]
+    up_check = mock.Mock()
+    up_check.is_up.return_value = False
+
+    with mock.patch('time.sleep'):
+        assert reboot_succeeded('host', verifier=verifier, up_checks=[up_check])
+
+    assert up_check.is_up.call_count == 2
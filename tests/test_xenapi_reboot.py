@@ -2,12 +2,35 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import contextlib
+import datetime
+import socketserver
+import ssl
+import threading
+import time
+from xmlrpc.client import ServerProxy
+from xmlrpc.server import (
+    SimpleXMLRPCRequestHandler,
+    SimpleXMLRPCServer,
+)
+
 import mock
 import pytest
 
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import (
+    hashes,
+    serialization,
+)
+from cryptography.hazmat.primitives.asymmetric import rsa
+
 from django.core.management import call_command
 from django.core.management.base import CommandError
 
+from relops_hardware_controller import XenAPI
+from relops_hardware_controller.api.management.commands import xenapi_reboot
+
 
 @pytest.mark.xenapi_reboot
 @pytest.mark.parametrize(
@@ -24,18 +47,30 @@ def test_xenapi_reboot_requires_arg(args):
 # TODO: test invalid args
 
 
+def vm_events(mock_session, *power_states):
+    """Makes event.from of mock_session report the VM in each of power_states in turn."""
+    getattr(mock_session.xenapi.event, 'from').side_effect = [
+        dict(token=str(index + 1), valid_ref_counts={}, events=[{
+            'class': 'vm',
+            'ref': mock_session.xenapi.VM.get_by_uuid.return_value,
+            'operation': 'mod',
+            'snapshot': dict(power_state=power_state, guest_metrics='OpaqueRef:NULL'),
+        }]) for index, power_state in enumerate(power_states)]
+
+
 @pytest.mark.xenapi_reboot
 def test_xenapi_reboot_login_failure():
     with mock.patch('relops_hardware_controller.api.management.commands'
                     '.xenapi_reboot.XenAPI.Session') as mock_session_ctor:
         mock_session = mock_session_ctor.return_value
+        vm_events(mock_session, 'Halted')
 
         mock_session.login_with_password.side_effect = \
             Exception("XenAPI login failed.")
 
         call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
 
-        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/')
+        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/', timeout=300)
 
         mock_session.login_with_password.assert_called_once_with('xen_dev_username', 'anything_zen_password')
 
@@ -47,11 +82,12 @@ def test_xenapi_soft_reboot_success():
     with mock.patch('relops_hardware_controller.api.management.commands'
                     '.xenapi_reboot.XenAPI.Session') as mock_session_ctor:
         mock_session = mock_session_ctor.return_value
+        vm_events(mock_session, 'Halted')
         mock_vm = mock_session.xenapi.VM.get_by_uuid.return_value
 
         call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
 
-        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/')
+        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/', timeout=300)
 
         mock_session.login_with_password.assert_called_once_with('xen_dev_username', 'anything_zen_password')
 
@@ -68,13 +104,14 @@ def test_xenapi_hard_reboot_success():
     with mock.patch('relops_hardware_controller.api.management.commands'
                     '.xenapi_reboot.XenAPI.Session') as mock_session_ctor:
         mock_session = mock_session_ctor.return_value
+        vm_events(mock_session, 'Halted')
         mock_vm = mock_session.xenapi.VM.get_by_uuid.return_value
 
         mock_session.xenapi.VM.clean_shutdown.side_effect = Exception("XenAPI clean shutdown failed.")
 
         call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
 
-        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/')
+        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/', timeout=300)
 
         mock_session.login_with_password.assert_called_once_with('xen_dev_username', 'anything_zen_password')
 
@@ -99,7 +136,7 @@ def test_xenapi_reboot_shutdown_failure():
         with pytest.raises(Exception):
             call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
 
-        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/')
+        mock_session_ctor.assert_called_once_with(uri='https://xenapiserver/', timeout=300)
 
         mock_session.login_with_password.assert_called_once_with('xen_dev_username', 'anything_zen_password')
 
@@ -108,3 +145,334 @@ def test_xenapi_reboot_shutdown_failure():
         mock_session.xenapi.VM.hard_shutdown.assert_called_once_with(mock_vm)
 
         mock_session.xenapi.session.logout.assert_called_once_with()
+
+
+class KeepAliveHandler(SimpleXMLRPCRequestHandler):
+    # xapi keeps connections open between calls
+    protocol_version = 'HTTP/1.1'
+
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients close kept alive connections without a TLS close_notify
+        pass
+
+
+def server_context(tmpdir):
+    """Returns an ssl.SSLContext serving a self-signed certificate for 127.0.0.1."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()).serial_number(1).not_valid_before(now).not_valid_after(
+        now + datetime.timedelta(days=1)).sign(key, hashes.SHA256(), default_backend())
+    cert_file = tmpdir.join('xapi.pem')
+    cert_file.write_binary(cert.public_bytes(serialization.Encoding.PEM) + key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(str(cert_file))
+    return context
+
+
+class FakeXapi(object):
+    """XML-RPC stand-in for the xapi calls xenapi_reboot makes, serving
+    https when given an ssl.SSLContext. Its VM runs, and boot_time
+    seconds after VM.start its guest agent reports guest metrics unless
+    guest_agent is False.
+    """
+
+    def __init__(self, context=None):
+        self.sessions = set()
+        self.calls = []
+        self.logins = 0
+        self.boot_time = 0.2
+        self.guest_agent = True
+        self.halt_time = 0
+        self.changed = threading.Condition()
+        self.generation = 0
+        # ref to (class, generation of the last change, record or None once deleted)
+        self.objects = {}
+        self.set_object('VM', 'OpaqueRef:vm', dict(power_state='Running', guest_metrics='OpaqueRef:NULL'))
+        self.guest_reports()
+
+        self.server = ThreadingXMLRPCServer(('127.0.0.1', 0), requestHandler=KeepAliveHandler,
+                                            logRequests=False, allow_none=True)
+        if context is not None:
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.server.register_function(self.login_with_password, 'session.login_with_password')
+        self.server.register_function(self.logout, 'session.logout')
+        for name, value in [
+                ('pool.get_all', ['OpaqueRef:pool']),
+                ('pool.get_master', 'OpaqueRef:host'),
+                ('host.get_API_version_major', '2'),
+                ('host.get_API_version_minor', '7'),
+                ('VM.get_by_uuid', 'OpaqueRef:vm'),
+                ('VM.get_power_state', lambda vm: self.objects[vm][2]['power_state']),
+                ('VM.clean_shutdown', self.shutdown),
+                ('VM.start', self.start),
+                ('event.from', self.event_from)]:
+            self.server.register_function(self.call(name, value), name)
+        scheme = 'http' if context is None else 'https'
+        self.url = '{}://127.0.0.1:{}/'.format(scheme, self.server.server_address[1])
+
+    def login_with_password(self, username, password, *args):
+        self.logins += 1
+        session = 'OpaqueRef:session-{}'.format(self.logins)
+        self.sessions.add(session)
+        return dict(Status='Success', Value=session)
+
+    def logout(self, session):
+        self.calls.append('session.logout')
+        self.sessions.discard(session)
+        return dict(Status='Success', Value='')
+
+    def call(self, name, value):
+        def method(session, *args):
+            if session not in self.sessions:
+                return dict(Status='Failure', ErrorDescription=['SESSION_INVALID', session])
+            self.calls.append(name)
+            return dict(Status='Success', Value=value(*args) if callable(value) else value)
+        return method
+
+    def set_object(self, cls, ref, record):
+        with self.changed:
+            self.generation += 1
+            self.objects[ref] = (cls, self.generation, record)
+            self.changed.notify_all()
+
+    def set_vm(self, **fields):
+        record = dict(self.objects['OpaqueRef:vm'][2], **fields)
+        self.set_object('VM', 'OpaqueRef:vm', record)
+
+    def guest_reports(self):
+        ref = 'OpaqueRef:guest-metrics-{}'.format(self.generation)
+        self.set_object('VM_guest_metrics', ref, dict(networks={'0/ip': '10.0.0.5'}))
+        self.set_vm(guest_metrics=ref)
+
+    def shutdown(self, vm):
+        if self.halt_time == 0:
+            self.halted(vm)
+        elif self.halt_time is not None:
+            threading.Timer(self.halt_time, self.halted, args=(vm,)).start()
+        return ''
+
+    def halted(self, vm):
+        self.set_object('VM_guest_metrics', self.objects[vm][2]['guest_metrics'], None)
+        self.set_vm(power_state='Halted', guest_metrics='OpaqueRef:NULL')
+
+    def start(self, vm, paused, force):
+        self.set_vm(power_state='Running')
+        if self.guest_agent:
+            threading.Timer(self.boot_time, self.guest_reports).start()
+        return ''
+
+    def matches(self, classes, cls, ref):
+        return cls in classes or '{}/{}'.format(cls, ref) in classes
+
+    def event_from(self, classes, token, timeout):
+        since = int(token or 0)
+        with self.changed:
+            self.changed.wait_for(lambda: not token or self.generation > since, timeout)
+            events = []
+            for ref, (cls, generation, record) in sorted(self.objects.items(), key=lambda item: item[1][1]):
+                if generation <= since or not self.matches(classes, cls, ref):
+                    continue
+                if record is None:
+                    if token:
+                        events.append(dict(id=generation, ref=ref, operation='del'))
+                        events[-1]['class'] = cls.lower()
+                    continue
+                events.append(dict(id=generation, ref=ref, operation='mod' if token else 'add', snapshot=record))
+                events[-1]['class'] = cls.lower()
+            return dict(events=events, valid_ref_counts={}, token=str(self.generation))
+
+
+@pytest.fixture
+def xapi(settings):
+    with serving(FakeXapi()) as fake:
+        settings.XEN_URL = fake.url
+        settings.XEN_SESSION_IDLE = 600
+        settings.XEN_GUEST_TIMEOUT = 0
+        xenapi_reboot.pool.close_all()
+        yield fake
+        xenapi_reboot.pool.close_all()
+
+
+@pytest.fixture
+def xapi_https(tmpdir):
+    with serving(FakeXapi(server_context(tmpdir))) as fake:
+        yield fake
+
+
+@contextlib.contextmanager
+def serving(fake):
+    thread = threading.Thread(target=fake.server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        yield fake
+    finally:
+        fake.server.shutdown()
+        fake.server.server_close()
+        thread.join()
+
+
+vm_calls = ['VM.get_by_uuid', 'VM.clean_shutdown', 'event.from', 'VM.start']
+api_version_calls = ['pool.get_all', 'pool.get_master', 'host.get_API_version_major', 'host.get_API_version_minor']
+
+
+@pytest.mark.xenapi_reboot
+def test_xenapi_reboot_reuses_the_pooled_session(xapi):
+    with mock.patch('time.sleep'):
+        call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
+        assert xapi.calls == api_version_calls + vm_calls
+
+        xapi.calls = []
+        call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
+    assert xapi.calls == vm_calls
+    assert xapi.logins == 1
+
+    xenapi_reboot.pool.close_all()
+    assert xapi.calls[-1] == 'session.logout'
+    assert xapi.sessions == set()
+
+
+@pytest.mark.xenapi_reboot
+def test_xenapi_reboot_logs_in_again_on_session_invalid(xapi):
+    with mock.patch('time.sleep'):
+        call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
+
+        # e.g. the pool master restarted
+        xapi.sessions.clear()
+        xapi.calls = []
+        call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
+
+    assert xapi.logins == 2
+    assert xapi.calls == api_version_calls + vm_calls
+
+
+@pytest.mark.xenapi_reboot
+def test_idle_xen_sessions_are_logged_out(xapi, settings):
+    with mock.patch('time.sleep'):
+        call_command('xenapi_reboot', 'test_xen_vm_uuid', delay=1)
+
+    [(session, last_used)] = xenapi_reboot.pool.sessions[(xapi.url, 'xen_dev_username')]
+    xenapi_reboot.pool.sessions[(xapi.url, 'xen_dev_username')] = [(session, last_used - 601)]
+
+    assert xenapi_reboot.Command().power_on('test_xen_vm_uuid') is None
+    assert xapi.logins == 2
+    assert xapi.sessions == {'OpaqueRef:session-2'}
+
+
+@pytest.mark.xenapi_reboot
+def test_xen_session_keeps_its_connection(xapi):
+    session = XenAPI.Session(uri=xapi.url, timeout=5)
+    session.login_with_password('xen_dev_username', 'xen_dev_password')
+    for _ in range(5):
+        assert session.xenapi.VM.get_power_state('OpaqueRef:vm') == 'Running'
+    session.xenapi.session.logout()
+
+    assert session.transport.connections == 1
+    assert session.transport._connection[1].sock.gettimeout() == 5
+
+
+@pytest.mark.xenapi_reboot
+def test_xen_session_resumes_tls_on_reconnect(xapi_https):
+    session = XenAPI.Session(uri=xapi_https.url, ignore_ssl=True)
+    session.login_with_password('xen_dev_username', 'xen_dev_password')
+    vm = session.xenapi.VM.get_by_uuid('test_xen_vm_uuid')
+
+    # e.g. the load balancer in front of xapi dropped the idle connection
+    session.transport.close()
+    assert session.xenapi.VM.get_power_state(vm) == 'Running'
+
+    assert session.transport.connections == 2
+    assert session.transport.resumed == 1
+
+
+def rpc_latency(proxy, calls):
+    """Returns the mean seconds of calls VM.get_power_state RPCs on proxy."""
+    session = proxy.session.login_with_password('xen_dev_username', 'xen_dev_password')['Value']
+    start = time.perf_counter()
+    for _ in range(calls):
+        assert proxy.VM.get_power_state(session, 'OpaqueRef:vm')['Value'] == 'Running'
+    return (time.perf_counter() - start) / calls
+
+
+class Reconnecting(XenAPI.KeepAliveTransport):
+    """KeepAliveTransport connecting again for every request like a
+    server or proxy closing idle connections would make it.
+    """
+
+    def __init__(self, resume, **kwargs):
+        super(Reconnecting, self).__init__(**kwargs)
+        self.resume = resume
+
+    def single_request(self, *args, **kwargs):
+        self.close()
+        if not self.resume:
+            self.tls_session = None
+        return super(Reconnecting, self).single_request(*args, **kwargs)
+
+
+@pytest.mark.xenapi_reboot
+def test_benchmark_keep_alive_rpc_latency(xapi_https):
+    """Benchmark of XenAPI RPC latency over https against FakeXapi.
+    Run with -s to see the numbers.
+    """
+    calls = 50
+    transports = [
+        ('xmlrpc.client default', None),
+        ('reconnect, full handshake', Reconnecting(False, context=ssl._create_unverified_context())),
+        ('reconnect, resumed TLS', Reconnecting(True, context=ssl._create_unverified_context())),
+        ('KeepAliveTransport', XenAPI.KeepAliveTransport(context=ssl._create_unverified_context())),
+    ]
+    for name, transport in transports:
+        if transport is None:
+            proxy = ServerProxy(xapi_https.url, context=ssl._create_unverified_context(), allow_none=True)
+        else:
+            proxy = ServerProxy(xapi_https.url, transport=transport, allow_none=True)
+        latency = rpc_latency(proxy, calls)
+        print('{:<26} {:7.3f} ms/call'.format(name, latency * 1000))
+
+    [full, resumed, keep_alive] = [transport for _, transport in transports[1:]]
+    assert full.connections == resumed.connections == calls + 1
+    assert full.resumed == 0
+    assert resumed.resumed == calls
+    assert keep_alive.connections == 1
+
+
+@pytest.mark.xenapi_reboot
+def test_xenapi_reboot_starts_halted_vm_and_waits_for_the_guest(xapi):
+    with mock.patch('time.sleep') as sleep_mock:
+        output = call_command('xenapi_reboot', 'test_xen_vm_uuid', guest_timeout=10)
+        assert not sleep_mock.called
+
+    assert output.startswith('xen VM test_xen_vm_uuid started, guest ready after ')
+    assert output.endswith(' 10.0.0.5')
+    # halted, started and the guest agent reporting, each without polling
+    assert xapi.calls[-3:] == ['VM.start', 'event.from', 'event.from']
+
+
+@pytest.mark.xenapi_reboot
+def test_xenapi_reboot_reports_a_silent_guest(xapi):
+    xapi.guest_agent = False
+    output = call_command('xenapi_reboot', 'test_xen_vm_uuid', guest_timeout=1)
+
+    assert output == 'xen VM test_xen_vm_uuid started, guest agent not reporting after 1s'
+    assert xapi.objects['OpaqueRef:vm'][2]['power_state'] == 'Running'
+
+
+@pytest.mark.xenapi_reboot
+def test_xenapi_reboot_waits_for_the_vm_to_halt(xapi):
+    # the shutdown returns while the VM is still halting
+    xapi.halt_time = 0.2
+    assert call_command('xenapi_reboot', 'test_xen_vm_uuid') == 'xen VM test_xen_vm_uuid started'
+    assert xapi.calls[-3:] == ['event.from', 'event.from', 'VM.start']
+
+    xapi.halt_time = None
+    with mock.patch.object(xenapi_reboot, 'HALT_TIMEOUT', 0):
+        with pytest.raises(Exception, match='is Running after shutting it down'):
+            call_command('xenapi_reboot', 'test_xen_vm_uuid')
+    assert xapi.calls[-1] == 'event.from'